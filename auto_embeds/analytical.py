@@ -1,12 +1,14 @@
-from typing import Tuple, Union
+from typing import List, Optional, Tuple, Union
 
 import torch as t
 from jaxtyping import Float
+from roma import special_procrustes
 from roma.utils import rigid_vectors_registration
 from torch import Tensor
 from torch.utils.data import DataLoader
 
 from auto_embeds.modules import ManualTransformModule
+from auto_embeds.utils.instrument import instrumented
 from auto_embeds.utils.logging import logger
 from auto_embeds.utils.misc import default_device
 
@@ -14,7 +16,7 @@ from auto_embeds.utils.misc import default_device
 def calc_translation(
     train_src_embeds: Float[Tensor, "batch pos d_model"],
     train_tgt_embeds: Float[Tensor, "batch pos d_model"],
-) -> Float[Tensor, "pos d_model"]:
+) -> Float[Tensor, "d_model"]:
     """Calculates translation vector for source to target language embeddings.
 
     Args:
@@ -22,10 +24,10 @@ def calc_translation(
         train_tgt_embeds: Target language embeddings of shape.
 
     Returns:
-        Translation vector of shape (pos, d_model).
+        Translation vector of shape (d_model).
     """
-    X = train_src_embeds.detach().clone().squeeze()
-    Y = train_tgt_embeds.detach().clone().squeeze()
+    X = train_src_embeds.detach().squeeze()
+    Y = train_tgt_embeds.detach().squeeze()
     T = t.mean(Y - X, dim=0)
     return T
 
@@ -45,8 +47,8 @@ def calc_procrustes_roma(
             - Rotation matrix of shape (d_model, d_model).
             - Scale factor.
     """
-    A = train_src_embeds.detach().clone().squeeze()
-    B = train_tgt_embeds.detach().clone().squeeze()
+    A = train_src_embeds.detach().squeeze()
+    B = train_tgt_embeds.detach().squeeze()
     R, scale = rigid_vectors_registration(A, B, compute_scaling=True)
     return R, scale
 
@@ -68,13 +70,14 @@ def calc_orthogonal_procrustes(
             - Rotation matrix of shape (d_model, d_model).
             - Scale factor.
     """
-    A = train_src_embeds.detach().clone().squeeze()
-    B = train_tgt_embeds.detach().clone().squeeze()
+    A = train_src_embeds.detach().squeeze()
+    B = train_tgt_embeds.detach().squeeze()
     M = t.matmul(B.T, A)
     U, S, Vt = t.linalg.svd(M)
     if ensure_rotation:
         if t.det(t.matmul(U, Vt)) < 0.0:
-            Vt[:, -1] *= -1.0
+            # flip the direction of the smallest singular value
+            Vt[-1, :] *= -1.0
     R = t.matmul(U, Vt)
     scale = S.sum()
     return R, scale
@@ -95,8 +98,8 @@ def calc_linear_map(
             - Linear map matrix of shape (d_model, d_model).
             - Residual of the least squares solution.
     """
-    A = train_src_embeds.detach().clone().squeeze()
-    B = train_tgt_embeds.detach().clone().squeeze()
+    A = train_src_embeds.detach().squeeze()
+    B = train_tgt_embeds.detach().squeeze()
     # A and B after squeezing is [batch d_model] and as we are following the convention
     # of having our transformation matrix be left-multiplied i.e.
     # XA = B
@@ -116,6 +119,249 @@ def calc_linear_map(
     return X
 
 
+class EmbeddingStatistics:
+    """Streaming sufficient statistics of paired source and target embeddings.
+
+    The analytical transforms only depend on the data through a few d_model sized
+    statistics: the means (translation), the cross-covariance BᵀA (Procrustes) and
+    additionally the Gram matrix AᵀA (least squares). These are accumulated batch by
+    batch with update, so fitting needs O(d_model²) memory however large the dataset,
+    and the transforms are solved from them at the end. The statistics are accumulated
+    in float64 (float32 on mps, which has no float64) to limit the loss of precision
+    from summing over many batches.
+
+    Args:
+        d_model: The dimensionality of the embeddings.
+        gram: Whether to accumulate AᵀA and AᵀB, only needed by linear_map.
+        device: The device to accumulate the statistics on.
+    """
+
+    def __init__(
+        self,
+        d_model: int,
+        gram: bool = False,
+        device: Union[str, t.device] = default_device,
+    ):
+        self.device = t.device(device)
+        self.dtype = t.float32 if self.device.type == "mps" else t.float64
+        kwargs = {"device": self.device, "dtype": self.dtype}
+        self.n = 0
+        self.src_sum = t.zeros(d_model, **kwargs)
+        self.tgt_sum = t.zeros(d_model, **kwargs)
+        self.src_sq_norm_sum = t.zeros((), **kwargs)
+        self.tgt_src = t.zeros(d_model, d_model, **kwargs)
+        self.src_src: Optional[Tensor] = None
+        self.src_tgt: Optional[Tensor] = None
+        if gram:
+            self.src_src = t.zeros(d_model, d_model, **kwargs)
+            self.src_tgt = t.zeros(d_model, d_model, **kwargs)
+
+    @t.no_grad()
+    def update(
+        self,
+        src_embeds: Float[Tensor, "... d_model"],
+        tgt_embeds: Float[Tensor, "... d_model"],
+    ) -> None:
+        """Adds a batch of paired embeddings to the statistics.
+
+        Args:
+            src_embeds: Source language embeddings, e.g. of shape [batch pos d_model].
+            tgt_embeds: The corresponding target language embeddings.
+        """
+        d_model = self.src_sum.shape[0]
+        A = src_embeds.detach().reshape(-1, d_model).to(self.device, self.dtype)
+        B = tgt_embeds.detach().reshape(-1, d_model).to(self.device, self.dtype)
+        self.n += A.shape[0]
+        self.src_sum += A.sum(dim=0)
+        self.tgt_sum += B.sum(dim=0)
+        self.src_sq_norm_sum += A.square().sum()
+        self.tgt_src.addmm_(B.T, A)
+        if self.src_src is not None and self.src_tgt is not None:
+            self.src_src.addmm_(A.T, A)
+            self.src_tgt.addmm_(A.T, B)
+
+    @classmethod
+    def from_loader(
+        cls,
+        train_loader: DataLoader,
+        gram: bool = False,
+        device: Union[str, t.device] = default_device,
+    ) -> "EmbeddingStatistics":
+        """Accumulates the statistics of every (src, tgt) batch of a DataLoader."""
+        stats = None
+        for src_embeds, tgt_embeds in train_loader:
+            if stats is None:
+                stats = cls(src_embeds.shape[-1], gram=gram, device=device)
+            stats.update(src_embeds, tgt_embeds)
+        if stats is None:
+            raise ValueError("Cannot compute statistics of an empty DataLoader.")
+        return stats
+
+    def _check_not_empty(self) -> None:
+        if self.n == 0:
+            raise ValueError("No embeddings have been added to the statistics.")
+
+    def translation(self) -> Float[Tensor, "d_model"]:
+        """Solves for the translation, the same as calc_translation."""
+        self._check_not_empty()
+        return ((self.tgt_sum - self.src_sum) / self.n).float()
+
+    def orthogonal_procrustes(
+        self, ensure_rotation: bool = False
+    ) -> Tuple[Float[Tensor, "d_model d_model"], Float[Tensor, ""]]:
+        """Solves for the orthogonal Procrustes rotation matrix and scale, the same as
+        calc_orthogonal_procrustes."""
+        self._check_not_empty()
+        U, S, Vt = t.linalg.svd(self.tgt_src)
+        if ensure_rotation:
+            if t.det(t.matmul(U, Vt)) < 0.0:
+                # flip the direction of the smallest singular value
+                Vt[-1, :] *= -1.0
+        R = t.matmul(U, Vt)
+        scale = S.sum()
+        return R.float(), scale.float()
+
+    def procrustes_roma(
+        self,
+    ) -> Tuple[Float[Tensor, "d_model d_model"], Float[Tensor, ""]]:
+        """Solves for the rotation and scale, the same as calc_procrustes_roma."""
+        self._check_not_empty()
+        R, DS = special_procrustes(self.tgt_src / self.n, return_singular_values=True)
+        scale = DS.sum() / (self.src_sq_norm_sum / self.n)
+        return R.float(), scale.float()
+
+    def linear_map(self) -> Float[Tensor, "d_model d_model"]:
+        """Solves for the least squares linear map from the statistics.
+
+        Unlike calc_linear_map, which runs lstsq on the embeddings themselves, this
+        solves the normal equations AᵀA Xᵀ = AᵀB, which squares the condition number
+        of A. The two agree for well conditioned A, but the normal equations lose
+        precision as A becomes ill-conditioned, so a warning is logged when the
+        condition number of AᵀA exceeds max_gram_condition. For a rank deficient A only
+        the eigenvalues of AᵀA above a tolerance are inverted (as in pinv), which gives
+        the minimum norm solution, where lstsq's solution depends on its driver.
+        """
+        self._check_not_empty()
+        if self.src_src is None or self.src_tgt is None:
+            raise ValueError("linear_map needs statistics accumulated with gram=True.")
+        eigenvalues, eigenvectors = t.linalg.eigh(self.src_src)
+        condition = eigenvalues[-1] / eigenvalues[0].clamp(min=0)
+        if condition > max_gram_condition(self.dtype):
+            logger.warning(
+                "the gram matrix is ill-conditioned (condition number "
+                f"{condition:.3g}), so the linear map may differ from the lstsq "
+                "solution of calc_linear_map"
+            )
+        tolerance = eigenvalues.shape[0] * t.finfo(self.dtype).eps * eigenvalues[-1]
+        inverse_eigenvalues = t.where(eigenvalues > tolerance, 1 / eigenvalues, 0.0)
+        X = (eigenvectors * inverse_eigenvalues) @ (eigenvectors.T @ self.src_tgt)
+        return X.T.float()
+
+
+def max_gram_condition(dtype: t.dtype) -> float:
+    """Returns the largest condition number of a Gram matrix AᵀA for which solving
+    the normal equations in dtype is still accurate to about 1e-6."""
+    return 1e-6 / t.finfo(dtype).eps
+
+
+def _padded_stack(
+    matrices: List[Tensor], padding: List[float]
+) -> Float[Tensor, "problem d_max d_max"]:
+    """Stacks square matrices, padding each with padding[i] times the identity."""
+    d_max = max(matrix.shape[-1] for matrix in matrices)
+    stacked = t.zeros(
+        len(matrices), d_max, d_max, dtype=matrices[0].dtype, device=matrices[0].device
+    )
+    for i, (matrix, pad) in enumerate(zip(matrices, padding)):
+        d_model = matrix.shape[-1]
+        stacked[i, :d_model, :d_model] = matrix
+        stacked[i, d_model:, d_model:].diagonal().fill_(pad)
+    return stacked
+
+
+def solve_orthogonal_procrustes_batched(
+    stats: List[EmbeddingStatistics], ensure_rotation: bool = False
+) -> List[Tuple[Float[Tensor, "d_model d_model"], Float[Tensor, ""]]]:
+    """Solves many orthogonal Procrustes problems with one batched SVD.
+
+    The cross-covariances are padded to a common size with c * identity, where c is
+    larger than any of the problem's singular values. The orthogonal polar factor of
+    the padded matrix is then the problem's rotation with the identity on the padding,
+    and the smallest singular value (flipped by ensure_rotation) is always one of the
+    problem's own.
+
+    Args:
+        stats: The statistics of each problem, on the same device.
+        ensure_rotation: If True, ensures the resulting matrices are proper rotations.
+
+    Returns:
+        The rotation matrix and scale of each problem, as orthogonal_procrustes.
+    """
+    for problem_stats in stats:
+        problem_stats._check_not_empty()
+    # the frobenius norm bounds the largest singular value
+    padding = [
+        float(t.linalg.matrix_norm(problem_stats.tgt_src)) + 1.0
+        for problem_stats in stats
+    ]
+    M = _padded_stack([problem_stats.tgt_src for problem_stats in stats], padding)
+    U, S, Vt = t.linalg.svd(M)
+    if ensure_rotation:
+        flip = t.det(t.matmul(U, Vt)) < 0.0
+        Vt[flip, -1, :] *= -1.0
+    R = t.matmul(U, Vt)
+    results = []
+    for i, (problem_stats, pad) in enumerate(zip(stats, padding)):
+        d_model = problem_stats.tgt_src.shape[-1]
+        scale = S[i].sum() - pad * (M.shape[-1] - d_model)
+        results.append((R[i, :d_model, :d_model].float(), scale.float()))
+    return results
+
+
+def solve_linear_map_batched(
+    stats: List[EmbeddingStatistics],
+) -> List[Float[Tensor, "d_model d_model"]]:
+    """Solves many least squares problems with one batched Cholesky factorisation.
+
+    The Gram matrices are padded to a common size with the identity (and AᵀB with
+    zeros), which leaves each problem's solution unchanged. Problems whose Gram matrix
+    is not positive definite, or whose condition number estimated from the Cholesky
+    factor exceeds max_gram_condition, fall back to linear_map, which truncates the
+    small eigenvalues and warns about the conditioning.
+
+    Args:
+        stats: The statistics of each problem, accumulated with gram=True and on the
+            same device.
+
+    Returns:
+        The linear map of each problem, as linear_map.
+    """
+    grams, src_tgts = [], []
+    for problem_stats in stats:
+        problem_stats._check_not_empty()
+        if problem_stats.src_src is None or problem_stats.src_tgt is None:
+            raise ValueError("linear_map needs statistics accumulated with gram=True.")
+        grams.append(problem_stats.src_src)
+        src_tgts.append(problem_stats.src_tgt)
+    gram = _padded_stack(grams, [1.0] * len(stats))
+    src_tgt = _padded_stack(src_tgts, [0.0] * len(stats))
+    L, info = t.linalg.cholesky_ex(gram)
+    X = t.cholesky_solve(src_tgt, L)
+    results = []
+    for i, problem_stats in enumerate(stats):
+        d_model = problem_stats.tgt_src.shape[-1]
+        # the squared ratio of the extreme diagonal entries of the Cholesky factor is
+        # a cheap lower bound on the condition number of the Gram matrix
+        L_diagonal = L[i, :d_model, :d_model].diagonal()
+        condition = (L_diagonal.max() / L_diagonal.min()) ** 2
+        if info[i] != 0 or condition > max_gram_condition(gram.dtype):
+            results.append(problem_stats.linear_map())
+        else:
+            results.append(X[i, :d_model, :d_model].T.float())
+    return results
+
+
+@instrumented()
 def initialize_manual_transform(
     transform_name: str,
     train_loader: DataLoader,
@@ -124,41 +370,43 @@ def initialize_manual_transform(
     """Initializes a ManualTransformModule.
 
     Initializes a ManualTransformModule with transformations derived analytically from
-    the training data.
+    the training data. The training data is streamed through EmbeddingStatistics, so it
+    never has to fit in memory at once.
 
     Args:
         transform_name: The name of the transformation to apply. Supported names
             include 'analytical_rotation', 'analytical_translation', etc.
         train_loader: DataLoader containing the training data used to
             calculate the transformation weights.
+        device: The device to compute the transformation on.
 
     Returns:
         A ManualTransformModule initialized with the specified transformation.
     """
     transformations = []
 
-    # Initialize placeholders for embeddings
-    train_src_embeds, train_tgt_embeds = [], []
-
-    # Extract embeddings from the train_loader
-    for src_embeds, tgt_embeds in train_loader:
-        src_embeds = src_embeds.to(device)
-        tgt_embeds = tgt_embeds.to(device)
-        train_src_embeds.append(src_embeds)
-        train_tgt_embeds.append(tgt_embeds)
+    if transform_name not in {
+        "analytical_translation",
+        "roma_analytical",
+        "roma_scale_analytical",
+        "analytical_rotation",
+        "analytical_rotation_and_reflection",
+        "analytical_linear_map",
+    }:
+        logger.error(f"Unknown transformation name: {transform_name}")
+        raise ValueError(f"Unknown transformation name: {transform_name}")
 
-    # Convert lists to tensors
-    train_src_embeds = t.cat(train_src_embeds, dim=0)
-    train_tgt_embeds = t.cat(train_tgt_embeds, dim=0)
+    stats = EmbeddingStatistics.from_loader(
+        train_loader,
+        gram=(transform_name == "analytical_linear_map"),
+        device=device,
+    )
 
     if transform_name == "analytical_translation":
-        translation_vector = calc_translation(train_src_embeds, train_tgt_embeds)
-        transformations.append(("add", translation_vector))
+        transformations.append(("add", stats.translation()))
 
     elif transform_name in {"roma_analytical", "roma_scale_analytical"}:
-        rotation_matrix, scale = calc_procrustes_roma(
-            train_src_embeds, train_tgt_embeds
-        )
+        rotation_matrix, scale = stats.procrustes_roma()
         transformations.append(("multiply", rotation_matrix))
         if transform_name == "roma_scale_analytical":
             transformations.append(("scale", scale))
@@ -167,21 +415,58 @@ def initialize_manual_transform(
         "analytical_rotation",
         "analytical_rotation_and_reflection",
     }:
-        rotation_matrix, scale = calc_orthogonal_procrustes(
-            train_src_embeds,
-            train_tgt_embeds,
+        rotation_matrix, scale = stats.orthogonal_procrustes(
             ensure_rotation=(transform_name == "analytical_rotation"),
         )
         transformations.append(("multiply", rotation_matrix))
 
     elif transform_name == "analytical_linear_map":
-        linear_map_matrix = calc_linear_map(train_src_embeds, train_tgt_embeds)
-        transformations.append(("multiply", linear_map_matrix))
-
-    else:
-        logger.error(f"Unknown transformation name: {transform_name}")
-        raise ValueError(f"Unknown transformation name: {transform_name}")
+        transformations.append(("multiply", stats.linear_map()))
 
     transform_module = ManualTransformModule(transformations)
 
     return transform_module
+
+
+def initialize_manual_transforms(
+    transform_name: str,
+    train_loaders: List[DataLoader],
+    device: Union[str, t.device] = default_device,
+) -> List[ManualTransformModule]:
+    """Initializes a ManualTransformModule for each of many training sets.
+
+    Rotations and linear maps are solved for all training sets at once with
+    solve_orthogonal_procrustes_batched and solve_linear_map_batched (the training sets
+    may have different d_model). Other transforms are solved one by one.
+
+    Args:
+        transform_name: The name of the transformation to apply, as for
+            initialize_manual_transform.
+        train_loaders: A DataLoader of the training data of each problem.
+        device: The device to compute the transformations on.
+
+    Returns:
+        A ManualTransformModule for each DataLoader, in order.
+    """
+    if transform_name in {"analytical_rotation", "analytical_rotation_and_reflection"}:
+        stats = [
+            EmbeddingStatistics.from_loader(loader, device=device)
+            for loader in train_loaders
+        ]
+        solutions = solve_orthogonal_procrustes_batched(
+            stats, ensure_rotation=(transform_name == "analytical_rotation")
+        )
+        return [ManualTransformModule([("multiply", R)]) for R, _ in solutions]
+    if transform_name == "analytical_linear_map":
+        stats = [
+            EmbeddingStatistics.from_loader(loader, gram=True, device=device)
+            for loader in train_loaders
+        ]
+        return [
+            ManualTransformModule([("multiply", X)])
+            for X in solve_linear_map_batched(stats)
+        ]
+    return [
+        initialize_manual_transform(transform_name, loader, device)
+        for loader in train_loaders
+    ]
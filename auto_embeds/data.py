@@ -1,25 +1,48 @@
 # Mapping of dataset names to their file locations
+import bisect
 import json
+import math
+import os
+import pickle
 import random
+from collections import Counter
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict, List, Literal, Optional, Tuple, TypeAlias, Union, overload
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Literal,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Tuple,
+    TypeAlias,
+    Union,
+    overload,
+)
 
 import numpy as np
 import torch as t
-import transformer_lens as tl
-from einops import repeat
 from Levenshtein import distance as levenshtein_distance
 from torch import Tensor
 from torch.utils.data import DataLoader, TensorDataset
 from transformers import PreTrainedTokenizerBase
 from word2word import Word2word
 
-from auto_embeds.utils.cache import auto_embeds_cache
+from auto_embeds.utils.cache import (
+    FingerprintedList,
+    auto_embeds_cache,
+    cachedir,
+    file_fingerprint,
+)
+from auto_embeds.utils.instrument import instrumented
 from auto_embeds.utils.misc import (
     default_device,
     repo_path_to_abs_path,
 )
+from auto_embeds.weight_store import WeightStore, extract_weights
 
 
 @dataclass(frozen=True)
@@ -154,6 +177,87 @@ def get_dataset_path(name: str) -> Path:
     return DATASETS[name]
 
 
+def load_word_pairs(path: Union[str, Path]) -> FingerprintedList:
+    """Loads a JSON file of word pairs.
+
+    The returned list carries the hash of the file as its cache fingerprint, so passing
+    it to cached functions such as filter_word_pairs does not hash its contents.
+
+    Args:
+        path: The path to the JSON file of word pairs.
+
+    Returns:
+        The word pairs, as a FingerprintedList.
+    """
+    with open(path, "r", encoding="utf-8") as file:
+        word_pairs = json.load(file)
+    return FingerprintedList(word_pairs, f"file:{file_fingerprint(path)}")
+
+
+class AzureTranslations(NamedTuple):
+    """The acceptable translations from an Azure Translator validation file.
+
+    Attributes:
+        translations_dict: Maps each normalizedSource to its non-null
+            normalizedTargets, as used by mark_translation. It is shared by every
+            caller of load_azure_translations, so it must not be mutated.
+    """
+
+    translations_dict: Dict[str, List[str]]
+
+
+# maps (path, mtime, size) of azure validation files to their parsed translations
+_azure_translations: Dict[Tuple[str, int, int], AzureTranslations] = {}
+
+
+def load_azure_translations(path: Union[str, Path]) -> AzureTranslations:
+    """Loads the acceptable translations from an Azure Translator validation file.
+
+    The parsed translations are memoized in-process (keyed by the file's path,
+    modification time and size) and persisted as a pickle under AUTOEMBEDS_CACHE_DIR
+    (keyed by the sha1 of the file's contents), so each file is only parsed from JSON
+    once across runs and processes. The same AzureTranslations is returned to every
+    caller, so its translations_dict must not be mutated.
+
+    Args:
+        path: The path to the Azure Translator validation JSON file.
+
+    Returns:
+        An AzureTranslations with the translations dictionary.
+    """
+    path = Path(path).resolve()
+    stat = path.stat()
+    key = (str(path), stat.st_mtime_ns, stat.st_size)
+    if key in _azure_translations:
+        return _azure_translations[key]
+
+    # v2 pickles no longer hold the index of the first version
+    pickle_path = (
+        Path(cachedir) / "azure_translations" / f"{file_fingerprint(path)}.v2.pkl"
+    )
+    if pickle_path.exists():
+        with open(pickle_path, "rb") as file:
+            azure_translations = pickle.load(file)
+    else:
+        translations_dict = {
+            item["normalizedSource"]: [
+                trans["normalizedTarget"]
+                for trans in item["translations"]
+                if trans["normalizedTarget"] is not None
+            ]
+            for item in json.loads(path.read_text(encoding="utf-8"))
+        }
+        azure_translations = AzureTranslations(translations_dict)
+        pickle_path.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first so concurrent runs never read a partial file
+        tmp_path = pickle_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as file:
+            pickle.dump(azure_translations, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, pickle_path)
+    _azure_translations[key] = azure_translations
+    return azure_translations
+
+
 def generate_tokens(
     tokenizer: PreTrainedTokenizerBase,
     n_toks: int,
@@ -198,7 +302,132 @@ def generate_tokens(
     return t.tensor(en_toks, device=device), t.tensor(fr_toks, device=device)
 
 
+def _deduplicate_similar_words(
+    words: List[str],
+    id_sums: List[int],
+    acceptable_overlap: float,
+    q: int = 2,
+) -> List[int]:
+    """Greedily merges similar words, keeping the one with the lowest token id sum.
+
+    Words are visited in order. Each unmerged word is compared against every later
+    unmerged word, and a later word whose similarity ratio with it,
+    1 - levenshtein_distance / max_length, is at least acceptable_overlap and whose id
+    sum is lower than the best so far replaces the best so far and is merged away. The
+    best word is kept. This gives the same result as comparing every pair but avoids
+    most of the comparisons:
+
+    - A ratio threshold bounds the distance to k = (1 - acceptable_overlap) * max_length
+      so only words whose lengths differ by at most k can be similar.
+    - Two words within distance k share at least t = max_length + q - 1 - k * q of
+      their padded q-grams, so they must share one of the rarest len(q-grams) - t + 1
+      q-grams of each word (prefix filtering). Only these prefixes are indexed and
+      only words sharing a prefix q-gram are compared.
+    - The distance of the remaining candidates is computed with a cutoff of k.
+
+    For the short, mostly dissimilar words of a dictionary this takes roughly
+    O(n * (L + c)) time, for n words of length L with c candidates each, instead of
+    O(n^2) distance computations. It degrades back to O(n^2) when most words are
+    within the threshold of each other (e.g. very low acceptable_overlap).
+
+    Args:
+        words: The words to deduplicate.
+        id_sums: The token id sum of each word.
+        acceptable_overlap: The similarity ratio at or above which words are merged.
+        q: The length of the q-grams used for the prefix filter.
+
+    Returns:
+        The indices of the kept words, in the order they were kept.
+    """
+
+    def max_distance(max_length: int) -> int:
+        # the slack only guards against rounding, the exact ratio is checked below
+        return math.floor((1 - acceptable_overlap) * max_length + 1e-9)
+
+    def min_common_grams(length: int, other_length: int) -> Optional[int]:
+        # None if words of these lengths can never be similar
+        max_length = max(length, other_length)
+        k = max_distance(max_length)
+        if abs(length - other_length) > k:
+            return None
+        return max_length + q - 1 - k * q
+
+    words_by_length: Dict[int, List[int]] = {}
+    for i, word in enumerate(words):
+        words_by_length.setdefault(len(word), []).append(i)
+    # the valid lengths of the words each word can be similar to, with the minimum
+    # number of q-grams they must share
+    length_bounds: Dict[int, Dict[int, int]] = {}
+    for length in words_by_length:
+        length_bounds[length] = {}
+        for other_length in words_by_length:
+            min_common = min_common_grams(length, other_length)
+            if min_common is not None:
+                length_bounds[length][other_length] = min_common
+
+    # q-grams are numbered by occurrence so that multisets become sets
+    padding = "\0" * (q - 1)
+    word_grams = []
+    for word in words:
+        padded = padding + word + padding
+        seen: Dict[str, int] = {}
+        grams = []
+        for j in range(len(padded) - q + 1):
+            gram = padded[j : j + q]
+            seen[gram] = seen.get(gram, 0) + 1
+            grams.append((gram, seen[gram]))
+        word_grams.append(grams)
+    gram_frequencies = Counter(gram for grams in word_grams for gram in grams)
+
+    # maps q-grams to the (sorted) indices of the words with it in their prefix
+    prefix_index: Dict[Tuple[str, int], List[int]] = {}
+    word_prefixes = []
+    for i, grams in enumerate(word_grams):
+        min_common = min(length_bounds[len(words[i])].values(), default=None)
+        if min_common is None:
+            prefix = []
+        elif min_common <= 0:
+            prefix = grams
+        else:
+            prefix = sorted(grams, key=lambda gram: (gram_frequencies[gram], gram))
+            prefix = prefix[: len(grams) - min_common + 1]
+        word_prefixes.append(prefix)
+        for gram in prefix:
+            prefix_index.setdefault(gram, []).append(i)
+
+    alive = [True] * len(words)
+    kept = []
+    for i, word in enumerate(words):
+        if not alive[i]:
+            continue
+        alive[i] = False
+        bounds = length_bounds[len(word)]
+        candidates = set()
+        for length, min_common in bounds.items():
+            if min_common <= 0:
+                candidates.update(words_by_length[length])
+        for gram in word_prefixes[i]:
+            indices = prefix_index[gram]
+            candidates.update(indices[bisect.bisect_right(indices, i) :])
+
+        best, best_id_sum = i, id_sums[i]
+        for j in sorted(candidates):
+            if j <= i or not alive[j] or id_sums[j] >= best_id_sum:
+                continue
+            if len(words[j]) not in bounds:
+                continue
+            max_length = max(len(word), len(words[j]))
+            k = max_distance(max_length)
+            distance = levenshtein_distance(word, words[j], score_cutoff=k)
+            if distance <= k and 1 - distance / max_length >= acceptable_overlap:
+                best, best_id_sum = j, id_sums[j]
+                alive[j] = False
+        kept.append(best)
+    return kept
+
+
 @auto_embeds_cache
+@instrumented()
 def filter_word_pairs(
     tokenizer: PreTrainedTokenizerBase,
     word_pairs: List[List[str]],
@@ -237,11 +466,15 @@ def filter_word_pairs(
             aggregate token ID in cases of multiple translations for English.
         most_common_french: When true, prefers the translation pair with the lowest
             aggregate token ID in cases of multiple translations for French.
-        acceptable_overlap: The maximum acceptable similarity between word pairs before
-            they are merged by taking the one with the lowest aggregate token ID. Can
-            be used with most_common_english and most_common_french for performance
-            reasons as the metric used, the Levenshtein distance can be quite slow to
-            compute so it is good to filter out words that are identical first.
+        acceptable_english_overlap: The maximum acceptable similarity between the
+            English words of pairs before they are merged by taking the one with the
+            lowest aggregate token ID. The similarity is 1 - the Levenshtein distance
+            divided by the length of the longer word. Candidates are found with a
+            length and q-gram index (see _deduplicate_similar_words), so this scales
+            roughly linearly in the number of pairs for typical thresholds, but it can
+            still be worth using most_common_english first to drop identical words.
+        acceptable_french_overlap: As acceptable_english_overlap, but for the French
+            words.
 
     Returns:
         A list of filtered word pairs that tokenize into single tokens.
@@ -393,70 +626,24 @@ def filter_word_pairs(
             print(f"After most_common_french: {len(pairs_to_filter)}")
 
     if acceptable_english_overlap != 1.0:
-        filtered_pairs = []
-        while pairs_to_filter:
-            current_pair = pairs_to_filter.pop(0)
-            (
-                current_id_sum,
-                current_en_token,
-                current_fr_token,
-                current_words,
-            ) = current_pair
-            current_en_word, _ = current_words
-            most_similar_pair = current_pair
-            most_similar_id_sum = current_id_sum
-
-            for other_pair in pairs_to_filter[:]:
-                other_id_sum, _, _, other_words = other_pair
-                other_en_word, _ = other_words
-                en_similarity_ratio = 1 - levenshtein_distance(
-                    current_en_word, other_en_word
-                ) / max(len(current_en_word), len(other_en_word))
-                if (
-                    en_similarity_ratio >= acceptable_english_overlap
-                    and other_id_sum < most_similar_id_sum
-                ):
-                    most_similar_pair = other_pair
-                    most_similar_id_sum = other_id_sum
-                    pairs_to_filter.remove(other_pair)
-            filtered_pairs.append(most_similar_pair)
+        kept = _deduplicate_similar_words(
+            [words[0] for _, _, _, words in pairs_to_filter],
+            [id_sum for id_sum, _, _, _ in pairs_to_filter],
+            acceptable_english_overlap,
+        )
+        pairs_to_filter = [pairs_to_filter[i] for i in kept]
         if verbose_count:
-            print(f"After acceptable_english_overlap: {len(filtered_pairs)}")
-
-        pairs_to_filter = filtered_pairs
+            print(f"After acceptable_english_overlap: {len(pairs_to_filter)}")
 
     if acceptable_french_overlap != 1.0:
-        filtered_pairs = []
-        while pairs_to_filter:
-            current_pair = pairs_to_filter.pop(0)
-            (
-                current_id_sum,
-                current_en_token,
-                current_fr_token,
-                current_words,
-            ) = current_pair
-            _, current_fr_word = current_words
-            most_similar_pair = current_pair
-            most_similar_id_sum = current_id_sum
-
-            for other_pair in pairs_to_filter[:]:
-                other_id_sum, _, _, other_words = other_pair
-                _, other_fr_word = other_words
-                fr_similarity_ratio = 1 - levenshtein_distance(
-                    current_fr_word, other_fr_word
-                ) / max(len(current_fr_word), len(other_fr_word))
-                if (
-                    fr_similarity_ratio >= acceptable_french_overlap
-                    and other_id_sum < most_similar_id_sum
-                ):
-                    most_similar_pair = other_pair
-                    most_similar_id_sum = other_id_sum
-                    pairs_to_filter.remove(other_pair)
-            filtered_pairs.append(most_similar_pair)
+        kept = _deduplicate_similar_words(
+            [words[1] for _, _, _, words in pairs_to_filter],
+            [id_sum for id_sum, _, _, _ in pairs_to_filter],
+            acceptable_french_overlap,
+        )
+        pairs_to_filter = [pairs_to_filter[i] for i in kept]
         if verbose_count:
-            print(f"After acceptable_french_overlap: {len(filtered_pairs)}")
-
-        pairs_to_filter = filtered_pairs
+            print(f"After acceptable_french_overlap: {len(pairs_to_filter)}")
 
     # extracting just the word pairs out again (discarding id_sum and token_ids)
     filtered_pairs = [
@@ -513,6 +700,70 @@ def tokenize_word_pairs(
     return en_tokens, fr_tokens, en_mask, fr_mask
 
 
+class FastTensorLoader(DataLoader):
+    """A DataLoader over in-memory tensors that batches by slicing.
+
+    A DataLoader over a TensorDataset fetches every item through __getitem__ and
+    collates the items in Python. As our datasets are small tensors that already live
+    on the device, this loader instead yields contiguous slices of the tensors (views,
+    so no copy at all) or, when shuffling, a single index_select per tensor using a
+    permutation drawn on the tensors' device every epoch. It is a DataLoader subclass
+    with the same (src, tgt) tuple batches, so it can be used anywhere a DataLoader of
+    the dataset is expected, e.g. train_transform and the metrics.
+
+    Args:
+        dataset: The TensorDataset whose tensors are batched.
+        batch_size: The number of items per batch.
+        shuffle: Whether to draw a new random order of the items every epoch.
+        generator: Optional; the generator the permutations are drawn from, which must
+            be on the device of the tensors. Defaults to the global RNG of that device.
+        drop_last: Whether to drop the last batch if it is smaller than batch_size.
+    """
+
+    def __init__(
+        self,
+        dataset: TensorDataset,
+        batch_size: int = 1,
+        shuffle: bool = False,
+        generator: Optional[t.Generator] = None,
+        drop_last: bool = False,
+    ):
+        super().__init__(
+            dataset, batch_size=batch_size, drop_last=drop_last, generator=generator
+        )
+        self.shuffle = shuffle
+
+    def __len__(self) -> int:
+        n_items = len(self.dataset)  # type: ignore
+        if self.drop_last:
+            return n_items // self.batch_size  # type: ignore
+        return math.ceil(n_items / self.batch_size)  # type: ignore
+
+    def batch_indices(self) -> Iterator[Union[slice, Tensor]]:
+        """Yields the indices of each batch of an epoch, as slices or index tensors."""
+        n_items = len(self.dataset)  # type: ignore
+        batch_size: int = self.batch_size  # type: ignore
+        if self.shuffle:
+            permutation = t.randperm(
+                n_items,
+                generator=self.generator,
+                device=self.dataset.tensors[0].device,  # type: ignore
+            )
+        for start in range(0, n_items, batch_size):
+            end = min(start + batch_size, n_items)
+            if self.drop_last and end - start < batch_size:
+                break
+            yield permutation[start:end] if self.shuffle else slice(start, end)
+
+    def __iter__(self) -> Iterator[Tuple[Tensor, ...]]:  # type: ignore
+        tensors = self.dataset.tensors  # type: ignore
+        for indices in self.batch_indices():
+            if isinstance(indices, slice):
+                yield tuple(tensor[indices] for tensor in tensors)
+            else:
+                yield tuple(tensor.index_select(0, indices) for tensor in tensors)
+
+
 TwoDataLoaders: TypeAlias = Tuple[DataLoader, DataLoader]
 TwoTensors: TypeAlias = Tuple[Tensor, Tensor]
 FourTensors: TypeAlias = Tuple[Tensor, Tensor, Tensor, Tensor]
@@ -698,10 +949,10 @@ def prepare_data(
         test_dataset = TensorDataset(test_en_embeds, test_fr_embeds)
 
         if return_type == "dataloader":
-            train_loader = DataLoader(
+            train_loader = FastTensorLoader(
                 train_dataset, batch_size=batch_size, shuffle=shuffle_dataloader
             )
-            test_loader = DataLoader(
+            test_loader = FastTensorLoader(
                 test_dataset, batch_size=batch_size, shuffle=shuffle_dataloader
             )
             return train_loader, test_loader
@@ -716,7 +967,7 @@ def prepare_data(
         dataset = TensorDataset(en_embeds, fr_embeds)
 
         if return_type == "dataloader":
-            loader = DataLoader(
+            loader = FastTensorLoader(
                 dataset, batch_size=batch_size, shuffle=shuffle_dataloader
             )
             return loader
@@ -747,6 +998,7 @@ def print_most_similar_embeddings_dict(
             )
 
 
+@t.no_grad()
 def get_most_similar_embeddings(
     tokenizer: PreTrainedTokenizerBase,
     out: t.Tensor,
@@ -754,57 +1006,73 @@ def get_most_similar_embeddings(
     top_k: int = 10,
     print_results: bool = False,
 ) -> Dict[int, Any]:
-    results = {}
+    """Finds the most likely tokens for each row of a batch of logits.
+
+    Only the top_k logits of each row are selected and decoded, with probabilities
+    computed from the logsumexp of the row rather than a full softmax and sort over
+    the vocabulary.
+
+    Args:
+        tokenizer: The tokenizer used to decode the token ids.
+        out: Logits of shape [d_vocab], [batch, d_vocab] or [batch, 1, d_vocab].
+        answer: Optional; the expected word for each row of the batch. Each word is
+            ranked against the full vocabulary using its first token.
+        top_k: The number of most likely tokens to return per row.
+        print_results: Whether to print the results for each row.
+
+    Returns:
+        A dictionary mapping each batch index to a dictionary with the "top_tokens"
+        and, if answer is given, the "answer_rank" of that row.
+    """
     # Adjust tensor dimensions if needed
     out = out.unsqueeze(0).unsqueeze(0) if out.ndim == 1 else out
     # Reshape the output tensor
     logits = out.squeeze(1)
-    # Convert logits to probabilities
-    probs = logits.softmax(dim=-1)
+    log_norm = logits.logsumexp(dim=-1, keepdim=True)
+    top_logits, top_ids = logits.topk(top_k, dim=-1)
+    top_probs = (top_logits - log_norm).exp()
 
-    sorted_token_probs, sorted_token_values = probs.sort(descending=True)
+    # Move everything to the cpu in one go and decode all tokens in a single batch
+    top_logits_list = top_logits.tolist()
+    top_probs_list = top_probs.tolist()
+    top_ids_list = top_ids.tolist()
+    top_strs = tokenizer.batch_decode([[i] for row in top_ids_list for i in row])
 
     if answer is not None:
-        answer_token = tokenizer.encode(answer, add_special_tokens=False)
-        answer_str_token = tokenizer.decode(answer_token)
-        correct_rank = repeat(
-            t.arange(sorted_token_values.shape[-1]),
-            "d_vocab -> batch d_vocab",
-            batch=sorted_token_values.shape[0],
-        )[(sorted_token_values == answer_token).cpu()]
+        answer_ids = t.tensor(
+            [tokenizer.encode(word, add_special_tokens=False)[0] for word in answer],
+            device=logits.device,
+        )
+        answer_logits = logits.gather(-1, answer_ids.unsqueeze(-1))
+        # the rank of a token is the number of tokens with a strictly higher logit
+        answer_ranks = (logits > answer_logits).sum(dim=-1).tolist()
+        answer_probs = (answer_logits - log_norm).exp().squeeze(-1).tolist()
+        answer_logits_list = answer_logits.squeeze(-1).tolist()
+        answer_strs = tokenizer.batch_decode([[i] for i in answer_ids.tolist()])
 
     results = {}
     # This loop compiles a results dictionary per batch, including rankings of correct
     # answers (if any) and the top-k predicted tokens.
-    for batch_idx in range(sorted_token_values.shape[0]):
-        # Initialize a dictionary to hold results for the current batch.
+    for batch_idx in range(logits.shape[0]):
         word_results = {}
-        # If an answer is provided, calculate its rank and related information.
         if answer is not None:
-            # Collect rankings for each answer token.
-            answer_ranks = [
+            word_results["answer_rank"] = [
                 {
-                    "token": token,
-                    "rank": correct_rank[idx].item(),  # type: ignore
-                    "logit": logits[idx, answer_token[idx]].item(),  # type: ignore
-                    "prob": probs[idx, answer_token[idx]].item(),  # type: ignore
+                    "token": answer_strs[batch_idx],
+                    "rank": answer_ranks[batch_idx],
+                    "logit": answer_logits_list[batch_idx],
+                    "prob": answer_probs[batch_idx],
                 }
-                for idx, token in enumerate(answer_str_token)  # type: ignore
             ]
-            # Store the collected answer ranks in the results dictionary.
-            word_results["answer_rank"] = answer_ranks
-        # Identify and store the top-k tokens based on their probabilities.
-        top_tokens = [
+        word_results["top_tokens"] = [
             {
                 "rank": i,
-                "logit": logits[batch_idx, sorted_token_values[batch_idx, i]].item(),
-                "prob": sorted_token_probs[batch_idx, i].item(),
-                "token": tokenizer.decode([sorted_token_values[batch_idx, i]]),
+                "logit": top_logits_list[batch_idx][i],
+                "prob": top_probs_list[batch_idx][i],
+                "token": top_strs[batch_idx * top_k + i],
             }
             for i in range(top_k)
         ]
-        word_results["top_tokens"] = top_tokens
-        # Assign results for the current batch to the main results dictionary.
         results[batch_idx] = word_results
     # Optionally print the results for each batch.
     if print_results:
@@ -814,13 +1082,13 @@ def get_most_similar_embeddings(
     return results
 
 
-@auto_embeds_cache
+@instrumented()
 @t.no_grad()
 def get_cached_weights(
     model_name: str,
     processing: bool = False,
     device: Union[str, t.device] = default_device,
-) -> Dict[str, t.Tensor]:
+) -> Mapping[str, Optional[t.Tensor]]:
     """Fetches and caches model weights for a specified transformer model.
 
     This function retrieves the weights of a transformer model, either with or without
@@ -829,12 +1097,19 @@ def get_cached_weights(
     weights such as W_E, embed.ln.w, embed.ln.b (if applicable), ln_final.w, ln_final.b,
     W_U, and b_U.
 
+    The weights are extracted once (straight from the safetensors checkpoint when
+    processing is False, see extract_weights) and stored as one .npy file per weight
+    under AUTOEMBEDS_CACHE_DIR/weights. They are returned as a lazy WeightStore that
+    memory-maps each weight on first access, so cache hits do not unpickle anything and
+    worker processes share the pages of the files.
+
     Args:
         model_name: The name of the transformer model to load.
         processing: Whether to load the model with processing. Defaults to False.
+        device: The device to load the weights to.
 
     Returns:
-        A dictionary containing the model weights as tensors, including:
+        A mapping from names to the model weights as tensors, including:
             - W_E: Embedding weights.
             - embed.ln.w: Embedding layer normalization weights (if applicable).
             - embed.ln.b: Embedding layer normalization biases (if applicable).
@@ -846,35 +1121,12 @@ def get_cached_weights(
     Raises:
         ValueError: If the model name is not supported.
     """
-    if processing:
-        model = tl.HookedTransformer.from_pretrained(model_name)
-    else:
-        model = tl.HookedTransformer.from_pretrained_no_processing(model_name)
-    if "bloom" in model_name:
-        model_weights = {
-            "W_E": model.W_E.detach().clone(),
-            "embed.ln.w": (model.embed.ln.w.detach().clone()),
-            "embed.ln.b": (model.embed.ln.b.detach().clone()),
-            "ln_final.w": model.ln_final.w.detach().clone(),
-            "ln_final.b": model.ln_final.b.detach().clone(),
-            "W_U": model.W_U.detach().clone(),
-            "b_U": model.b_U.detach().clone(),
-        }
-    elif "gpt" in model_name:
-        model_weights = {
-            "W_E": model.W_E.detach().clone(),
-            "embed.ln.w": None,
-            "embed.ln.b": None,
-            "ln_final.w": model.ln_final.w.detach().clone(),
-            "ln_final.b": model.ln_final.b.detach().clone(),
-            "W_U": model.W_U.detach().clone(),
-            "b_U": model.b_U.detach().clone(),
-        }
-    else:
-        raise ValueError(f"Unsupported model: {model_name}")
-    del model
-    model_weights = {
-        k: v.to(device) if isinstance(v, t.Tensor) else v
-        for k, v in model_weights.items()
-    }
-    return model_weights
+    store_dir = (
+        Path(cachedir)
+        / "weights"
+        / model_name.replace("/", "--")
+        / ("processing" if processing else "no_processing")
+    )
+    if not WeightStore.exists(store_dir):
+        WeightStore.save(store_dir, extract_weights(model_name, processing))
+    return WeightStore(store_dir, device)
@@ -1,15 +1,28 @@
-import json
+from itertools import groupby
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Literal,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 import plotly.express as px
 import torch as t
 import torch.nn as nn
 from torch import Tensor
+from torch.func import vmap
 from torch.optim import Optimizer
+from torch.optim.adam import adam
 from torch.utils.data import DataLoader
 from transformers import PreTrainedTokenizerBase
 
+from auto_embeds.data import load_azure_translations
 from auto_embeds.metrics import calc_loss, mark_translation
 from auto_embeds.modules import (
     BiasedRotationTransform,
@@ -17,21 +30,54 @@ from auto_embeds.modules import (
     IdentityTransform,
     LinearTransform,
     RotationTransform,
+    TransformEnsemble,
     TranslationTransform,
     UncenteredLinearMapTransform,
     UncenteredRotationTransform,
     Unembed,
 )
 from auto_embeds.utils.custom_tqdm import tqdm
+from auto_embeds.utils.instrument import instrumented
+from auto_embeds.utils.logging import logger
 from auto_embeds.utils.misc import default_device
 
 
+def initialize_optim(
+    params: Iterable[nn.Parameter],
+    optim_name: Literal["adam", "lbfgs"] = "adam",
+    optim_kwargs: Dict[str, Any] = {},
+) -> Optimizer:
+    """Initializes an optimizer for the parameters of a transformation.
+
+    Args:
+        params: The parameters to optimize.
+        optim_name: The optimizer to use. 'adam' for Adam, 'lbfgs' for L-BFGS with a
+            strong Wolfe line search, which suits full-batch training of the small
+            (linear) transformations, see train_transform.
+        optim_kwargs: Dict containing kwargs for optimizer initialization.
+
+    Returns:
+        The optimizer.
+    """
+    if optim_name == "adam":
+        return t.optim.Adam(params, **optim_kwargs)
+    elif optim_name == "lbfgs":
+        # L-BFGS has no weight decay, so it is dropped from the (shared) run config
+        lbfgs_kwargs = {
+            "line_search_fn": "strong_wolfe",
+            **{k: v for k, v in optim_kwargs.items() if k != "weight_decay"},
+        }
+        return t.optim.LBFGS(params, **lbfgs_kwargs)
+    raise ValueError(f"Unsupported optimizer: {optim_name}")
+
+
 def initialize_transform_and_optim(
     d_model: int,
     transformation: str,
     transform_kwargs: Dict[str, Any] = {},
     optim_kwargs: Dict[str, Any] = {},
     device: Union[str, t.device] = default_device,
+    optim_name: Literal["adam", "lbfgs"] = "adam",
 ) -> Tuple[nn.Module, Optional[Optimizer]]:
     """Initializes a transformation and its optimizer.
 
@@ -50,6 +96,7 @@ def initialize_transform_and_optim(
         optim_kwargs: Dict containing kwargs for optimizer initialization.
         device: The device on which to allocate tensors. If None, defaults to
             default_device.
+        optim_name: The optimizer to use, see initialize_optim.
 
     Returns:
         A tuple containing the transformation module and its optimizer.
@@ -62,35 +109,35 @@ def initialize_transform_and_optim(
 
     elif transformation == "translation":
         transform = TranslationTransform(d_model, **transform_kwargs)
-        optim = t.optim.Adam([transform.translation], **optim_kwargs)
+        optim = initialize_optim([transform.translation], optim_name, optim_kwargs)
 
     elif transformation == "linear_map":
         transform = LinearTransform(d_model, bias=False, **transform_kwargs)
-        optim = t.optim.Adam(transform.parameters(), **optim_kwargs)
+        optim = initialize_optim(transform.parameters(), optim_name, optim_kwargs)
 
     elif transformation == "biased_linear_map":
         transform = LinearTransform(d_model, bias=True, **transform_kwargs)
-        optim = t.optim.Adam(transform.parameters(), **optim_kwargs)
+        optim = initialize_optim(transform.parameters(), optim_name, optim_kwargs)
 
     elif transformation == "uncentered_linear_map":
         transform = UncenteredLinearMapTransform(d_model, **transform_kwargs)
-        optim = t.optim.Adam(list(transform.parameters()), **optim_kwargs)
+        optim = initialize_optim(transform.parameters(), optim_name, optim_kwargs)
 
     elif transformation == "biased_uncentered_linear_map":
         transform = UncenteredLinearMapTransform(d_model, bias=True, **transform_kwargs)
-        optim = t.optim.Adam(list(transform.parameters()), **optim_kwargs)
+        optim = initialize_optim(transform.parameters(), optim_name, optim_kwargs)
 
     elif transformation == "rotation":
         transform = RotationTransform(d_model, **transform_kwargs)
-        optim = t.optim.Adam(list(transform.parameters()), **optim_kwargs)
+        optim = initialize_optim(transform.parameters(), optim_name, optim_kwargs)
 
     elif transformation == "biased_rotation":
         transform = BiasedRotationTransform(d_model, **transform_kwargs)
-        optim = t.optim.Adam(list(transform.parameters()), **optim_kwargs)
+        optim = initialize_optim(transform.parameters(), optim_name, optim_kwargs)
 
     elif transformation == "uncentered_rotation":
         transform = UncenteredRotationTransform(d_model, **transform_kwargs)
-        optim = t.optim.Adam(list(transform.parameters()), **optim_kwargs)
+        optim = initialize_optim(transform.parameters(), optim_name, optim_kwargs)
     else:
         raise Exception(f"the supplied transform '{transformation}' was unrecognized")
     return transform, optim
@@ -204,6 +251,7 @@ def initialize_embed_and_unembed(
     return embed_module, unembed_module
 
 
+@instrumented()
 def train_transform(
     tokenizer: PreTrainedTokenizerBase,
     train_loader: DataLoader[Tuple[Tensor, ...]],
@@ -218,11 +266,26 @@ def train_transform(
     device: Union[str, t.device] = default_device,
     neptune_run: Optional[Any] = None,
     azure_translations_path: Optional[Union[str, Path]] = None,
+    full_batch: bool = False,
+    tol: Optional[float] = None,
+    patience: int = 1,
+    log_every: Optional[int] = None,
 ) -> Tuple[nn.Module, Dict[str, List[Dict[str, Union[float, int]]]]]:
     """Trains the transformation.
 
     Trains the transformation, returning the learned transformation and loss history.
 
+    The training sets are only a few thousand embeddings, so with full_batch the whole
+    training set is concatenated once and every epoch is a single optimizer step on it.
+    This pairs well with an L-BFGS optimizer (see initialize_optim), which is driven
+    through a closure re-evaluating the loss as its line search needs. With a tol,
+    training stops early once the mean train loss of an epoch has improved by less
+    than tol (relative to the previous epoch) for patience epochs in a row.
+
+    The train loss of every step is kept on the device and only copied to the
+    history (and Neptune) every log_every steps and at the end of every epoch, so the
+    steps are not serialised by waiting for the device to report each loss.
+
     Args:
         tokenizer: The tokenizer used for tokenization.
         train_loader: DataLoader for the training dataset.
@@ -235,46 +298,99 @@ def train_transform(
         device: The device on which the model is allocated.
         neptune: If provided, log training metrics to Neptune.
         azure_translations_path: Path to JSON file for mark_translation evaluation.
+        full_batch: If True, trains on the whole training set in a single batch.
+        tol: Optional; the relative improvement of the epoch train loss below which
+            training is considered converged. If None, trains for all n_epochs.
+        patience: The number of consecutive converged epochs after which to stop.
+        log_every: Optional; the number of steps after which the buffered train
+            losses are logged. Defaults to logging them at the end of every epoch.
 
     Returns:
         The learned transformation after training, the train and test loss history.
     """
     train_history = {"train_loss": [], "test_loss": [], "mark_translation_score": []}
     transform.train()
-    # if a azure_translations_path is provided we process the azure json file into a
-    # more accessible format just once to speed up the marking, passing a
-    # translations_dict directly into mark_translate()
+    # if a azure_translations_path is provided we load the (cached) translations_dict
+    # just once to speed up the marking, passing it directly into mark_translation()
     if azure_translations_path:
-        with open(azure_translations_path, "r", encoding="utf-8") as file:
-            allowed_translations = json.load(file)
-        translations_dict = {}
-        for item in allowed_translations:
-            source = item["normalizedSource"]
-            translations = [
-                trans["normalizedTarget"]
-                for trans in item["translations"]
-                if trans["normalizedTarget"] is not None
-            ]
-            translations_dict[source] = translations
+        translations_dict = load_azure_translations(
+            azure_translations_path
+        ).translations_dict
+    if full_batch:
+        # the order of the batches does not matter as they are concatenated
+        train_batches = [tuple(t.cat(tensors) for tensors in zip(*train_loader))]
+    else:
+        train_batches = train_loader
+    use_closure = isinstance(optim, t.optim.LBFGS)
+    # the train losses are written to a device buffer and only copied to the host
+    # (which waits for the device) when the buffer is flushed
+    buffer_size = log_every if log_every is not None else len(train_batches)
+    loss_buffer: Optional[Tensor] = None
+    n_buffered = 0
+    prev_epoch_loss = None
+    converged_epochs = 0
     step_count = 0
+
+    def flush_losses(epoch: int) -> None:
+        nonlocal n_buffered
+        if n_buffered == 0:
+            return
+        assert loss_buffer is not None
+        losses = loss_buffer[:n_buffered].tolist()
+        steps = list(range(step_count - n_buffered + 1, step_count + 1))
+        train_history["train_loss"].extend(
+            {"train_loss": loss, "epoch": epoch} for loss in losses
+        )
+        if neptune_run:
+            # one extend call for the whole buffer rather than an append per step
+            neptune_run["train"].extend(
+                {"train_loss": losses, "epoch": [epoch] * len(losses)}, steps=steps
+            )
+        epoch_pbar.set_description(f"train loss: {losses[-1]:.3f}")
+        n_buffered = 0
+
     for epoch in (epoch_pbar := tqdm(range(n_epochs + 1))):
-        for en_embed, fr_embed in train_loader:
-            optim.zero_grad()
-            pred = transform(en_embed)
-            train_loss = loss_module(pred.squeeze(), fr_embed.squeeze())
-            info_dict = {
-                "train_loss": train_loss.item(),
-                "epoch": epoch,
-            }
+        epoch_loss_sum: Union[Tensor, float] = 0.0
+        n_epoch_steps = 0
+        for en_embed, fr_embed in train_batches:
+
+            def closure() -> Tensor:
+                optim.zero_grad()
+                pred = transform(en_embed)
+                loss = loss_module(pred.squeeze(), fr_embed.squeeze())
+                loss.backward()
+                return loss
+
+            if use_closure:
+                # the loss before the step, as for the other optimizers
+                train_loss = optim.step(closure)
+            else:
+                train_loss = closure()
+                optim.step()
+            train_loss = train_loss.detach()
+            if loss_buffer is None:
+                loss_buffer = t.empty(buffer_size, device=train_loss.device)
+            loss_buffer[n_buffered] = train_loss
+            epoch_loss_sum = epoch_loss_sum + train_loss
+            n_buffered += 1
+            n_epoch_steps += 1
             step_count += 1
-            train_history["train_loss"].append(info_dict)
-            if neptune_run:
-                neptune_run["train"].append(info_dict, step=step_count)
-            train_loss.backward()
-            optim.step()
-        epoch_pbar.set_description(f"train loss: {train_loss.item():.3f}")
-        # Calculate and log test loss at the end of each epoch divisible by 10
-        if epoch % 10 == 0:
+            if n_buffered == buffer_size:
+                flush_losses(epoch)
+        flush_losses(epoch)
+        converged = False
+        if tol is not None:
+            epoch_loss = float(epoch_loss_sum) / n_epoch_steps
+            if prev_epoch_loss is not None:
+                if prev_epoch_loss - epoch_loss < tol * abs(prev_epoch_loss):
+                    converged_epochs += 1
+                else:
+                    converged_epochs = 0
+            prev_epoch_loss = epoch_loss
+            converged = converged_epochs >= patience
+        # Calculate and log test loss at the end of each epoch divisible by 10 and at
+        # the last epoch if training converged early
+        if epoch % 10 == 0 or converged:
             with t.no_grad():
                 avg_test_loss = calc_loss(test_loader, transform, loss_module)
                 info_dict = {"test_loss": avg_test_loss, "epoch": epoch}
@@ -297,6 +413,9 @@ def train_transform(
                     train_history["mark_translation_score"].append(info_dict)
                 if neptune_run:
                     neptune_run["test"].append(info_dict, step=step_count)
+        if converged:
+            logger.info(f"train loss converged after {epoch} epochs")
+            break
     if plot_fig or save_fig:
         fig = px.line(title="Train and Test Loss with Mark Correct Score")
         fig.add_scatter(
@@ -329,6 +448,200 @@ def train_transform(
     return transform, train_history
 
 
+def initialize_transform_ensemble(
+    d_model: int,
+    transformation: str,
+    seeds: Sequence[int],
+    transform_kwargs: Dict[str, Any] = {},
+    device: Union[str, t.device] = default_device,
+) -> TransformEnsemble:
+    """Initializes an ensemble of transformations of the same type.
+
+    Args:
+        d_model: The dimensionality of the model embeddings.
+        transformation: The type of transformation, see initialize_transform_and_optim.
+            Any type but 'identity' is supported.
+        seeds: The seed each member is initialized with, one per member.
+        transform_kwargs: Dict containing kwargs for transformation initialization.
+        device: The device on which to allocate tensors. If None, defaults to
+            default_device.
+
+    Returns:
+        The TransformEnsemble of the transformations.
+    """
+    if transformation == "identity":
+        raise ValueError("the identity transformation has no parameters to train")
+    transforms = []
+    for seed in seeds:
+        t.manual_seed(seed)
+        transform, _ = initialize_transform_and_optim(
+            d_model, transformation, dict(transform_kwargs), device=device
+        )
+        transforms.append(transform)
+    return TransformEnsemble(transforms)
+
+
+class EnsembleAdam(Optimizer):
+    """Adam for the stacked parameters of a TransformEnsemble.
+
+    Performs the same update as t.optim.Adam (with L2 weight decay), but with a
+    learning rate and weight decay per member, i.e. per index of the leading
+    n_members dimension of every parameter. Consecutive members sharing a learning
+    rate and weight decay are updated together by the fused Adam kernel, as slices
+    of the stacked parameters, so an ensemble differing only in seeds takes a single
+    fused step over the whole stacked tensors.
+
+    Args:
+        params: The stacked parameters of the ensemble.
+        lrs: The learning rate of each member.
+        weight_decays: The weight decay of each member.
+        betas: The coefficients of the running averages of the gradient and its square.
+        eps: The term added to the denominator for numerical stability.
+    """
+
+    def __init__(
+        self,
+        params: Iterable[nn.Parameter],
+        lrs: Sequence[float],
+        weight_decays: Sequence[float],
+        betas: Tuple[float, float] = (0.9, 0.999),
+        eps: float = 1e-8,
+    ):
+        super().__init__(params, {"betas": betas, "eps": eps})
+        # (slice, lr, weight decay) of each run of members with the same lr and decay
+        self.member_slices = []
+        start = 0
+        for (lr, weight_decay), members in groupby(zip(lrs, weight_decays)):
+            stop = start + len(list(members))
+            self.member_slices.append((slice(start, stop), lr, weight_decay))
+            start = stop
+
+    @t.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with t.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            beta1, beta2 = group["betas"]
+            params = [param for param in group["params"] if param.grad is not None]
+            for param in params:
+                state = self.state[param]
+                if not state:
+                    # a step count per slice, which the fused kernel increments
+                    state["step"] = t.zeros(
+                        len(self.member_slices), device=param.device
+                    )
+                    state["exp_avg"] = t.zeros_like(param)
+                    state["exp_avg_sq"] = t.zeros_like(param)
+            states = [self.state[param] for param in params]
+            for i, (members, lr, weight_decay) in enumerate(self.member_slices):
+                adam(
+                    [param[members] for param in params],
+                    [param.grad[members] for param in params],
+                    [state["exp_avg"][members] for state in states],
+                    [state["exp_avg_sq"][members] for state in states],
+                    [],
+                    [state["step"][i] for state in states],
+                    fused=True,
+                    amsgrad=False,
+                    beta1=beta1,
+                    beta2=beta2,
+                    lr=lr,
+                    weight_decay=weight_decay,
+                    eps=group["eps"],
+                    maximize=False,
+                )
+        return loss
+
+
+def train_transform_ensemble(
+    train_loader: DataLoader[Tuple[Tensor, ...]],
+    test_loader: DataLoader[Tuple[Tensor, ...]],
+    ensemble: TransformEnsemble,
+    loss_module: nn.Module,
+    n_epochs: int,
+    lrs: Sequence[float],
+    weight_decays: Optional[Sequence[float]] = None,
+    device: Union[str, t.device] = default_device,
+) -> Tuple[List[nn.Module], List[Dict[str, List[Dict[str, Union[float, int]]]]]]:
+    """Trains every member of an ensemble of transformations at once.
+
+    All members are trained on the same batches, with a single (batched) forward and
+    backward pass per step for the whole ensemble. Each member has its own learning
+    rate and weight decay, applied by EnsembleAdam, so every member follows the
+    trajectory of training it on its own with Adam(lr, weight_decay) in
+    train_transform.
+
+    Args:
+        train_loader: DataLoader for the training dataset.
+        test_loader: DataLoader for the test dataset.
+        ensemble: The ensemble of transformations to be optimized.
+        loss_module: The loss function used for training.
+        n_epochs: The number of epochs to train for.
+        lrs: The learning rate of each member.
+        weight_decays: Optional; the weight decay of each member. Defaults to none.
+        device: The device on which the ensemble is allocated.
+
+    Returns:
+        The learned transformations, unstacked from the ensemble, and for each member
+        a train and test loss history in the format of train_transform.
+    """
+    n_members = ensemble.n_members
+    if weight_decays is None:
+        weight_decays = [0.0] * n_members
+    if len(lrs) != n_members or len(weight_decays) != n_members:
+        raise ValueError(
+            f"expected {n_members} learning rates and weight decays, got {len(lrs)} "
+            f"and {len(weight_decays)}"
+        )
+    params = list(ensemble.parameters())
+    optim = EnsembleAdam(params, lrs, weight_decays)
+
+    def member_losses(preds: Tensor, targets: Tensor) -> Tensor:
+        def member_loss(pred: Tensor) -> Tensor:
+            return loss_module(pred.squeeze(), targets.squeeze())
+
+        return vmap(member_loss)(preds)
+
+    histories = [{"train_loss": [], "test_loss": []} for _ in range(n_members)]
+    ensemble.train()
+    for epoch in (epoch_pbar := tqdm(range(n_epochs + 1))):
+        # the losses are kept on the device and copied to the histories once per epoch
+        epoch_losses = []
+        for en_embed, fr_embed in train_loader:
+            en_embed, fr_embed = en_embed.to(device), fr_embed.to(device)
+            optim.zero_grad()
+            train_losses = member_losses(ensemble(en_embed), fr_embed)
+            # the members are independent, so the gradient of the sum with respect to
+            # a member's parameters is the gradient of that member's loss
+            train_losses.sum().backward()
+            optim.step()
+            epoch_losses.append(train_losses.detach())
+        epoch_losses = t.stack(epoch_losses, dim=1).tolist()
+        for history, losses in zip(histories, epoch_losses):
+            history["train_loss"].extend(
+                {"train_loss": loss, "epoch": epoch} for loss in losses
+            )
+        epoch_pbar.set_description(
+            f"train loss: {min(losses[-1] for losses in epoch_losses):.3f} (best)"
+        )
+        # Calculate and log test loss at the end of each epoch divisible by 10
+        if epoch % 10 == 0:
+            with t.no_grad():
+                total_test_losses = t.zeros(n_members, device=params[0].device)
+                for test_en_embed, test_fr_embed in test_loader:
+                    test_en_embed = test_en_embed.to(device)
+                    test_fr_embed = test_fr_embed.to(device)
+                    total_test_losses += member_losses(
+                        ensemble(test_en_embed), test_fr_embed
+                    )
+                test_losses = (total_test_losses / len(test_loader)).tolist()
+            for history, test_loss in zip(histories, test_losses):
+                history["test_loss"].append({"test_loss": test_loss, "epoch": epoch})
+    return ensemble.unstack(), histories
+
+
 def generate_new_embeddings_from_noise(
     embedding_matrix: t.Tensor,
     num_copies: int = 1,
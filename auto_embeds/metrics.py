@@ -1,4 +1,3 @@
-import json
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple, Union
 
@@ -10,12 +9,16 @@ from transformers import PreTrainedTokenizerBase
 
 from auto_embeds.data import (
     get_most_similar_embeddings,
+    load_azure_translations,
     print_most_similar_embeddings_dict,
 )
-from auto_embeds.modules import CosineSimilarityLoss
+from auto_embeds.modules import CosineSimilarityLoss, unembed_argmax
+from auto_embeds.token_classes import get_token_classes
+from auto_embeds.utils.instrument import instrumented
 from auto_embeds.utils.misc import (
     default_device,
 )
+from auto_embeds.verify import iter_verify_batches
 
 
 def calc_cos_sim_acc(
@@ -98,11 +101,11 @@ def calc_acc_detailed(
     """
     correct_count = 0
     total_count = 0
-    for en_embeds, fr_embeds in test_loader:
-        en_logits = unembed_module(en_embeds)
-        en_strs: List[str] = tokenizer.batch_decode(en_logits.argmax(dim=-1))
-        fr_logits = unembed_module(fr_embeds)
-        fr_strs: List[str] = tokenizer.batch_decode(fr_logits.argmax(dim=-1))
+    for en_embeds, _, en_toks, fr_toks, _ in iter_verify_batches(
+        test_loader, unembed_module, device
+    ):
+        en_strs: List[str] = tokenizer.batch_decode(en_toks)
+        fr_strs: List[str] = tokenizer.batch_decode(fr_toks)
         pred = transformation(en_embeds)
         pred_logits = unembed_module(pred)
         pred_top_strs = tokenizer.batch_decode(pred_logits.argmax(dim=-1))
@@ -178,31 +181,20 @@ def calc_acc_fast(
     Returns:
         The accuracy of the learned transformation as a float.
     """
-    correct_count = 0
+    token_classes = None
+    correct_count = t.zeros((), dtype=t.long, device=device)
     total_count = 0
-    for en_embeds, fr_embeds in test_loader:
-        en_embeds = en_embeds.to(device)
-        fr_embeds = fr_embeds.to(device)
-        fr_logits = unembed_module(fr_embeds)
-        fr_strs: List[str] = tokenizer.batch_decode(fr_logits.argmax(dim=-1))
+    for en_embeds, _, _, fr_toks, _ in iter_verify_batches(
+        test_loader, unembed_module, device
+    ):
         pred = transformation(en_embeds)
-        pred_logits = unembed_module(pred)
-        pred_top_strs = tokenizer.batch_decode(pred_logits.argmax(dim=-1))
-        pred_top_strs = [
-            item if isinstance(item, str) else item[0] for item in pred_top_strs
-        ]
-        assert all(isinstance(item, str) for item in pred_top_strs)
-        correct_count += sum(
-            (
-                fr_str == pred_top_str
-                if exact_match
-                else fr_str.strip().lower() == pred_top_str.strip().lower()
-            )
-            for fr_str, pred_top_str in zip(fr_strs, pred_top_strs)
-        )
+        pred_toks, d_vocab = unembed_argmax(unembed_module, pred)
+        if token_classes is None:
+            token_classes = get_token_classes(tokenizer, d_vocab)
+        correct_count += token_classes.same(fr_toks, pred_toks, exact_match).sum()
         total_count += len(en_embeds)
 
-    accuracy = correct_count / total_count
+    accuracy = correct_count.item() / total_count
     if print_acc:
         print(f"Correct Percentage: {accuracy * 100:.2f}%")
     return accuracy
@@ -250,82 +242,69 @@ def mark_translation(
         raise ValueError(
             "Either 'azure_translations_path' or 'translations_dict' must be given."
         )
-    # load acceptable translations from JSON file if given
-    if azure_translations_path:
-        with open(azure_translations_path, "r", encoding="utf-8") as file:
-            azure_translations = json.load(file)
-
-    # convert list of acceptable translations to a dict is this is not already provided.
-    # directly providing a dict is faster.
+    # the parsed translations are cached, directly providing a dict is still faster as
+    # it skips checking the file
     if translations_dict is None:
-        translations_dict = {}
-        for item in azure_translations:
-            source = item["normalizedSource"]
-            translations = [
-                trans["normalizedTarget"]
-                for trans in item["translations"]
-                if trans["normalizedTarget"] is not None
-            ]
-            translations_dict[source] = translations
+        translations_dict = load_azure_translations(
+            azure_translations_path
+        ).translations_dict
 
-    correct_count = 0
-    total_marked = 0
-
-    for en_embeds, fr_embeds in test_loader:
-        en_embeds = en_embeds.to(device)
-        fr_embeds = fr_embeds.to(device)
-        en_logits = unembed_module(en_embeds)
-        en_strs: List[str] = tokenizer.batch_decode(en_logits.squeeze().argmax(dim=-1))
-        fr_logits = unembed_module(fr_embeds)
-        fr_strs: List[str] = tokenizer.batch_decode(fr_logits.squeeze().argmax(dim=-1))
+    token_classes = None
+    correct_count = t.zeros((), dtype=t.long, device=device)
+    total_marked = t.zeros((), dtype=t.long, device=device)
+
+    for en_embeds, _, en_toks, fr_toks, _ in iter_verify_batches(
+        test_loader, unembed_module, device
+    ):
         pred = transformation(en_embeds)
-        pred_logits = unembed_module(pred)
-        pred_top_strs = tokenizer.batch_decode(pred_logits.squeeze().argmax(dim=-1))
-        pred_top_strs = [
-            item if isinstance(item, str) else item[0] for item in pred_top_strs
-        ]
-        assert all(isinstance(item, str) for item in pred_top_strs)
+        pred_toks, d_vocab = unembed_argmax(unembed_module, pred)
+        if token_classes is None:
+            token_classes = get_token_classes(tokenizer, d_vocab)
+            allowed = token_classes.allowed_translations(
+                translations_dict, en_toks.device
+            )
+        words_found, marks = token_classes.mark(en_toks, pred_toks, allowed)
+        correct_count += marks.sum()
+        total_marked += words_found.sum()
+        if not print_results:
+            continue
+
+        en_strs: List[str] = tokenizer.batch_decode(en_toks)
+        fr_strs: List[str] = tokenizer.batch_decode(fr_toks)
+        pred_top_strs: List[str] = tokenizer.batch_decode(pred_toks)
         # if statement for performance
         if print_top_preds:
             most_similar_embeds = get_most_similar_embeddings(
                 tokenizer,
-                out=pred_logits,
+                out=unembed_module(pred),
                 top_k=4,
             )
-        for i, pred_top_str in enumerate(pred_top_strs):
-            correct = None
+        for i, (word_found, mark) in enumerate(
+            zip(words_found.flatten().tolist(), marks.flatten().tolist())
+        ):
+            correct = mark if word_found else None
             en_str = en_strs[i]
             fr_str = fr_strs[i]
-            word_found = en_str.strip().lower() in translations_dict
+            pred_top_str = pred_top_strs[i]
+            result_emoji = "✅" if correct else "❌"
+            print(
+                f'English: "{en_str}"\n'
+                f'Target: "{fr_str}"\n'
+                f'Predicted: "{pred_top_str}" {result_emoji}'
+            )
             if word_found:
-                all_allowed_translations = translations_dict[en_str.strip().lower()]
-                correct = (
-                    pred_top_str.strip() in all_allowed_translations
-                    or pred_top_str.strip() + "s" in all_allowed_translations
-                    or pred_top_str.strip()[:-1] in all_allowed_translations
-                )
-                correct_count += correct
-                total_marked += 1
-            if print_results:
-                result_emoji = "✅" if correct else "❌"
                 print(
-                    f'English: "{en_str}"\n'
-                    f'Target: "{fr_str}"\n'
-                    f'Predicted: "{pred_top_str}" {result_emoji}'
+                    f"Check: Found "
+                    f"{list(translations_dict[en_str.strip().lower()])}"
                 )
-                if word_found:
-                    print(
-                        f"Check: Found "
-                        f"{list(translations_dict[en_str.strip().lower()])}"
-                    )
-                else:
-                    print("Check: Not Found")
-                if print_top_preds:
-                    print("Top Predictions:")
-                    current_most_similar_embeds = {0: most_similar_embeds[i]}
-                    print_most_similar_embeddings_dict(current_most_similar_embeds)
-                print()
-    accuracy = correct_count / total_marked
+            else:
+                print("Check: Not Found")
+            if print_top_preds:
+                print("Top Predictions:")
+                current_most_similar_embeds = {0: most_similar_embeds[i]}
+                print_most_similar_embeddings_dict(current_most_similar_embeds)
+            print()
+    accuracy = correct_count.item() / total_marked.item()
     return accuracy
 
 
@@ -381,25 +360,19 @@ def calc_pred_same_as_input(
     unembed_module: nn.Module,
     device: Optional[Union[str, t.device]] = default_device,
 ) -> float:
-    same_count = 0
+    token_classes = None
+    same_count = t.zeros((), dtype=t.long, device=device)
     total_count = 0
-    for en_embeds, _ in test_loader:
-        en_embeds = en_embeds.to(device)
-        en_logits = unembed_module(en_embeds)
-        en_strs: List[str] = tokenizer.batch_decode(en_logits.argmax(dim=-1))
+    for en_embeds, _, en_toks, _, _ in iter_verify_batches(
+        test_loader, unembed_module, device
+    ):
         pred = transformation(en_embeds)
-        pred_logits = unembed_module(pred)
-        pred_top_strs = tokenizer.batch_decode(pred_logits.argmax(dim=-1))
-        pred_top_strs = [
-            item if isinstance(item, str) else item[0] for item in pred_top_strs
-        ]
-        assert all(isinstance(item, str) for item in pred_top_strs)
-        same_count += sum(
-            en_str.strip().lower() == pred_top_str.strip().lower()
-            for en_str, pred_top_str in zip(en_strs, pred_top_strs)
-        )
+        pred_toks, d_vocab = unembed_argmax(unembed_module, pred)
+        if token_classes is None:
+            token_classes = get_token_classes(tokenizer, d_vocab)
+        same_count += token_classes.same(en_toks, pred_toks).sum()
         total_count += len(en_embeds)
-    proportion_same = same_count / total_count
+    proportion_same = same_count.item() / total_count
     return proportion_same
 
 
@@ -442,7 +415,6 @@ def calc_loss(
     transform: nn.Module,
     loss_module: nn.Module,
     device: Optional[Union[str, t.device]] = default_device,
-    
 ) -> float:
     """Calculate the average test loss over all batches in the test loader.
 
@@ -456,26 +428,38 @@ def calc_loss(
     Returns:
         The average test loss as a float.
     """
-    total_test_loss = 0.0
+    # summed on the device so that there is a single host sync for the whole loader
+    total_test_loss: Union[Tensor, float] = 0.0
     for test_en_embed, test_fr_embed in test_loader:
         test_en_embed = test_en_embed.to(device)
         test_fr_embed = test_fr_embed.to(device)
         test_pred = transform(test_en_embed)
         test_loss = loss_module(test_pred.squeeze(), test_fr_embed.squeeze())
-        total_test_loss += test_loss.item()
-    avg_test_loss = total_test_loss / len(test_loader)
+        total_test_loss = total_test_loss + test_loss.detach()
+    avg_test_loss = float(total_test_loss) / len(test_loader)
     return avg_test_loss
 
 
 @t.no_grad()
+@instrumented()
 def calc_metrics(
     loader: DataLoader[Tuple[Tensor, ...]],
     transform: nn.Module,
     tokenizer: Any,
     unembed_module: nn.Module,
     azure_translations_path: Optional[Path],
-) -> Dict[str, float]:
-    """Calculate various metrics for a given data loader.
+    translations_dict: Optional[Dict[str, List[str]]] = None,
+    device: Optional[Union[str, t.device]] = default_device,
+) -> Dict[str, Optional[float]]:
+    """Calculate various metrics for a given data loader in a single pass.
+
+    Each batch is transformed once and only the predictions are unembedded, the source
+    and target tokens coming from iter_verify_batches (cached for a VerifyDataset).
+    Every metric is then computed on device via the token classes of the tokenizer.
+    The results are the same as those of calc_acc_fast (with exact_match=False),
+    calc_loss with the cos_sim and mse_loss losses, calc_pred_same_as_input and
+    mark_translation, but calling those separately walks the loader and transforms
+    every batch once per metric.
 
     Args:
         loader: DataLoader for the dataset (train or test).
@@ -483,46 +467,61 @@ def calc_metrics(
         tokenizer: The tokenizer used for tokenization.
         unembed_module: The module used for unembedding operations.
         azure_translations_path: Path to Azure translations, if available.
+        translations_dict: Optional; A dictionary of translations, used instead of
+            loading azure_translations_path if given.
+        device: The device on which to allocate tensors. If None, defaults to
+            default_device.
 
     Returns:
         A dictionary containing calculated metrics.
     """
-    metrics = {}
-    metrics["accuracy"] = calc_acc_fast(
-        tokenizer=tokenizer,
-        test_loader=loader,
-        transformation=transform,
-        unembed_module=unembed_module,
-        exact_match=False,
-        print_results=False,
-        print_top_preds=False,
-        print_acc=False,
-    )
-    metrics["cos_sim_loss"] = calc_loss(
-        test_loader=loader,
-        transform=transform,
-        loss_module=initialize_loss("cos_sim"),
-    )
-    metrics["mse_loss"] = calc_loss(
-        test_loader=loader,
-        transform=transform,
-        loss_module=initialize_loss("mse_loss"),
-    )
-    metrics["pred_same_as_input"] = calc_pred_same_as_input(
-        tokenizer=tokenizer,
-        test_loader=loader,
-        transformation=transform,
-        unembed_module=unembed_module,
-    )
-    if azure_translations_path:
-        metrics["mark_translation_acc"] = mark_translation(
-            tokenizer=tokenizer,
-            transformation=transform,
-            unembed_module=unembed_module,
-            test_loader=loader,
-            azure_translations_path=azure_translations_path,
-            print_results=False,
-        )
+    if translations_dict is None and azure_translations_path:
+        translations_dict = load_azure_translations(
+            azure_translations_path
+        ).translations_dict
+    cos_sim_loss_module = initialize_loss("cos_sim")
+    mse_loss_module = initialize_loss("mse_loss")
+
+    token_classes = None
+    counts = t.zeros(4, dtype=t.long, device=device)
+    # correct, same as input, marked correct, marked
+    total_count = 0
+    total_cos_sim_loss = t.zeros((), device=device)
+    total_mse_loss = t.zeros((), device=device)
+    for en_embeds, fr_embeds, en_toks, fr_toks, _ in iter_verify_batches(
+        loader, unembed_module, device
+    ):
+        pred = transform(en_embeds)
+        total_cos_sim_loss += cos_sim_loss_module(pred.squeeze(), fr_embeds.squeeze())
+        total_mse_loss += mse_loss_module(pred.squeeze(), fr_embeds.squeeze())
+
+        # only the predictions depend on the transform, the source and target tokens
+        # come from iter_verify_batches
+        batch_size = en_embeds.shape[0]
+        pred_toks, d_vocab = unembed_argmax(unembed_module, pred)
+        if token_classes is None:
+            token_classes = get_token_classes(tokenizer, d_vocab)
+            if translations_dict is not None:
+                allowed = token_classes.allowed_translations(
+                    translations_dict, pred_toks.device
+                )
+        counts[0] += token_classes.same(fr_toks, pred_toks).sum()
+        counts[1] += token_classes.same(en_toks, pred_toks).sum()
+        if translations_dict is not None:
+            words_found, marks = token_classes.mark(en_toks, pred_toks, allowed)
+            counts[2] += marks.sum()
+            counts[3] += words_found.sum()
+        total_count += batch_size
+
+    correct_count, same_count, marked_correct_count, total_marked = counts.tolist()
+
+    metrics: Dict[str, Optional[float]] = {}
+    metrics["accuracy"] = correct_count / total_count
+    metrics["cos_sim_loss"] = total_cos_sim_loss.item() / len(loader)
+    metrics["mse_loss"] = total_mse_loss.item() / len(loader)
+    metrics["pred_same_as_input"] = same_count / total_count
+    if translations_dict is not None:
+        metrics["mark_translation_acc"] = marked_correct_count / total_marked
     else:
         metrics["mark_translation_acc"] = None
     return metrics
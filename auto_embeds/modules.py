@@ -1,14 +1,17 @@
+import copy
 import math
-from typing import Optional, Union
+from typing import Dict, List, Literal, NamedTuple, Optional, Tuple, Union
 
 import torch as t
 import torch.nn as nn
-from fancy_einsum import einsum
+import torch.nn.functional as F
 from jaxtyping import Float, Int
 from torch import Tensor
+from torch.func import functional_call, stack_module_state, vmap
 
 from auto_embeds.utils.logging import logger
 from auto_embeds.utils.misc import get_default_device
+from auto_embeds.vocab_index import chunked_topk
 
 default_device = get_default_device()
 
@@ -180,37 +183,238 @@ class UncenteredLinearMapTransform(nn.Module):
         return x
 
 
+OrthogonalParametrization = Literal["cayley", "matrix_exp", "householder", "retraction"]
+
+
+def random_rotation(
+    d_model: int, device: Optional[Union[str, t.device]] = default_device
+) -> Float[Tensor, "d_model d_model"]:
+    """Samples a uniformly random rotation matrix (with determinant +1).
+
+    The orthogonal factor of the QR decomposition of a gaussian matrix (with the signs
+    of R's diagonal moved into it) is uniformly distributed over the orthogonal
+    matrices, and flipping its first column if it is a reflection makes it a uniformly
+    random rotation, without resampling.
+
+    Args:
+        d_model: The dimensionality of the rotation.
+        device: The device on which to allocate the matrix.
+
+    Returns:
+        The rotation matrix.
+    """
+    Q, R = t.linalg.qr(t.randn(d_model, d_model, device=device))
+    Q = Q * t.sign(t.diagonal(R))
+    if t.linalg.det(Q) < 0:
+        Q[:, 0] = -Q[:, 0]
+    return Q
+
+
+def polar_rotation(
+    matrix: Float[Tensor, "d_model d_model"],
+) -> Float[Tensor, "d_model d_model"]:
+    """Returns the closest rotation to a matrix in Frobenius norm (its polar factor).
+
+    Args:
+        matrix: The matrix to project.
+
+    Returns:
+        The rotation matrix.
+    """
+    U, _, Vh = t.linalg.svd(matrix)
+    # a reflection is turned into the closest rotation by flipping the last singular
+    # vector, selected with a sign rather than a branch so that this works under vmap
+    flip = t.where(t.linalg.det(U @ Vh) < 0, -1.0, 1.0)
+    Vh = t.cat((Vh[..., :-1, :], flip[..., None, None] * Vh[..., -1:, :]), dim=-2)
+    return U @ Vh
+
+
+class OrthogonalLinear(nn.Module):
+    """
+    A nn.Module that multiplies the input tensor by a learned rotation matrix, i.e. an
+    orthogonal matrix with determinant +1.
+
+    The rotation is base @ C, where C is an orthogonal correction computed from the
+    parameters and base is a fixed rotation (a buffer) chosen so that the weight
+    starts at the initial rotation. C starts at the identity for cayley and
+    matrix_exp, but at the product of random reflections for householder. The
+    corrections are always proper rotations, so the weight is one too without ever
+    checking its determinant. The parametrizations of C are:
+
+    - cayley: the Cayley transform of a skew-symmetric matrix, a d_model^3 solve.
+    - matrix_exp: the matrix exponential of a skew-symmetric matrix.
+    - householder: a product of an even number of Householder reflections, built with
+      the compact WY representation (two matmuls and a triangular solve). Fewer
+      reflections than d_model make it cheaper but restrict the reachable rotations.
+    - retraction: a free matrix used as is (so a training step costs no more than for
+      a linear map), which is retracted onto the rotations every retract_every
+      training forward passes and whenever the weight is read without gradients.
+
+    Unlike t.nn.utils.parametrizations.orthogonal, the weight is computed once and
+    cached while the parameters do not change whenever gradients are disabled (e.g. in
+    evaluation, or the metrics between optimizer steps), unless cache_weight is False.
+    With gradients enabled it is recomputed on every forward pass, as a training step
+    needs its graph anyway.
+
+    Args:
+        d_model: The dimensionality of the model embeddings.
+        parametrization: The parametrization of the rotation, see above.
+        init: The initial rotation, 'random' for a uniformly random rotation or
+            'identity'.
+        n_reflections: The number of reflections of the householder parametrization,
+            rounded down to an even number. Defaults to d_model.
+        retract_every: The number of training forward passes between retractions of
+            the retraction parametrization.
+        cache_weight: Whether to cache the weight while gradients are disabled.
+        device: The device on which the module should be initialized.
+
+    Attributes:
+        weight: The rotation matrix, of shape [d_model, d_model]. Assigning to it sets
+            the rotation, the matrix assigned is assumed to be a rotation.
+        cache_weight: Whether the weight is cached while gradients are disabled, which
+            is turned off where the parameters are swapped for new tensors on every
+            call anyway, e.g. under the vmap of a TransformEnsemble.
+    """
+
+    def __init__(
+        self,
+        d_model: int,
+        parametrization: OrthogonalParametrization = "cayley",
+        init: Literal["random", "identity"] = "random",
+        n_reflections: Optional[int] = None,
+        retract_every: int = 10,
+        cache_weight: bool = True,
+        device: Optional[Union[str, t.device]] = default_device,
+    ):
+        super().__init__()
+        self.d_model = d_model
+        self.parametrization = parametrization
+        self.retract_every = retract_every
+        self.cache_weight = cache_weight
+        if init == "random":
+            initial_rotation = random_rotation(d_model, device=device)
+        elif init == "identity":
+            initial_rotation = t.eye(d_model, device=device)
+        else:
+            raise ValueError(f"Unsupported init: {init}")
+        if parametrization in ["cayley", "matrix_exp"]:
+            self.skew_pre = nn.Parameter(t.zeros(d_model, d_model, device=device))
+        elif parametrization == "householder":
+            n_reflections = n_reflections if n_reflections is not None else d_model
+            n_reflections -= n_reflections % 2
+            if n_reflections < 2:
+                raise ValueError("the householder parametrization needs 2 reflections")
+            self.reflections = nn.Parameter(
+                t.randn(d_model, n_reflections, device=device)
+            )
+        elif parametrization == "retraction":
+            self.free_weight = nn.Parameter(initial_rotation.clone())
+            self.n_training_forwards = 0
+        else:
+            raise ValueError(f"Unsupported parametrization: {parametrization}")
+        if parametrization != "retraction":
+            self.register_buffer("base", t.eye(d_model, device=device))
+        self.weight = initial_rotation
+        self._cache: Optional[Tuple[Tuple[Tensor, ...], Tuple[int, ...], Tensor]] = None
+
+    def _correction(self) -> Float[Tensor, "d_model d_model"]:
+        if self.parametrization in ["cayley", "matrix_exp"]:
+            skew = self.skew_pre.triu(1)
+            skew = skew - skew.T
+            if self.parametrization == "matrix_exp":
+                return t.linalg.matrix_exp(skew)
+            eye = t.eye(self.d_model, device=skew.device, dtype=skew.dtype)
+            return t.linalg.solve(eye + skew, eye - skew)
+        # the product of the reflections I - 2 u u^T in compact WY form, see Joffrain
+        # et al., Accumulating Householder transformations, revisited (2006)
+        U = self.reflections / self.reflections.norm(dim=0)
+        n_reflections = U.shape[1]
+        S = (U.T @ U).triu(1) + 0.5 * t.eye(
+            n_reflections, device=U.device, dtype=U.dtype
+        )
+        eye = t.eye(self.d_model, device=U.device, dtype=U.dtype)
+        return eye - U @ t.linalg.solve_triangular(S, U.T, upper=True)
+
+    def _compute_weight(self) -> Float[Tensor, "d_model d_model"]:
+        if self.parametrization == "retraction":
+            if t.is_grad_enabled():
+                return self.free_weight
+            return polar_rotation(self.free_weight)
+        return self.base @ self._correction()
+
+    @property
+    def weight(self) -> Float[Tensor, "d_model d_model"]:
+        if t.is_grad_enabled() or not self.cache_weight:
+            return self._compute_weight()
+        params = tuple(self.parameters()) + tuple(self.buffers())
+        versions = tuple(param._version for param in params)
+        if (
+            self._cache is None
+            or len(self._cache[0]) != len(params)
+            or any(a is not b for a, b in zip(self._cache[0], params))
+            or self._cache[1] != versions
+        ):
+            self._cache = (params, versions, self._compute_weight())
+        return self._cache[2]
+
+    @weight.setter
+    def weight(self, rotation: Float[Tensor, "d_model d_model"]) -> None:
+        with t.no_grad():
+            if self.parametrization == "retraction":
+                self.free_weight.copy_(rotation)
+            else:
+                self.base.copy_(rotation @ self._correction().T)
+        self._cache = None
+
+    @t.no_grad()
+    def retract(self) -> None:
+        """Projects the free matrix of the retraction parametrization onto the
+        rotations."""
+        if self.parametrization == "retraction":
+            self.free_weight.copy_(polar_rotation(self.free_weight))
+
+    def forward(self, x: Float[Tensor, "... d_model"]) -> Float[Tensor, "... d_model"]:
+        """
+        Applies the rotation to the input tensor.
+
+        Args:
+            x: The input tensor.
+
+        Returns:
+            The rotated tensor.
+        """
+        if (
+            self.parametrization == "retraction"
+            and self.training
+            and t.is_grad_enabled()
+        ):
+            if self.n_training_forwards % self.retract_every == 0:
+                self.retract()
+            self.n_training_forwards += 1
+        return F.linear(x, self.weight)
+
+
 class RotationTransform(nn.Module):
     """
     A nn.Module that applies a rotation transformation to the input tensor.
 
     Args:
         d_model: The dimensionality of the model embeddings.
+        parametrization: The parametrization of the rotation, see OrthogonalLinear.
         device: The device on which the module should be initialized.
 
     Attributes:
-        rotation: The rotation matrix.
+        rotation: The rotation, an OrthogonalLinear.
     """
 
     def __init__(
         self,
         d_model: int,
+        parametrization: OrthogonalParametrization = "cayley",
         device: Optional[Union[str, t.device]] = default_device,
     ):
         super().__init__()
-        self.rotation_pre = nn.Linear(d_model, d_model, bias=False, device=device)
-        # using orthogonal_map=cayley as it seems more performant
-        self.rotation = t.nn.utils.parametrizations.orthogonal(
-            self.rotation_pre, orthogonal_map="cayley"
-        )
-        # janky way to ensure that random initialisation of linear layer means that the
-        # orthogonal matrix has a positive determinant (that there is no reflection
-        # going on)
-        while self.rotation.weight.clone().detach().det() < 0:
-            self.rotation_pre = nn.Linear(d_model, d_model, bias=False, device=device)
-            self.rotation = t.nn.utils.parametrizations.orthogonal(
-                self.rotation_pre, orthogonal_map="cayley"
-            )
+        self.rotation = OrthogonalLinear(d_model, parametrization, device=device)
         self.d_model = d_model
 
     def forward(
@@ -235,24 +439,22 @@ class BiasedRotationTransform(nn.Module):
 
     Args:
         d_model: The dimensionality of the model embeddings.
+        parametrization: The parametrization of the rotation, see OrthogonalLinear.
         device: The device on which the module should be initialized.
 
     Attributes:
-        rotation (t.nn.Linear): The rotation matrix.
+        rotation (OrthogonalLinear): The rotation.
         bias (t.nn.Parameter): The bias vector.
     """
 
     def __init__(
         self,
         d_model: int,
+        parametrization: OrthogonalParametrization = "matrix_exp",
         device: Optional[Union[str, t.device]] = default_device,
     ):
         super().__init__()
-        self.rotation_pre = t.nn.Linear(d_model, d_model, bias=False, device=device)
-        self.rotation = t.nn.utils.parametrizations.orthogonal(self.rotation_pre)
-        while self.rotation.weight.clone().detach().det() < 0:
-            self.rotation_pre = nn.Linear(d_model, d_model, bias=False, device=device)
-            self.rotation = t.nn.utils.parametrizations.orthogonal(self.rotation_pre)
+        self.rotation = OrthogonalLinear(d_model, parametrization, device=device)
         self.bias = nn.Parameter(t.empty(d_model, device=device))
         fan_in, _ = nn.init._calculate_fan_in_and_fan_out(self.rotation.weight)
         bound = 1 / math.sqrt(fan_in) if fan_in > 0 else 0
@@ -282,24 +484,22 @@ class UncenteredRotationTransform(nn.Module):
 
     Args:
         d_model: The dimensionality of the model embeddings.
+        parametrization: The parametrization of the rotation, see OrthogonalLinear.
         device: The device on which the module should be initialized.
 
     Attributes:
-        rotation: The rotation matrix.
+        rotation: The rotation, an OrthogonalLinear.
         center: The translation vector.
     """
 
     def __init__(
         self,
         d_model: int,
+        parametrization: OrthogonalParametrization = "matrix_exp",
         device: Optional[Union[str, t.device]] = default_device,
     ):
         super().__init__()
-        self.rotation_pre = t.nn.Linear(d_model, d_model, bias=False, device=device)
-        self.rotation = t.nn.utils.parametrizations.orthogonal(self.rotation_pre)
-        while self.rotation.weight.clone().detach().det() < 0:
-            self.rotation_pre = nn.Linear(d_model, d_model, bias=False, device=device)
-            self.rotation = t.nn.utils.parametrizations.orthogonal(self.rotation_pre)
+        self.rotation = OrthogonalLinear(d_model, parametrization, device=device)
         self.center = nn.Parameter(t.empty(d_model, device=device))
         fan_in, _ = nn.init._calculate_fan_in_and_fan_out(self.rotation.weight)
         bound = 1 / math.sqrt(fan_in) if fan_in > 0 else 0
@@ -336,9 +536,7 @@ class ManualTransformModule(nn.Module):
         super(ManualTransformModule, self).__init__()
         self.transformations = transformations
 
-    def forward(
-        self, x: Float[Tensor, "batch pos d_model"]
-    ) -> Float[Tensor, "batch pos d_model"]:
+    def forward(self, x: Float[Tensor, "... d_model"]) -> Float[Tensor, "... d_model"]:
         """
         Applies the sequence of affine transformations to the input tensor.
 
@@ -350,14 +548,8 @@ class ManualTransformModule(nn.Module):
         """
         for operation, transform_tensor in self.transformations:
             if operation == "multiply":
-                x = einsum(
-                    (
-                        "d_model_row d_model_col, batch pos d_model_col -> "
-                        "batch pos d_model_row"
-                    ),
-                    transform_tensor,
-                    x,
-                )
+                # x @ M.T applies M to every row vector of x
+                x = t.matmul(x, transform_tensor.T)
             elif operation == "add":
                 x = x + transform_tensor
             elif operation == "scale":
@@ -367,6 +559,203 @@ class ManualTransformModule(nn.Module):
 
         return x
 
+    def fuse(self, d_model: Optional[int] = None) -> "FusedAffineTransform":
+        """
+        Collapses the chain of transformations into a single affine map.
+
+        Every supported operation is affine, so the whole chain equals x -> Wx + b for
+        a single W and b. These are composed once (in float64) and returned as a
+        FusedAffineTransform, which then costs one GEMM per call.
+
+        Args:
+            d_model: The dimensionality of the model embeddings. Only needed if no
+                operation is a matrix or vector, i.e. the chain only scales by scalars.
+
+        Returns:
+            FusedAffineTransform: A module computing the same function.
+        """
+        if d_model is None:
+            for _, transform_tensor in self.transformations:
+                if transform_tensor.dim() > 0:
+                    d_model = transform_tensor.shape[-1]
+                    break
+            else:
+                raise ValueError("d_model cannot be inferred, pass it explicitly.")
+        first_tensor = self.transformations[0][1] if self.transformations else None
+        device = first_tensor.device if first_tensor is not None else None
+        dtype = first_tensor.dtype if first_tensor is not None else t.float32
+        W = t.eye(d_model, dtype=t.float64, device=device)
+        b = t.zeros(d_model, dtype=t.float64, device=device)
+        for operation, transform_tensor in self.transformations:
+            transform_tensor = transform_tensor.detach().to(t.float64)
+            if operation == "multiply":
+                W = transform_tensor @ W
+                b = transform_tensor @ b
+            elif operation == "add":
+                b = b + transform_tensor
+            elif operation == "scale":
+                # a scalar or a per-dimension scale of the output
+                W = transform_tensor.unsqueeze(-1) * W
+                b = transform_tensor * b
+            else:
+                raise ValueError(f"Unsupported operation: {operation}")
+        return FusedAffineTransform(W.to(dtype), b.to(dtype))
+
+
+class FusedAffineTransform(nn.Module):
+    """
+    A nn.Module that applies a fixed affine map x -> Wx + b to the input tensor with a
+    single addmm over the flattened leading dimensions. Usually created with
+    ManualTransformModule.fuse.
+
+    Args:
+        weight: The matrix W of shape [d_model_out, d_model_in].
+        bias: The vector b of shape [d_model_out].
+    """
+
+    def __init__(
+        self,
+        weight: Float[Tensor, "d_model_out d_model_in"],
+        bias: Float[Tensor, "d_model_out"],
+    ):
+        super().__init__()
+        # stored transposed so that the addmm reads it contiguously
+        self.register_buffer("weight_t", weight.detach().T.contiguous())
+        self.register_buffer("bias", bias.detach().clone())
+
+    def forward(
+        self, x: Float[Tensor, "... d_model_in"]
+    ) -> Float[Tensor, "... d_model_out"]:
+        """
+        Applies the affine map to the input tensor.
+
+        Args:
+            x: The input tensor.
+
+        Returns:
+            torch.Tensor: The transformed tensor.
+        """
+        out = t.addmm(self.bias, x.reshape(-1, x.shape[-1]), self.weight_t)
+        return out.reshape(*x.shape[:-1], out.shape[-1])
+
+
+def set_weight_caching(module: nn.Module, enabled: bool) -> None:
+    """Sets cache_weight of every OrthogonalLinear within a module.
+
+    Args:
+        module: The module, e.g. a RotationTransform.
+        enabled: Whether the OrthogonalLinears should cache their weights.
+    """
+    for submodule in module.modules():
+        if isinstance(submodule, OrthogonalLinear):
+            submodule.cache_weight = enabled
+            submodule._cache = None
+
+
+class TransformEnsemble(nn.Module):
+    """
+    A nn.Module holding an ensemble of transforms of the same type (e.g. trained with
+    different seeds, learning rates or weight decays) as stacked parameters, and
+    applying all of them to the same input at once. Each parameter of the transforms
+    becomes one tensor with a leading n_members dimension, and the forward pass vmaps
+    the transform's forward over it, so every matmul is a single batched matmul over
+    the members rather than one call per member. This works for any of the transforms
+    above, including the rotations of every parametrization (the retraction one
+    retracts the stacked free matrices in place), though the rotations of the members
+    are recomputed on every call rather than cached. Ensembles of LinearTransforms and
+    TranslationTransforms skip vmap: as the members share their input, their stacked
+    weights are applied as a single (n_members * d_model, d_model) matmul and their
+    translations as a single broadcast add.
+
+    Args:
+        transforms: The transforms, all of the same type and shape.
+
+    Attributes:
+        stacked_params: The stacked parameters, in the order of param_names.
+        param_names: The name of each stacked parameter in the transforms.
+        n_members: The number of transforms in the ensemble.
+    """
+
+    def __init__(self, transforms: List[nn.Module]):
+        super().__init__()
+        params, buffers = stack_module_state(transforms)
+        self.param_names = list(params)
+        self.buffer_names = list(buffers)
+        self.stacked_params = nn.ParameterList(
+            [nn.Parameter(param) for param in params.values()]
+        )
+        for i, buffer in enumerate(buffers.values()):
+            self.register_buffer(f"stacked_buffer_{i}", buffer)
+        self.n_members = len(transforms)
+        # kept in a list so that its parameters are not registered as the ensemble's,
+        # it is only used for its forward and as the template for unstack
+        self._template = [copy.deepcopy(transforms[0])]
+        # under vmap the parameters are new tensors on every call, so caching the
+        # rotations would only keep batched tensors alive outside of the vmap
+        set_weight_caching(self._template[0], False)
+
+    def _stacked_state(self) -> Tuple[Dict[str, Tensor], Dict[str, Tensor]]:
+        params = dict(zip(self.param_names, self.stacked_params))
+        buffers = {
+            name: getattr(self, f"stacked_buffer_{i}")
+            for i, name in enumerate(self.buffer_names)
+        }
+        return params, buffers
+
+    def forward(
+        self, x: Float[Tensor, "... d_model"]
+    ) -> Float[Tensor, "n_members ... d_model"]:
+        """
+        Applies every transform of the ensemble to the input tensor.
+
+        Args:
+            x: The input tensor, shared by all the members.
+
+        Returns:
+            The transformed tensor of each member, stacked along the first dimension.
+        """
+        template = self._template[0]
+        params, buffers = self._stacked_state()
+        if type(template) is LinearTransform:
+            weight, bias = params["linear.weight"], params.get("linear.bias")
+            out = F.linear(
+                x,
+                weight.flatten(0, 1),
+                None if bias is None else bias.flatten(),
+            )
+            return out.unflatten(-1, (self.n_members, -1)).movedim(-2, 0)
+        if type(template) is TranslationTransform:
+            translation = params["translation"]
+            return x + translation.view(self.n_members, *[1] * (x.dim() - 1), -1)
+
+        def member_forward(params, buffers, x):
+            return functional_call(template, (params, buffers), (x,))
+
+        return vmap(member_forward, in_dims=(0, 0, None))(params, buffers, x)
+
+    @t.no_grad()
+    def unstack(self) -> List[nn.Module]:
+        """
+        Returns the members of the ensemble as independent transforms.
+
+        Returns:
+            A list of n_members transforms of the type the ensemble was created from,
+            holding copies of the current parameters of each member.
+        """
+        params, buffers = self._stacked_state()
+        members = []
+        for i in range(self.n_members):
+            member = copy.deepcopy(self._template[0])
+            member_params = dict(member.named_parameters())
+            member_buffers = dict(member.named_buffers())
+            for name, param in params.items():
+                member_params[name].data = param[i].detach().clone()
+            for name, buffer in buffers.items():
+                member_buffers[name].data = buffer[i].clone()
+            set_weight_caching(member, True)
+            members.append(member)
+        return members
+
 
 class Embed(nn.Module):
     """
@@ -428,6 +817,21 @@ class Embed(nn.Module):
         return self.W_E[tokens, :]
 
 
+class UnembedTopK(NamedTuple):
+    """The result of Unembed.topk.
+
+    Attributes:
+        ids: The token ids of the top-k logits of shape [..., k], highest first.
+        logits: The top-k logits of shape [..., k].
+        probs: The softmax probabilities of the top-k tokens over the full vocabulary
+            of shape [..., k] if requested, otherwise None.
+    """
+
+    ids: Int[Tensor, "... k"]
+    logits: Float[Tensor, "... k"]
+    probs: Optional[Float[Tensor, "... k"]]
+
+
 class Unembed(nn.Module):
     """
     A nn.Module that provides functionality for unembedding, converting high-dimensional
@@ -444,6 +848,9 @@ class Unembed(nn.Module):
         ln_weight: The weight for layer normalization.
         ln_bias: The bias for layer normalization.
         device: The device on which the module should be initialized.
+        transpose_weight: If True, stores W_U transposed and contiguous, i.e. as a
+            [d_vocab, d_model] W_U_T, which is the layout F.linear passes to the GEMM
+            directly. W_U is then a (non-contiguous) view of W_U_T. Defaults to False.
     """
 
     def __init__(
@@ -456,9 +863,14 @@ class Unembed(nn.Module):
         ln_weight: Optional[Tensor] = None,
         ln_bias: Optional[Tensor] = None,
         device: Optional[Union[str, t.device]] = default_device,
+        transpose_weight: bool = False,
     ):
         super().__init__()
-        self.W_U = nn.Parameter(W_U, requires_grad=False)
+        self.transpose_weight = transpose_weight
+        if transpose_weight:
+            self.W_U_T = nn.Parameter(W_U.T.contiguous(), requires_grad=False)
+        else:
+            self.W_U = nn.Parameter(W_U, requires_grad=False)
         self.b_U = nn.Parameter(b_U, requires_grad=False)
         self.ln_final = nn.LayerNorm(d_model, device=device) if apply_ln else None
         if self.ln_final is not None:
@@ -469,13 +881,25 @@ class Unembed(nn.Module):
             if ln_bias is not None:
                 self.ln_final.bias.data.copy_(ln_bias)
 
-    def forward(
-        self, x: Float[Tensor, "batch pos d_model"]
-    ) -> Float[Tensor, "batch pos d_vocab"]:
+    @property
+    def W_U(self) -> Float[Tensor, "d_model d_vocab"]:
+        """The unembedding matrix, a view of W_U_T if transpose_weight."""
+        if self.transpose_weight:
+            return self.W_U_T.T
+        # without transpose_weight W_U is registered as a parameter, which nn.Module
+        # keeps in _parameters rather than as an attribute
+        if "W_U" not in self._parameters:
+            raise AttributeError("W_U")
+        return self._parameters["W_U"]
+
+    def forward(self, x: Float[Tensor, "... d_model"]) -> Float[Tensor, "... d_vocab"]:
         """
         Forward pass for unembedding, optionally applying layer normalization before
         converting embeddings back to the vocabulary space.
 
+        The leading dimensions are flattened so that the unembedding, with b_U fused
+        in, is a single addmm (or F.linear with transpose_weight).
+
         Args:
             x: Input tensor containing embeddings.
 
@@ -484,15 +908,87 @@ class Unembed(nn.Module):
         """
         if self.ln_final is not None:
             x = self.ln_final(x)
-        result = (
-            einsum(
-                "batch pos d_model, d_model vocab -> batch pos vocab",
-                x,
-                self.W_U,
-            )
-            + self.b_U
+        x_flat = x.reshape(-1, x.shape[-1])
+        if self.transpose_weight:
+            result = F.linear(x_flat, self.W_U_T, self.b_U)
+        else:
+            result = t.addmm(self.b_U, x_flat, self.W_U)
+        return result.reshape(*x.shape[:-1], result.shape[-1])
+
+    @property
+    def d_vocab(self) -> int:
+        return self.b_U.shape[0]
+
+    @t.no_grad()
+    def topk(
+        self,
+        x: Float[Tensor, "... d_model"],
+        k: int,
+        return_probs: bool = False,
+        chunk_size: int = 16384,
+    ) -> UnembedTopK:
+        """
+        Finds the top-k tokens of the embeddings without materialising their logits.
+
+        The logits are computed for chunk_size tokens of the vocabulary at a time and
+        merged into a running top-k (and log-sum-exp if return_probs), so peak memory
+        is O(n_embeddings * chunk_size) rather than O(n_embeddings * d_vocab).
+
+        Args:
+            x: Input tensor containing embeddings.
+            k: The number of top tokens to return per embedding.
+            return_probs: If True, also returns the exact softmax probabilities of the
+                top-k tokens.
+            chunk_size: The number of vocabulary tokens scored at a time.
+
+        Returns:
+            UnembedTopK: The ids, logits and optionally probs of the top-k tokens.
+        """
+        if self.ln_final is not None:
+            x = self.ln_final(x)
+        x_flat = x.reshape(-1, x.shape[-1])
+        vectors = self.W_U_T if self.transpose_weight else self.W_U.T
+        top = chunked_topk(
+            x_flat,
+            vectors,
+            k,
+            bias=self.b_U,
+            chunk_size=chunk_size,
+            return_logsumexp=return_probs,
         )
-        return result
+        k = top.values.shape[-1]
+        probs = None
+        if top.logsumexp is not None:
+            probs = (top.values - top.logsumexp.unsqueeze(-1)).exp()
+            probs = probs.reshape(*x.shape[:-1], k)
+        return UnembedTopK(
+            top.indices.reshape(*x.shape[:-1], k),
+            top.values.reshape(*x.shape[:-1], k),
+            probs,
+        )
+
+
+def unembed_argmax(
+    unembed_module: nn.Module, x: Float[Tensor, "... d_model"]
+) -> Tuple[Int[Tensor, "..."], int]:
+    """
+    Finds the most likely token of each embedding.
+
+    Uses Unembed.topk, which never materialises the full logits, for Unembed modules
+    and the argmax of the logits for any other unembedding module.
+
+    Args:
+        unembed_module: The module used for unembedding.
+        x: Input tensor containing embeddings.
+
+    Returns:
+        A tuple of the most likely token ids, of the shape of x without d_model, and
+        the size of the vocabulary.
+    """
+    if isinstance(unembed_module, Unembed):
+        return unembed_module.topk(x, 1).ids[..., 0], unembed_module.d_vocab
+    logits = unembed_module(x)
+    return logits.argmax(dim=-1), logits.shape[-1]
 
 
 # losses ===============================================================================
@@ -503,7 +999,7 @@ class CosineSimilarityLoss(nn.Module):
         self,
         predictions: Float[Tensor, "... d_model"],
         targets: Float[Tensor, "... d_model"],
-    ) -> Float[Tensor, "1"]:
+    ) -> Float[Tensor, ""]:
         return -nn.functional.cosine_similarity(predictions, targets, dim=-1).mean()
 
 
@@ -0,0 +1,188 @@
+import json
+import os
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from auto_embeds.utils.logging import logger
+from auto_embeds.utils.misc import repo_path_to_abs_path
+
+# the artifacts of a run, stored under results/test/json/<name> like on Neptune
+ARTIFACT_NAMES = ["cos_sims_trend_plot", "test_cos_sim_diff", "verify_results"]
+
+
+def default_results_dir() -> Path:
+    return Path(os.getenv("AUTOEMBEDS_RESULTS_DIR", repo_path_to_abs_path("results")))
+
+
+def flatten_namespace(value: Any, prefix: str) -> Dict[str, Any]:
+    """Flattens nested dictionaries into "/" separated fields like Neptune does.
+
+    Values of types Neptune does not support as fields (e.g. lists or None) are
+    converted to strings, as with neptune.utils.stringify_unsupported.
+
+    Args:
+        value: The value to flatten, usually a dictionary.
+        prefix: The namespace of the value, e.g. "config".
+
+    Returns:
+        A dictionary mapping field paths, e.g. "config/dataset/name", to values.
+    """
+    if isinstance(value, dict):
+        fields = {}
+        for key, item in value.items():
+            fields.update(flatten_namespace(item, f"{prefix}/{key}"))
+        return fields
+    if not isinstance(value, (bool, int, float, str)):
+        value = str(value)
+    return {prefix: value}
+
+
+class ResultsStore:
+    """A local Parquet store of the configs, results and artifacts of runs.
+
+    Every run is written as a single row Parquet file to a date=YYYY-MM-DD partition
+    of the day it was created, so sweep workers can write runs concurrently without
+    coordination. Runs are keyed by a locally generated sys/store_id rather than their
+    Neptune id, which offline and debug runs do not have (or share between processes).
+    The columns follow the layout of the runs table of fetch_neptune_runs_df (sys/id,
+    config/..., results/... and the results/test/json/... artifacts) so that
+    load_runs_df can be passed straight to process_neptune_runs_df, plus
+    sys/store_id, sys/tags, sys/creation_time and the JSON encoded loss histories
+    under history/.... compact merges the files of each partition, which keeps
+    loading fast for stores of thousands of runs.
+
+    Args:
+        directory: The root directory of the store. Defaults to the
+            AUTOEMBEDS_RESULTS_DIR environment variable or results/ in the repo.
+    """
+
+    def __init__(self, directory: Optional[Union[str, Path]] = None):
+        self.directory = Path(directory) if directory else default_results_dir()
+
+    def write_run(
+        self,
+        tags: List[str],
+        config: Dict[str, Any],
+        results: Dict[str, Any],
+        histories: Optional[Dict[str, List[Dict[str, Any]]]] = None,
+        artifacts: Optional[Dict[str, str]] = None,
+        creation_time: Optional[datetime] = None,
+        neptune_id: Optional[str] = None,
+        store_id: Optional[str] = None,
+    ) -> Path:
+        """Writes a run to the store.
+
+        Args:
+            tags: The tags of the run.
+            config: The config of the run, stored under config/.
+            results: The results of the run, e.g. {"train": {...}, "test": {...}},
+                stored under results/.
+            histories: Optional; series of the run, e.g. the loss history of
+                train_transform, stored as JSON under history/.
+            artifacts: Optional; maps names in ARTIFACT_NAMES to their JSON contents.
+            creation_time: The time the run was created, defaults to now.
+            neptune_id: Optional; the Neptune sys/id of the run, stored as sys/id.
+                Only given for runs logged to the Neptune server.
+            store_id: Optional; the key of the run in the store, which replaces any
+                run previously written with it. Defaults to a new uuid.
+
+        Returns:
+            The path of the written file, named after the store id.
+        """
+        creation_time = creation_time or datetime.now(timezone.utc)
+        store_id = store_id or uuid.uuid4().hex
+        row: Dict[str, Any] = {
+            "sys/id": neptune_id,
+            "sys/store_id": store_id,
+            "sys/tags": list(tags),
+            "sys/creation_time": creation_time,
+            **flatten_namespace(config, "config"),
+            **flatten_namespace(results, "results"),
+        }
+        for name, history in (histories or {}).items():
+            row[f"history/{name}"] = json.dumps(history)
+        for name, artifact in (artifacts or {}).items():
+            if name not in ARTIFACT_NAMES:
+                raise ValueError(f"Unknown artifact: {name}")
+            row[f"results/test/json/{name}"] = artifact
+
+        partition = self.directory / f"date={creation_time:%Y-%m-%d}"
+        partition.mkdir(parents=True, exist_ok=True)
+        path = partition / f"{store_id}.parquet"
+        # written to a temporary file first so readers never see a partial file
+        tmp_path = partition / f".{store_id}.parquet.tmp"
+        pq.write_table(pa.Table.from_pylist([row]), tmp_path)
+        tmp_path.replace(path)
+        return path
+
+    def partitions(self) -> List[Path]:
+        return sorted(self.directory.glob("date=*"))
+
+    def load_runs_df(
+        self,
+        tags: Optional[List[str]] = None,
+        get_artifacts: bool = True,
+        dates: Optional[List[str]] = None,
+    ) -> pd.DataFrame:
+        """Loads the runs of the store as a DataFrame.
+
+        Args:
+            tags: Optional; only runs with all of these tags are loaded, as with the
+                tags of fetch_neptune_runs_df.
+            get_artifacts: Whether to load the artifact columns. Without artifacts
+                they are skipped when reading and filled with None.
+            dates: Optional; only runs created on these dates (YYYY-MM-DD) are read.
+
+        Returns:
+            A DataFrame with a row per run, ordered by creation time. If a store id
+            was written more than once only its latest row is kept.
+        """
+        artifact_columns = [f"results/test/json/{name}" for name in ARTIFACT_NAMES]
+        tables = []
+        for partition in self.partitions():
+            if dates is not None and partition.name.split("=", 1)[1] not in dates:
+                continue
+            for path in sorted(partition.glob("*.parquet")):
+                columns = pq.read_schema(path).names
+                if not get_artifacts:
+                    columns = [col for col in columns if col not in artifact_columns]
+                tables.append(pq.read_table(path, columns=columns))
+        if not tables:
+            return pd.DataFrame(columns=["sys/id", "sys/store_id"] + artifact_columns)
+        # runs of different configs may store a field with different types, e.g. an
+        # int weight decay of 0 next to floats, which are promoted when concatenating
+        df = pa.concat_tables(tables, promote_options="permissive").to_pandas()
+
+        if tags:
+            has_tags = df["sys/tags"].apply(lambda run_tags: set(tags) <= set(run_tags))
+            df = df[has_tags]
+        df = df.sort_values("sys/creation_time", kind="stable")
+        df = df.drop_duplicates("sys/store_id", keep="last").reset_index(drop=True)
+        for column in artifact_columns:
+            if not get_artifacts or column not in df.columns:
+                df[column] = None
+        logger.info(f"loaded {len(df)} runs from {self.directory}")
+        return df
+
+    def compact(self) -> None:
+        """Merges the files of each partition into a single file."""
+        for partition in self.partitions():
+            paths = sorted(partition.glob("*.parquet"))
+            if len(paths) <= 1:
+                continue
+            table = pa.concat_tables(
+                [pq.read_table(path) for path in paths], promote_options="permissive"
+            )
+            name = f"compacted-{uuid.uuid4().hex}.parquet"
+            tmp_path = partition / f".{name}.tmp"
+            pq.write_table(table, tmp_path)
+            tmp_path.replace(partition / name)
+            for path in paths:
+                path.unlink()
+            logger.info(f"compacted {len(paths)} files of {partition.name}")
@@ -9,6 +9,7 @@ import transformer_lens as tl
 from torch import Tensor
 from torch.utils.data import DataLoader
 
+from auto_embeds.modules import ManualTransformModule
 from auto_embeds.utils.custom_tqdm import tqdm
 from auto_embeds.utils.misc import remove_hooks
 
@@ -128,6 +129,9 @@ def perform_steering_tests(
         num_tests: The number of tests to perform. Defaults to 3.
 
     """
+    if isinstance(transformation, ManualTransformModule):
+        # the steering hook runs on every forward pass, so the chain is fused once
+        transformation = transformation.fuse()
     for idx, (test_en_str, test_fr_str) in enumerate(zip(en_strs, fr_strs)):
         if idx >= num_tests:
             break
@@ -0,0 +1,202 @@
+import weakref
+from typing import Dict, List, NamedTuple, Tuple, Union
+
+import torch as t
+from jaxtyping import Bool, Int
+from torch import Tensor
+from transformers import PreTrainedTokenizerBase
+
+
+class AllowedTranslations(NamedTuple):
+    """The allowed translations of a translations dictionary in terms of token classes.
+
+    Attributes:
+        found: Whether each case class (a token after strip().lower()) is a source word
+            in the translations dictionary.
+        keys: The allowed (source case class, predicted stripped class) pairs, packed as
+            case_class * n_stripped_classes + stripped_class and sorted. This is the CSR
+            layout of the sparse allowed-translation matrix flattened into one array,
+            so membership is a single searchsorted.
+    """
+
+    found: Bool[Tensor, "n_case_classes"]
+    keys: Int[Tensor, "n_allowed"]
+
+
+class TokenClasses:
+    """Equivalence classes of a tokenizer's tokens under the string comparisons used to
+    mark translations.
+
+    Every token is decoded once and assigned three class ids: its exact decoded string,
+    the string after strip() and the string after strip().lower(). Comparing decoded
+    strings in the evaluation loops then becomes comparing class ids, which is a tensor
+    op on the device the logits are on. Use get_token_classes to build the classes once
+    per tokenizer.
+
+    Args:
+        token_strs: The decoded string of every token id.
+    """
+
+    def __init__(self, token_strs: List[str]):
+        self.d_vocab = len(token_strs)
+        exact_ids: Dict[str, int] = {}
+        stripped_ids: Dict[str, int] = {}
+        case_ids: Dict[str, int] = {}
+        exact_classes = [exact_ids.setdefault(s, len(exact_ids)) for s in token_strs]
+        stripped_classes = [
+            stripped_ids.setdefault(s.strip(), len(stripped_ids)) for s in token_strs
+        ]
+        case_classes = [
+            case_ids.setdefault(s.strip().lower(), len(case_ids)) for s in token_strs
+        ]
+        self.stripped_strs = list(stripped_ids)
+        self.case_strs = list(case_ids)
+        self._case_ids = case_ids
+        self.exact_classes = t.tensor(exact_classes)
+        self.stripped_classes = t.tensor(stripped_classes)
+        self.case_classes = t.tensor(case_classes)
+        self._allowed_translations: Dict[Tuple[int, str], AllowedTranslations] = {}
+        self._device_classes: Dict[str, Tuple[Tensor, Tensor, Tensor]] = {}
+
+    def classes(self, device: Union[str, t.device]) -> Tuple[Tensor, Tensor, Tensor]:
+        """Returns the exact, stripped and case class of every token on a device.
+
+        The copies are kept so that the classes are only moved to each device once.
+        """
+        key = str(t.device(device))
+        if key not in self._device_classes:
+            self._device_classes[key] = (
+                self.exact_classes.to(device),
+                self.stripped_classes.to(device),
+                self.case_classes.to(device),
+            )
+        return self._device_classes[key]
+
+    def same(
+        self,
+        toks_a: Int[Tensor, "..."],
+        toks_b: Int[Tensor, "..."],
+        exact_match: bool = False,
+    ) -> Bool[Tensor, "..."]:
+        """Checks whether pairs of tokens decode to the same string.
+
+        Args:
+            toks_a: The first token ids.
+            toks_b: The second token ids, of the same shape as toks_a.
+            exact_match: If True, compares the decoded strings exactly. If False,
+                compares them after strip().lower().
+
+        Returns:
+            A boolean tensor of the same shape as toks_a.
+        """
+        exact_classes, _, case_classes = self.classes(toks_a.device)
+        classes = exact_classes if exact_match else case_classes
+        return classes[toks_a] == classes[toks_b]
+
+    def allowed_translations(
+        self,
+        translations_dict: Dict[str, List[str]],
+        device: Union[str, t.device] = "cpu",
+    ) -> AllowedTranslations:
+        """Builds (or fetches) the allowed translations for a translations dictionary.
+
+        A prediction p (after strip()) is allowed for a source word if p, p + "s" or
+        p[:-1] is one of the source word's translations, as in mark_translation. The
+        table only depends on the dictionary's contents, so it is built once per
+        dictionary and device.
+
+        Args:
+            translations_dict: Maps normalised source words to their translations.
+            device: The device to put the table on.
+
+        Returns:
+            The AllowedTranslations for the dictionary.
+        """
+        fingerprint = hash(tuple((k, tuple(v)) for k, v in translations_dict.items()))
+        cpu_key, key = (fingerprint, "cpu"), (fingerprint, str(t.device(device)))
+        if cpu_key not in self._allowed_translations:
+            self._allowed_translations[cpu_key] = self._build_allowed_translations(
+                translations_dict
+            )
+        if key not in self._allowed_translations:
+            found, keys = self._allowed_translations[cpu_key]
+            self._allowed_translations[key] = AllowedTranslations(
+                found.to(device), keys.to(device)
+            )
+        return self._allowed_translations[key]
+
+    def _build_allowed_translations(
+        self, translations_dict: Dict[str, List[str]]
+    ) -> AllowedTranslations:
+        found = t.zeros(len(self.case_strs), dtype=t.bool)
+        # maps each allowed translation to the case classes of the words it translates
+        case_classes_by_translation: Dict[str, List[int]] = {}
+        for source, translations in translations_dict.items():
+            case_class = self._case_ids.get(source)
+            if case_class is None:
+                continue
+            found[case_class] = True
+            for translation in translations:
+                case_classes_by_translation.setdefault(translation, []).append(
+                    case_class
+                )
+        n_stripped = len(self.stripped_strs)
+        keys = set()
+        for stripped_class, pred_str in enumerate(self.stripped_strs):
+            for candidate in {pred_str, pred_str + "s", pred_str[:-1]}:
+                for case_class in case_classes_by_translation.get(candidate, ()):
+                    keys.add(case_class * n_stripped + stripped_class)
+        return AllowedTranslations(found, t.tensor(sorted(keys), dtype=t.long))
+
+    def mark(
+        self,
+        src_toks: Int[Tensor, "..."],
+        pred_toks: Int[Tensor, "..."],
+        allowed: AllowedTranslations,
+    ) -> Tuple[Bool[Tensor, "..."], Bool[Tensor, "..."]]:
+        """Marks predicted tokens against the allowed translations of source tokens.
+
+        Args:
+            src_toks: The source token ids.
+            pred_toks: The predicted token ids, of the same shape as src_toks.
+            allowed: The AllowedTranslations from allowed_translations, on the same
+                device as the tokens.
+
+        Returns:
+            A tuple of whether each source word is in the translations dictionary and
+            whether each prediction is an allowed translation of it.
+        """
+        _, stripped_classes, case_classes = self.classes(src_toks.device)
+        case_classes = case_classes[src_toks]
+        stripped_classes = stripped_classes[pred_toks]
+        found = allowed.found[case_classes]
+        if allowed.keys.numel() == 0:
+            return found, t.zeros_like(found)
+        keys = case_classes * len(self.stripped_strs) + stripped_classes
+        idx = t.searchsorted(allowed.keys, keys).clamp(max=allowed.keys.numel() - 1)
+        return found, allowed.keys[idx] == keys
+
+
+# maps tokenizers to their TokenClasses by d_vocab
+_token_classes: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def get_token_classes(tokenizer: PreTrainedTokenizerBase, d_vocab: int) -> TokenClasses:
+    """Returns the TokenClasses of a tokenizer, decoding its vocabulary at most once.
+
+    Args:
+        tokenizer: The tokenizer to build the classes for.
+        d_vocab: The size of the logits the token ids come from. This can be larger
+            than the tokenizer's vocabulary (the unembedding is often padded), in which
+            case the extra ids decode to empty strings.
+
+    Returns:
+        The TokenClasses for the tokenizer.
+    """
+    classes_by_d_vocab = _token_classes.setdefault(tokenizer, {})
+    if d_vocab not in classes_by_d_vocab:
+        n_tokens = min(len(tokenizer), d_vocab)
+        token_strs = tokenizer.batch_decode([[tok] for tok in range(n_tokens)])
+        token_strs += [""] * (d_vocab - n_tokens)
+        classes_by_d_vocab[d_vocab] = TokenClasses(token_strs)
+    return classes_by_d_vocab[d_vocab]
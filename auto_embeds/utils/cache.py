@@ -1,14 +1,124 @@
+import hashlib
+import inspect
 import os
+import time
+import weakref
 from functools import wraps
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Union
 
 from joblib import Memory
 
+from auto_embeds.utils.logging import logger
+
 # Retrieve the cache directory from the environment variable or use '/tmp' as default.
 cachedir = os.getenv("AUTOEMBEDS_CACHE_DIR", "/tmp")
 memory = Memory(cachedir, verbose=0)
 
 
-def auto_embeds_cache(func):
+class FingerprintedList(list):
+    """A list carrying a precomputed cache fingerprint of its contents.
+
+    auto_embeds_cache uses the fingerprint in place of the list when computing cache
+    keys, e.g. the hash of the file a dataset was loaded from, so that large lists do
+    not have to be hashed on every call. The list must not be modified after creation.
+    """
+
+    def __init__(self, iterable, cache_fingerprint: str):
+        super().__init__(iterable)
+        self.cache_fingerprint = cache_fingerprint
+
+
+# maps (path, mtime, size) of files to the sha1 of their contents
+_file_fingerprints: Dict[Any, str] = {}
+
+
+def file_fingerprint(path: Union[str, Path]) -> str:
+    """Returns the sha1 of a file's contents.
+
+    The hashes are memoized by the file's path, modification time and size, so hashing
+    the same unchanged file again is free.
+
+    Args:
+        path: The path to the file.
+
+    Returns:
+        The hex digest of the sha1 of the file.
+    """
+    path = Path(path).resolve()
+    stat = path.stat()
+    key = (str(path), stat.st_mtime_ns, stat.st_size)
+    if key not in _file_fingerprints:
+        _file_fingerprints[key] = hashlib.sha1(path.read_bytes()).hexdigest()
+    return _file_fingerprints[key]
+
+
+# maps tokenizers to their fingerprints
+_tokenizer_fingerprints: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def tokenizer_fingerprint(tokenizer: Any) -> str:
+    """Returns a fingerprint of a tokenizer: its class, name and a hash of its vocab.
+
+    The fingerprint is memoized per tokenizer object, so the vocabulary is only hashed
+    once.
+
+    Args:
+        tokenizer: A PreTrainedTokenizerBase instance.
+
+    Returns:
+        A string identifying the tokenizer.
+    """
+    if tokenizer not in _tokenizer_fingerprints:
+        vocab_hash = hashlib.sha1()
+        for token, token_id in sorted(tokenizer.get_vocab().items()):
+            vocab_hash.update(f"{token_id}:{token}\0".encode("utf-8", "surrogatepass"))
+        _tokenizer_fingerprints[tokenizer] = (
+            f"{type(tokenizer).__name__}:{tokenizer.name_or_path}:"
+            f"{vocab_hash.hexdigest()}"
+        )
+    return _tokenizer_fingerprints[tokenizer]
+
+
+def cache_key_value(value: Any) -> Any:
+    """Replaces an argument by a cheap to hash stand-in for computing cache keys.
+
+    Tokenizers are replaced by their tokenizer_fingerprint and objects with a
+    cache_fingerprint attribute (e.g. a FingerprintedList) by that fingerprint. All
+    other values are returned unchanged and hashed by joblib.
+    """
+    if hasattr(value, "cache_fingerprint"):
+        return ("fingerprint", value.cache_fingerprint)
+    # imported lazily as transformers is slow to import
+    from transformers import PreTrainedTokenizerBase
+
+    if isinstance(value, PreTrainedTokenizerBase):
+        return ("tokenizer", tokenizer_fingerprint(value))
+    return value
+
+
+def default_cache_key(func: Callable) -> Callable[..., Dict[str, Any]]:
+    """Returns the default key function of auto_embeds_cache for a function.
+
+    The key function binds the arguments to the function's signature, so positional,
+    keyword and default arguments give the same key, and replaces each value using
+    cache_key_value.
+    """
+    signature = inspect.signature(func)
+
+    def key_fn(*args, **kwargs) -> Dict[str, Any]:
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        return {name: cache_key_value(value) for name, value in bound.arguments.items()}
+
+    return key_fn
+
+
+def auto_embeds_cache(
+    func: Optional[Callable] = None,
+    *,
+    key_fn: Optional[Callable[..., Any]] = None,
+):
     """
     A decorator that caches the outputs of the decorated function in a directory
     named after the function itself. This caching mechanism is useful for functions
@@ -18,18 +128,31 @@ def auto_embeds_cache(func):
     or defaults to '/tmp' if the variable is not set. Each function's cache is stored
     in a subdirectory under this path, named after the function.
 
+    Cache entries are keyed by key_fn(*args, **kwargs) (plus the function's source, so
+    editing the function invalidates its cache) rather than by the raw arguments, so
+    only the (small) key is hashed on every call. The default key function normalises
+    the arguments against the function's signature and replaces tokenizers by their
+    fingerprint and FingerprintedLists by theirs, see default_cache_key.
+
     Usage:
         @auto_embeds_cache
         def expensive_function(param1, param2):
             # Function implementation
             return computation_result
 
+        @auto_embeds_cache(key_fn=lambda path, **kwargs: file_fingerprint(path))
+        def parse_file(path, verbose=False):
+            ...
+
         # Call the function, result is computed and cached
         result = expensive_function(1, 2)
 
         # Clear the cache for this specific function
         expensive_function.clear_cache()
 
+        # Cache hits, misses and time spent looking up / computing results
+        expensive_function.cache_info()
+
     Attributes:
         None
 
@@ -37,16 +160,63 @@ def auto_embeds_cache(func):
         CachedFunction: A callable that behaves like the original function but caches
         its results.
     """
+    if func is None:
+        return lambda func: auto_embeds_cache(func, key_fn=key_fn)
 
     cachedir = os.path.join(os.getenv("AUTOEMBEDS_CACHE_DIR", "/tmp"), func.__name__)
     memory = Memory(cachedir, verbose=0)
 
     if os.getenv("AUTOEMBEDS_CACHING", "true").lower() == "true":
-        cached_func = memory.cache(func)
+        make_key = key_fn if key_fn is not None else default_cache_key(func)
+        try:
+            source_hash = hashlib.sha1(inspect.getsource(func).encode()).hexdigest()
+        except (OSError, TypeError):
+            source_hash = None
+
+        def cached_call(cache_key, source_hash, compute):
+            return compute()
+
+        cached_call.__name__ = cached_call.__qualname__ = func.__name__
+        cached_call.__module__ = func.__module__
+        cached_func = memory.cache(cached_call, ignore=["compute"])
 
         class CachedFunction:
+            def __init__(self):
+                self.hits = 0
+                self.misses = 0
+                self.key_time = 0.0
+                self.call_time = 0.0
+                wraps(func)(self)
+
             def __call__(self, *args, **kwargs):
-                return cached_func(*args, **kwargs)
+                start = time.perf_counter()
+                cache_key = make_key(*args, **kwargs)
+                key_done = time.perf_counter()
+                hit = cached_func.check_call_in_cache(cache_key, source_hash, None)
+                result = cached_func(
+                    cache_key, source_hash, lambda: func(*args, **kwargs)
+                )
+                end = time.perf_counter()
+                self.key_time += key_done - start
+                self.call_time += end - key_done
+                if hit:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                logger.debug(
+                    f"{func.__name__} cache {'hit' if hit else 'miss'}: key "
+                    f"{(key_done - start) * 1000:.1f}ms, "
+                    f"call {(end - key_done) * 1000:.1f}ms"
+                )
+                return result
+
+            def cache_info(self) -> Dict[str, Union[int, float]]:
+                return {
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "key_time": self.key_time,
+                    "call_time": self.call_time,
+                }
 
             def clear_cache(self):
                 memory.clear(warn=False)
@@ -0,0 +1,340 @@
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Literal,
+    NamedTuple,
+    Optional,
+    Union,
+)
+
+import torch as t
+
+from auto_embeds.utils.logging import logger
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def current_rss() -> Optional[int]:
+    """Returns the resident set size of this process in bytes, if it can be read."""
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def max_rss() -> Optional[int]:
+    """Returns the peak resident set size of this process so far in bytes."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+class SpanRecord(NamedTuple):
+    """The measurements of one finished span.
+
+    Attributes:
+        name: The name of the span.
+        start: The wall clock time the span started at, in seconds since the epoch.
+        duration: The wall time of the span in seconds.
+        depth: The number of spans the span was nested in.
+        pid: The pid of the process the span ran in.
+        rss_start: The resident set size at the start of the span in bytes.
+        rss_end: The resident set size at the end of the span in bytes.
+        max_rss: The peak resident set size of the process up to the end of the span
+            in bytes, so a span that raised it raised the process' high-water mark.
+        peak_allocated: The peak memory allocated by torch's cuda caching allocator
+            during the span in bytes, or None if cuda is not in use.
+        attributes: Any extra attributes given when the span was opened.
+    """
+
+    name: str
+    start: float
+    duration: float
+    depth: int
+    pid: int
+    rss_start: Optional[int]
+    rss_end: Optional[int]
+    max_rss: Optional[int]
+    peak_allocated: Optional[int]
+    attributes: Dict[str, Any]
+
+    def to_chrome_event(self) -> Dict[str, Any]:
+        """Returns the span as a complete event of the Chrome trace event format."""
+        return {
+            "name": self.name,
+            "ph": "X",
+            "ts": self.start * 1e6,
+            "dur": self.duration * 1e6,
+            "pid": self.pid,
+            "tid": 0,
+            "args": {
+                "rss_start": self.rss_start,
+                "rss_end": self.rss_end,
+                "max_rss": self.max_rss,
+                "peak_allocated": self.peak_allocated,
+                **self.attributes,
+            },
+        }
+
+
+class _OpenSpan:
+    def __init__(self):
+        self.peak_allocated: Optional[int] = None
+
+
+class Instrumentation:
+    """Records the wall time and memory use of named spans of code.
+
+    Spans are opened with span (or the module level span and instrumented once this
+    is made current with instrument) and may be nested. Each span costs a couple of
+    clock and /proc reads, so spans are meant for coarse stages rather than inner
+    loops. Finished spans are kept in records and, if a trace_path is given, appended
+    to it as they finish, either as JSON lines or as Chrome trace events (an
+    unterminated JSON array, which chrome://tracing and Perfetto accept), so several
+    runs or sweep worker processes can share one trace file.
+
+    When cuda is in use, the peak memory of torch's allocator is tracked per span by
+    resetting the peak statistics at the start of every span and folding the peak so
+    far into the enclosing span first, so nested spans do not hide each other's peaks.
+    The spans also synchronize cuda so that their wall times include the kernels
+    launched within them.
+
+    Args:
+        trace_path: The file to append finished spans to, if any.
+        trace_format: "jsonl" to write one SpanRecord per line or "chrome" to write
+            Chrome trace events.
+    """
+
+    def __init__(
+        self,
+        trace_path: Optional[Union[str, Path]] = None,
+        trace_format: Literal["jsonl", "chrome"] = "jsonl",
+    ):
+        if trace_format not in {"jsonl", "chrome"}:
+            raise ValueError(f"Unsupported trace format: {trace_format}")
+        self.trace_path = Path(trace_path) if trace_path is not None else None
+        self.trace_format = trace_format
+        self.records: List[SpanRecord] = []
+        self._stack: List[_OpenSpan] = []
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Dict[str, Any]]:
+        """Measures the code run within the context as a span.
+
+        Args:
+            name: The name of the span.
+            **attributes: Extra attributes to record with the span.
+
+        Yields:
+            The attributes of the span, which can be added to within the context.
+        """
+        cuda = t.cuda.is_available() and t.cuda.is_initialized()
+        open_span = _OpenSpan()
+        if cuda:
+            t.cuda.synchronize()
+            if self._stack:
+                parent = self._stack[-1]
+                parent.peak_allocated = max(
+                    parent.peak_allocated or 0, t.cuda.max_memory_allocated()
+                )
+            t.cuda.reset_peak_memory_stats()
+            open_span.peak_allocated = t.cuda.memory_allocated()
+        self._stack.append(open_span)
+        rss_start = current_rss()
+        wall_start = time.time()
+        start = time.perf_counter()
+        try:
+            yield attributes
+        finally:
+            if cuda:
+                t.cuda.synchronize()
+            duration = time.perf_counter() - start
+            self._stack.pop()
+            if cuda:
+                open_span.peak_allocated = max(
+                    open_span.peak_allocated or 0, t.cuda.max_memory_allocated()
+                )
+                if self._stack:
+                    parent = self._stack[-1]
+                    parent.peak_allocated = max(
+                        parent.peak_allocated or 0, open_span.peak_allocated
+                    )
+            record = SpanRecord(
+                name=name,
+                start=wall_start,
+                duration=duration,
+                depth=len(self._stack),
+                pid=os.getpid(),
+                rss_start=rss_start,
+                rss_end=current_rss(),
+                max_rss=max_rss(),
+                peak_allocated=open_span.peak_allocated,
+                attributes=attributes,
+            )
+            self.records.append(record)
+            if self.trace_path is not None:
+                self._append_to_trace(record)
+
+    def _append_to_trace(self, record: SpanRecord) -> None:
+        self.trace_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.trace_path, "a") as file:
+            if self.trace_format == "jsonl":
+                file.write(json.dumps(record._asdict(), default=str) + "\n")
+            else:
+                if file.tell() == 0:
+                    file.write("[\n")
+                event = json.dumps(record.to_chrome_event(), default=str)
+                file.write(event + ",\n")
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """Aggregates the records by span name.
+
+        Returns:
+            Maps each span name, in the order the spans first finished, to its count,
+            total and max duration in seconds, peak max_rss and peak_allocated.
+        """
+        summary: Dict[str, Dict[str, Any]] = {}
+        for record in self.records:
+            stats = summary.setdefault(
+                record.name,
+                {
+                    "count": 0,
+                    "total_duration": 0.0,
+                    "max_duration": 0.0,
+                    "max_rss": None,
+                    "peak_allocated": None,
+                },
+            )
+            stats["count"] += 1
+            stats["total_duration"] += record.duration
+            stats["max_duration"] = max(stats["max_duration"], record.duration)
+            for key in ["max_rss", "peak_allocated"]:
+                value = getattr(record, key)
+                if value is not None:
+                    stats[key] = max(stats[key] or 0, value)
+        return summary
+
+    def log_summary(self) -> None:
+        """Logs the summary, the spans taking the most time first."""
+        summary = sorted(
+            self.summary().items(), key=lambda item: -item[1]["total_duration"]
+        )
+        for name, stats in summary:
+            logger.info(
+                f"{name}: {stats['total_duration']:.3f}s over {stats['count']} "
+                f"span(s), max rss {(stats['max_rss'] or 0) / 1024**2:.0f}MiB"
+            )
+
+    def log_to_neptune(self, neptune_run: Any, namespace: str = "instrumentation"):
+        """Attaches the summary and the records to a Neptune run.
+
+        Args:
+            neptune_run: The Neptune run to log to.
+            namespace: The namespace in the run to log under.
+        """
+        from neptune.types import File
+
+        # neptune does not support None values, e.g. peak_allocated on the cpu
+        neptune_run[f"{namespace}/summary"] = {
+            name: {key: value for key, value in stats.items() if value is not None}
+            for name, stats in self.summary().items()
+        }
+        records = "\n".join(
+            json.dumps(record._asdict(), default=str) for record in self.records
+        )
+        neptune_run[f"{namespace}/spans"].upload(
+            File.from_content(records, extension="jsonl")
+        )
+
+
+# the instrumentation the module level span and instrumented record to, if any
+_current: Optional[Instrumentation] = None
+
+
+def get_instrumentation() -> Optional[Instrumentation]:
+    """Returns the current instrumentation, or None if spans are not recorded."""
+    return _current
+
+
+@contextmanager
+def instrument(
+    instrumentation: Optional[Instrumentation],
+) -> Iterator[Optional[Instrumentation]]:
+    """Makes an instrumentation current within the context.
+
+    Args:
+        instrumentation: The instrumentation to record spans to, or None to not
+            record spans.
+
+    Yields:
+        The instrumentation.
+    """
+    global _current
+    previous = _current
+    _current = instrumentation
+    try:
+        yield instrumentation
+    finally:
+        _current = previous
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Dict[str, Any]]:
+    """Measures the code run within the context as a span of the current
+    instrumentation. Without a current instrumentation nothing is measured.
+
+    Args:
+        name: The name of the span.
+        **attributes: Extra attributes to record with the span.
+
+    Yields:
+        The attributes of the span, which can be added to within the context.
+    """
+    if _current is None:
+        yield attributes
+    else:
+        with _current.span(name, **attributes) as span_attributes:
+            yield span_attributes
+
+
+def instrumented(name: Optional[str] = None) -> Callable[[Callable], Callable]:
+    """Decorates a function to measure each call as a span.
+
+    Args:
+        name: The name of the spans, defaults to the name of the function.
+
+    Returns:
+        The decorator.
+    """
+
+    def decorator(func: Callable) -> Callable:
+        span_name = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current is None:
+                return func(*args, **kwargs)
+            with _current.span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
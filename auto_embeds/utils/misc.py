@@ -1,6 +1,9 @@
 import argparse
+import copy
 import os
 import pickle
+import shutil
+import tempfile
 from contextlib import contextmanager
 from datetime import datetime
 from functools import reduce
@@ -56,6 +59,38 @@ def load_cache(folder_name: str, filename: str) -> Dict[Any, Any]:
         return pickle.load(f)
 
 
+@contextmanager
+def atomic_directory(directory: Union[str, Path]) -> Iterator[Path]:
+    """Writes the files of a directory so that they appear all at once.
+
+    The files are written to a new temporary directory next to directory, which is
+    renamed to directory on leaving the context. Readers therefore never see a partial
+    directory, and files that other processes have memory-mapped are never truncated
+    under them. If the directory already exists (e.g. as another process wrote it
+    first), it is kept and the temporary directory is discarded.
+
+    Args:
+        directory: The directory to write.
+
+    Yields:
+        The temporary directory to write the files to.
+    """
+    directory = Path(directory)
+    directory.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(prefix=f".{directory.name}.", dir=directory.parent))
+    try:
+        yield tmp_dir
+        try:
+            os.replace(tmp_dir, directory)
+        except OSError:
+            # renaming onto a directory that is not empty fails
+            if not directory.exists():
+                raise
+            logger.debug(f"{directory} was already written, keeping it")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
 @contextmanager
 def remove_hooks() -> Iterator[Set[RemovableHandle]]:
     handles: Set[RemovableHandle] = set()
@@ -156,8 +191,10 @@ def get_experiment_worker_config(
                              made.
 
     Returns:
-        dict: A subset of the configuration based on the provided arguments.
+        dict: A subset of the configuration based on the provided arguments. This is
+            a copy, the passed configuration is left unchanged.
     """
+    experiment_config = copy.deepcopy(experiment_config)
     # Add "test" or "actual" tag to neptune configuration based on worker_id
     tag = "test" if worker_id == 0 else "actual"
     experiment_config["neptune"]["tags"].append(tag)
@@ -1,27 +1,210 @@
+import hashlib
 import json
-import os
-from typing import List, Tuple
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import neptune
 import pandas as pd
+import requests
+from neptune.exceptions import (
+    InternalServerError,
+    MissingFieldException,
+    NeptuneConnectionLostException,
+)
 from tqdm.auto import tqdm
 
-from auto_embeds.utils.cache import auto_embeds_cache
 from auto_embeds.utils.logging import logger
 
+# the json artifacts every run of run_experiment uploads under results/test/json/
+ARTIFACT_TYPES = ["cos_sims_trend_plot", "test_cos_sim_diff", "verify_results"]
 
-def download_artifact(run, run_id, artifact_name):
-    destination = f"neptune_artifact_downloads/{run_id}-{artifact_name}"
-    run[f"results/test/json/{artifact_name}"].download(
-        destination=destination,
-        progress_bar=False,
+# the errors of calls to neptune that are worth retrying, other errors (e.g. a run
+# that never uploaded an artifact) fail straight away
+TRANSIENT_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    NeptuneConnectionLostException,
+    InternalServerError,
+)
+
+
+def _read_complete_artifact(path: Path) -> Optional[str]:
+    """Returns the contents of a downloaded artifact if its download completed.
+
+    An artifact counts as complete if the .sha1 file written after its download
+    matches the size and sha1 of the file, so partial or corrupted downloads (e.g. of
+    an interrupted earlier call) are downloaded again.
+    """
+    checksum_path = path.with_name(path.name + ".sha1")
+    if not path.exists() or not checksum_path.exists():
+        return None
+    size, sha1 = checksum_path.read_text().split()
+    content = path.read_bytes()
+    if len(content) != int(size) or hashlib.sha1(content).hexdigest() != sha1:
+        return None
+    return content.decode()
+
+
+def _download_run_artifacts(
+    init_run: Callable[..., Any],
+    project_name: str,
+    run_id: str,
+    artifact_names: List[str],
+    directory: Path,
+    max_retries: int,
+    retry_delay: float,
+) -> Dict[str, Optional[str]]:
+    artifacts: Dict[str, Optional[str]] = {}
+    missing = []
+    for artifact_name in artifact_names:
+        path = directory / f"{run_id}-{artifact_name}"
+        artifacts[artifact_name] = _read_complete_artifact(path)
+        if artifacts[artifact_name] is None:
+            missing.append(artifact_name)
+    if not missing:
+        return artifacts
+
+    def with_retries(action: Callable[[], Any], description: str) -> Any:
+        for attempt in range(max_retries + 1):
+            try:
+                return action()
+            except TRANSIENT_ERRORS as e:
+                if attempt == max_retries:
+                    raise
+                delay = retry_delay * 2**attempt
+                logger.warning(
+                    f"{description} failed ({e}), retrying in {delay:.1f}s "
+                    f"({attempt + 1}/{max_retries})"
+                )
+                time.sleep(delay)
+
+    # one read-only run handle is shared by all the artifacts of the run
+    run = with_retries(
+        lambda: init_run(project=project_name, with_id=run_id, mode="read-only"),
+        f"opening run {run_id}",
     )
-    with open(destination, "r") as file:
-        artifact = file.read()
-    return artifact
+    try:
+        for artifact_name in missing:
+            path = directory / f"{run_id}-{artifact_name}"
+            # neptune only downloads files to disk, so the file is downloaded to a
+            # temporary path and read back once, then kept as the resumable copy
+            part_path = path.with_name(path.name + ".part")
+
+            def download() -> bytes:
+                run[f"results/test/json/{artifact_name}"].download(
+                    destination=str(part_path), progress_bar=False
+                )
+                return part_path.read_bytes()
+
+            try:
+                content = with_retries(download, f"downloading {path.name}")
+            except Exception as e:
+                logger.error(f"could not download {path.name}: {e}")
+                continue
+            part_path.replace(path)
+            checksum = f"{len(content)} {hashlib.sha1(content).hexdigest()}"
+            path.with_name(path.name + ".sha1").write_text(checksum)
+            artifacts[artifact_name] = content.decode()
+    finally:
+        run.stop()
+    return artifacts
+
+
+def download_artifacts(
+    project_name: str,
+    run_ids: List[str],
+    artifact_names: List[str] = ARTIFACT_TYPES,
+    directory: Union[str, Path] = "neptune_artifact_downloads",
+    max_workers: int = 8,
+    max_retries: int = 3,
+    retry_delay: float = 1.0,
+    init_run: Optional[Callable[..., Any]] = None,
+) -> Dict[str, List[Optional[str]]]:
+    """Downloads the json artifacts of runs concurrently.
+
+    The runs are downloaded by a pool of max_workers threads, each opening the run
+    once for all of its artifacts. Calls failing with one of TRANSIENT_ERRORS are
+    retried with exponential backoff, other errors are not retried.
+    Every downloaded artifact is kept in directory together with the size and sha1 of
+    its contents, so artifacts completed by an earlier (possibly interrupted) call are
+    read from disk instead of being downloaded again.
+
+    Args:
+        project_name: The name of the project in neptune the runs belong to.
+        run_ids: The sys/ids of the runs.
+        artifact_names: The names of the artifacts under results/test/json/.
+        directory: The directory the artifacts are kept in.
+        max_workers: The maximum number of runs downloaded at the same time.
+        max_retries: The number of times a call failing transiently is retried.
+        retry_delay: The delay before the first retry in seconds, doubled on every
+            further retry.
+        init_run: Opens a run, called like neptune.init_run(project=..., with_id=...,
+            mode="read-only"). Defaults to neptune.init_run.
+
+    Returns:
+        Maps each artifact name to its contents for every run, in the order of
+        run_ids, or None for artifacts that could not be downloaded.
+    """
+    init_run = init_run if init_run is not None else neptune.init_run
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    results: Dict[str, Dict[str, Optional[str]]] = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                _download_run_artifacts,
+                init_run,
+                project_name,
+                run_id,
+                artifact_names,
+                directory,
+                max_retries,
+                retry_delay,
+            ): run_id
+            for run_id in run_ids
+        }
+        for future in tqdm(
+            as_completed(futures),
+            total=len(futures),
+            desc="Downloading artifacts",
+            unit="run",
+        ):
+            run_id = futures[future]
+            try:
+                results[run_id] = future.result()
+            except Exception as e:
+                logger.error(f"could not download the artifacts of run {run_id}: {e}")
+                results[run_id] = {name: None for name in artifact_names}
+    return {
+        name: [results[run_id][name] for run_id in run_ids] for name in artifact_names
+    }
+
+
+def fetch_neptune_id(run: Any, mode: str) -> Optional[str]:
+    """Returns the sys/id the Neptune server assigned to a run, if it has one.
+
+    Offline runs have no sys/id until they are synced and debug runs get ids like
+    OFFLINE-1 that every process reuses, so neither identifies a run.
+
+    Args:
+        run: The Neptune run.
+        mode: The mode the run was initialised with.
+
+    Returns:
+        The sys/id of the run, or None for offline and debug runs.
+    """
+    if mode in ("offline", "debug"):
+        return None
+    try:
+        return run["sys/id"].fetch()
+    except MissingFieldException:
+        return None
 
 
-@auto_embeds_cache
 def fetch_neptune_runs_df(
     project_name: str,
     tags: list,
@@ -30,11 +213,12 @@ def fetch_neptune_runs_df(
 ) -> pd.DataFrame:
     """
     Fetches runs data from a specified project filtered by tags and compiles a DataFrame
-    with run names, summaries, configurations, and histories. By default uses disk
-    caching to speed up repeated calls with the same arguments. This function now
+    with run names, summaries, configurations, and histories. This function now
     utilizes the Neptune API to directly fetch and filter runs based on system IDs,
     configurations, and results, and can optionally fetch artifacts related to the
-    'cos_sims_trend_plot'.
+    'cos_sims_trend_plot'. The runs table is fetched on every call, so it includes
+    runs added since, while the artifacts are downloaded with download_artifacts, which
+    reads those completed by earlier calls from disk and retries the missing ones.
 
     Args:
         project_name: The name of the project in neptune to fetch runs from.
@@ -56,32 +240,16 @@ def fetch_neptune_runs_df(
     df = project.fetch_runs_table(tag=tags).to_pandas()
     df = df.filter(regex="|".join(["sys/id", "config", "results"]))
 
-    artifact_types = ["cos_sims_trend_plot", "test_cos_sim_diff", "verify_results"]
     if get_artifacts:
-        artifacts_data = {
-            f"results/test/json/{artifact}": [] for artifact in artifact_types
-        }
-
-        pbar = tqdm(df["sys/id"].to_list(), desc="Downloading artifacts", unit="run")
-        for run_id in pbar:
-            run = neptune.init_run(
-                project=project_name,
-                with_id=run_id,
-                mode="read-only",
-            )
-            os.makedirs("neptune_artifact_downloads", exist_ok=True)
-            for artifact in artifact_types:
-                artifacts_data[f"results/test/json/{artifact}"].append(
-                    download_artifact(run, run_id, artifact)
-                )
-            pbar.set_description(f"Downloading artifacts for run ID: {run_id}")
-        df = df.assign(**artifacts_data)
+        artifacts_data = download_artifacts(project_name, df["sys/id"].to_list())
     else:
-        artifacts_data = {
-            f"results/test/json/{artifact}": [None] * len(df)
-            for artifact in artifact_types
+        artifacts_data = {artifact: [None] * len(df) for artifact in ARTIFACT_TYPES}
+    df = df.assign(
+        **{
+            f"results/test/json/{artifact}": contents
+            for artifact, contents in artifacts_data.items()
         }
-        df = df.assign(**artifacts_data)
+    )
 
     return df
 
@@ -170,7 +338,12 @@ def process_neptune_runs_df(
     config_columns = [col.split("/", 1)[1] for col in config_columns]
     result_columns = [col.split("/", 1)[1] for col in result_columns]
 
-    df = df.assign(run_id=df["sys/id"])
+    run_ids = df["sys/id"]
+    # runs of the results store that were never logged to the neptune server have no
+    # sys/id, so they are identified by their store id instead
+    if "sys/store_id" in df.columns:
+        run_ids = run_ids.fillna(df["sys/store_id"])
+    df = df.assign(run_id=run_ids)
 
     # rename dataset/name to dataset in both the df and config_columns list
     df = df.rename(columns={"dataset/name": "dataset"})
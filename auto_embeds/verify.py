@@ -1,5 +1,18 @@
 import random
-from typing import Any, Dict, List, Literal, Optional, Tuple, Union, overload
+import weakref
+from collections.abc import Sequence
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Literal,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+    overload,
+)
 
 import numpy as np
 import pandas as pd
@@ -7,6 +20,7 @@ import plotly.express as px
 import plotly.graph_objs as go
 import torch as t
 import torch.nn as nn
+from jaxtyping import Float, Int
 from plotly.graph_objects import Figure
 from rich.table import Table
 from scipy import stats
@@ -16,18 +30,170 @@ from transformers import PreTrainedTokenizerBase
 
 from auto_embeds.data import (
     ExtendedWordData,
+    FastTensorLoader,
     VerifyWordPairAnalysis,
     WordCategory,
     WordData,
     tokenize_word_pairs,
 )
+from auto_embeds.modules import unembed_argmax
+from auto_embeds.utils.instrument import instrumented
 from auto_embeds.utils.logging import logger
 from auto_embeds.utils.misc import (
     calc_gradient_color,
     default_device,
 )
+from auto_embeds.vocab_index import VocabIndex, get_vocab_index
+
+
+class VerifyDataset(TensorDataset):
+    """A TensorDataset of (source, target) embedding pairs that caches their tokens.
+
+    The most likely token of the source and target embeddings only depends on the
+    dataset and the unembedding, not on the transformation being evaluated, so
+    argmax_toks computes them once per unembedding module and keeps them alongside
+    the embeddings. Iterating over a DataLoader of a VerifyDataset with
+    iter_verify_batches then only has to unembed the predictions.
+
+    Args:
+        src_embeds: The source embeddings of shape [batch, pos, d_model].
+        tgt_embeds: The target embeddings of shape [batch, pos, d_model].
+    """
+
+    def __init__(
+        self,
+        src_embeds: Float[Tensor, "batch pos d_model"],
+        tgt_embeds: Float[Tensor, "batch pos d_model"],
+    ):
+        super().__init__(src_embeds, tgt_embeds)
+        # maps unembedding modules to their argmax tokens and, by tokenizer, strings
+        self._argmax_cache: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # the cache is keyed by modules, so it is not pickled
+        state = self.__dict__.copy()
+        del state["_argmax_cache"]
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._argmax_cache = weakref.WeakKeyDictionary()
+
+    @t.no_grad()
+    def argmax_toks(
+        self, unembed_module: nn.Module, batch_size: int = 1024
+    ) -> Tuple[Int[Tensor, "batch pos"], Int[Tensor, "batch pos"]]:
+        """Returns the most likely token of every source and target embedding.
+
+        Args:
+            unembed_module: The module used for unembedding.
+            batch_size: The number of embeddings unembedded at a time.
+
+        Returns:
+            A tuple of the source and target token ids.
+        """
+        if unembed_module not in self._argmax_cache:
+            src_embeds, tgt_embeds = self.tensors
+            toks = tuple(
+                t.cat(
+                    [
+                        unembed_argmax(unembed_module, embeds[i : i + batch_size])[0]
+                        for i in range(0, len(embeds), batch_size)
+                    ]
+                )
+                for embeds in (src_embeds, tgt_embeds)
+            )
+            self._argmax_cache[unembed_module] = (toks, weakref.WeakKeyDictionary())
+        return self._argmax_cache[unembed_module][0]
+
+    def argmax_strs(
+        self, tokenizer: PreTrainedTokenizerBase, unembed_module: nn.Module
+    ) -> Tuple[List[str], List[str]]:
+        """Returns the decoded argmax_toks of every source and target embedding."""
+        src_toks, tgt_toks = self.argmax_toks(unembed_module)
+        strs = self._argmax_cache[unembed_module][1]
+        if tokenizer not in strs:
+            strs[tokenizer] = (
+                tokenizer.batch_decode(src_toks),
+                tokenizer.batch_decode(tgt_toks),
+            )
+        return strs[tokenizer]
 
 
+class VerifyBatch(NamedTuple):
+    """A batch of iter_verify_batches.
+
+    Attributes:
+        src_embeds: The source embeddings of the batch.
+        tgt_embeds: The target embeddings of the batch.
+        src_toks: The most likely token of each source embedding.
+        tgt_toks: The most likely token of each target embedding.
+        indices: The indices of the batch in a VerifyDataset, as a slice or a tensor of
+            indices, None for other datasets.
+    """
+
+    src_embeds: Tensor
+    tgt_embeds: Tensor
+    src_toks: Tensor
+    tgt_toks: Tensor
+    indices: Optional[Union[slice, Int[Tensor, "batch"]]]
+
+
+def iter_verify_batches(
+    loader: DataLoader[Tuple[Tensor, ...]],
+    unembed_module: nn.Module,
+    device: Optional[Union[str, t.device]] = default_device,
+) -> Iterator[VerifyBatch]:
+    """Iterates over the batches of a DataLoader together with their argmax tokens.
+
+    For a DataLoader of a VerifyDataset the tokens are the cached argmax_toks of the
+    dataset and the batches are indexed straight from its tensors using the loader's
+    batch indices (or batch sampler), so nothing but the predictions has to be
+    unembedded. For any other DataLoader both sides of every batch are unembedded.
+
+    Args:
+        loader: A DataLoader of (source, target) embedding pairs.
+        unembed_module: The module used for unembedding.
+        device: The device to move the embeddings to.
+
+    Yields:
+        A VerifyBatch for every batch of the loader.
+    """
+    dataset = loader.dataset
+    if isinstance(dataset, VerifyDataset) and (
+        isinstance(loader, FastTensorLoader) or loader.batch_sampler is not None
+    ):
+        src_toks, tgt_toks = dataset.argmax_toks(unembed_module)
+        src_embeds, tgt_embeds = dataset.tensors
+        if isinstance(loader, FastTensorLoader):
+            batch_indices = loader.batch_indices()
+        else:
+            batch_indices = (
+                t.tensor(list(indices), device=src_embeds.device)
+                for indices in loader.batch_sampler  # type: ignore
+            )
+        for indices in batch_indices:
+            yield VerifyBatch(
+                src_embeds[indices].to(device),
+                tgt_embeds[indices].to(device),
+                src_toks[indices].to(device),
+                tgt_toks[indices].to(device),
+                indices,
+            )
+        return
+    for src_embeds, tgt_embeds in loader:
+        src_embeds = src_embeds.to(device)
+        tgt_embeds = tgt_embeds.to(device)
+        yield VerifyBatch(
+            src_embeds,
+            tgt_embeds,
+            unembed_argmax(unembed_module, src_embeds)[0],
+            unembed_argmax(unembed_module, tgt_embeds)[0],
+            None,
+        )
+
+
+@instrumented()
 def verify_transform(
     tokenizer: PreTrainedTokenizerBase,
     transformation: nn.Module,
@@ -82,26 +248,31 @@ def verify_transform(
     }
     # for each batch in the test dataset
     with t.no_grad():
-        for en_embeds, fr_embeds in test_loader:
-            # we get the embeddings for the source and target language
-            en_embeds = en_embeds.to(device)
-            fr_embeds = fr_embeds.to(device)
-            en_logits = unembed_module(en_embeds)
-            en_strs: List[str] = tokenizer.batch_decode(
-                en_logits.squeeze().argmax(dim=-1)
-            )
-            fr_logits = unembed_module(fr_embeds)
-            fr_strs: List[str] = tokenizer.batch_decode(
-                fr_logits.squeeze().argmax(dim=-1)
+        # the source and target tokens only depend on the dataset, so for a
+        # VerifyDataset they are decoded once and cached
+        if isinstance(test_loader.dataset, VerifyDataset):
+            all_en_strs, all_fr_strs = test_loader.dataset.argmax_strs(
+                tokenizer, unembed_module
             )
+        for batch in iter_verify_batches(test_loader, unembed_module, device):
+            # we get the embeddings for the source and target language
+            en_embeds, fr_embeds = batch.src_embeds, batch.tgt_embeds
+            if isinstance(batch.indices, slice):
+                en_strs = all_en_strs[batch.indices]
+                fr_strs = all_fr_strs[batch.indices]
+            elif batch.indices is not None:
+                indices = batch.indices.tolist()
+                en_strs = [all_en_strs[i] for i in indices]
+                fr_strs = [all_fr_strs[i] for i in indices]
+            else:
+                en_strs = tokenizer.batch_decode(batch.src_toks)
+                fr_strs = tokenizer.batch_decode(batch.tgt_toks)
             # transform it using our learned rotation
             with t.no_grad():
                 top_pred_embeds = transformation(en_embeds)
             # get the top predicted tokens
-            top_pred_logits = unembed_module(top_pred_embeds)
-            top_pred_strs = tokenizer.batch_decode(
-                top_pred_logits.squeeze().argmax(dim=-1)
-            )
+            top_pred_toks, _ = unembed_argmax(unembed_module, top_pred_embeds)
+            top_pred_strs = tokenizer.batch_decode(top_pred_toks)
             top_pred_strs = [
                 item if isinstance(item, str) else item[0] for item in top_pred_strs
             ]
@@ -194,16 +365,96 @@ def verify_transform_table_from_dict(verify_results: Dict[str, Any]) -> Table:
     return table
 
 
+class ClosestEmbedDetails(Sequence[str]):
+    """Lazily formatted per-pair details for calc_tgt_is_closest_embed.
+
+    Holds the batched top-k results as tensors and only decodes tokens and formats the
+    detail string of a pair when that pair is accessed, so computing the summary for a
+    large dataset never pays for tokenizer.decode calls.
+
+    Args:
+        tokenizer: The tokenizer used to decode tokens.
+        src_toks: Source token ids of shape [n_pairs].
+        tgt_toks: Target token ids of shape [n_pairs].
+        top_toks: Token ids of the top-k closest embeddings of shape [n_pairs, k].
+        top_cos_sims: Cosine similarities of the top-k closest embeddings of shape
+            [n_pairs, k].
+    """
+
+    def __init__(
+        self,
+        tokenizer: PreTrainedTokenizerBase,
+        src_toks: Int[Tensor, "n_pairs"],
+        tgt_toks: Int[Tensor, "n_pairs"],
+        top_toks: Int[Tensor, "n_pairs k"],
+        top_cos_sims: Float[Tensor, "n_pairs k"],
+    ):
+        self.tokenizer = tokenizer
+        self.src_toks = src_toks.cpu()
+        self.tgt_toks = tgt_toks.cpu()
+        self.top_toks = top_toks.cpu()
+        self.top_cos_sims = top_cos_sims.cpu()
+
+    def __len__(self) -> int:
+        return self.src_toks.shape[0]
+
+    @overload
+    def __getitem__(self, idx: int) -> str: ...
+
+    @overload
+    def __getitem__(self, idx: slice) -> List[str]: ...
+
+    def __getitem__(self, idx: Union[int, slice]) -> Union[str, List[str]]:
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("ClosestEmbedDetails index out of range")
+
+        src_tok = self.src_toks[idx].item()
+        tgt_tok = self.tgt_toks[idx].item()
+        top_toks = self.top_toks[idx].tolist()
+        cos_sim_values = self.top_cos_sims[idx].tolist()
+        status = "Correct ✅ " if top_toks[0] == tgt_tok else "Incorrect ❌"
+
+        top_k_tokens = [
+            self.tokenizer.decode(token, skip_special_tokens=True) for token in top_toks
+        ]
+        top_k_details = "\n".join(
+            f"  {rank}. {token} (Cosine Similarity: {cos_sim:.4f})"
+            for rank, (token, cos_sim) in enumerate(zip(top_k_tokens, cos_sim_values))
+        )
+        return (
+            f"{idx+1} {status}\n"
+            f"Source Token: '{self.tokenizer.decode(src_tok)}'\n"
+            f"Target Token: '{self.tokenizer.decode(tgt_tok)}'\n"
+            f"Top {len(top_toks)} tokens with highest cosine similarity:\n"
+            f"{top_k_details}\n\n"
+        )
+
+
+@t.no_grad()
 def calc_tgt_is_closest_embed(
     tokenizer: PreTrainedTokenizerBase,
     all_word_pairs: List[List[str]],
     embed_module: nn.Module,
     device: Union[str, t.device] = default_device,
-) -> Dict[str, Union[str, List[str]]]:
+    top_k: int = 5,
+    max_chunk_elements: int = 2**24,
+) -> Dict[str, Union[str, ClosestEmbedDetails]]:
     """Calculates the percentage of target tokens in top closest.
 
     Calculates the percentage of instances where the target language token is within
-    the top 1 and top 5 closest tokens in terms of cosine similarity.
+    the top 1 and top k closest tokens in terms of cosine similarity, where the
+    candidates are every source and target token in all_word_pairs apart from the
+    source token itself.
+
+    All embeddings are computed and normalised once. The similarities are then computed
+    as a single matmul per chunk of source tokens, with the number of source tokens per
+    chunk chosen so that the [chunk, 2 * n_pairs] similarity block stays within
+    max_chunk_elements. Self-matches are masked out by token id and the top k is taken
+    for the whole chunk at once, so memory stays bounded for any number of pairs.
 
     Args:
         tokenizer: A PreTrainedTokenizerBase instance used for tokenizing texts.
@@ -211,86 +462,55 @@ def calc_tgt_is_closest_embed(
         embed_module: The embedding module used to get embeddings of tokens.
         device: The device on which to allocate tensors. If None, defaults to
             default_device
+        top_k: The number of closest tokens to consider. Defaults to 5.
+        max_chunk_elements: The maximum number of elements in each similarity block.
 
     Returns:
         A dictionary containing a summary of the results and detailed results for each
-        source token. Keys are ["summary"] and ["details"].
+        source token. Keys are ["summary"] and ["details"]. The details are a lazily
+        decoded sequence of strings, one per word pair.
     """
-
-    correct_count_top_5 = 0
-    correct_count_top_1 = 0
-    total_count = len(all_word_pairs)
-
-    details = []
-
-    src_toks, tgt_toks, _, _ = tokenize_word_pairs(tokenizer, all_word_pairs)
+    src_toks, tgt_toks, _, _ = tokenize_word_pairs(tokenizer, all_word_pairs, device)
+    if src_toks.shape[-1] != 1 or tgt_toks.shape[-1] != 1:
+        raise ValueError("calc_tgt_is_closest_embed expects single token word pairs.")
+    src_toks = src_toks.squeeze(-1)
+    tgt_toks = tgt_toks.squeeze(-1)
+    # shape [n_pairs]
 
     all_toks = t.cat([src_toks, tgt_toks], dim=0)
-    all_embeds = embed_module(all_toks)
-
-    for i, (src_tok, correct_tgt_tok) in enumerate(zip(src_toks, tgt_toks)):
-        # Embed the source token
-        src_embed = embed_module(src_tok.unsqueeze(0)).squeeze(0)
-        # shape [d_model]
-
-        # Exclude the current source token from other_toks and other_embeds to avoid
-        # self-matching
-        valid_indices = (all_toks != src_tok).squeeze(-1)
-        # the mask valid_indices should be of shape [batch]
-
-        valid_other_toks = all_toks[valid_indices]
-        valid_other_embeds = all_embeds[valid_indices].squeeze(1)
-        # should now both be of shape [batch]
-
-        # The cosine similarities between the source token and all the other tokens
-        cos_sims = t.cosine_similarity(src_embed, valid_other_embeds, dim=-1)
-
-        # Get the indices of the top 5 target tokens with the highest cosine similarity
-        # that is valid (i.e. not the same as the source language token)
-        top_5_indices = t.topk(cos_sims, 5).indices
-
-        # Check if the correct target token is among the top 5
-        is_correct_in_top_5 = correct_tgt_tok in valid_other_toks[top_5_indices]
-        is_correct_in_top_1 = correct_tgt_tok == valid_other_toks[top_5_indices[0]]
-
-        if is_correct_in_top_5:
-            correct_count_top_5 += 1
-
-        if is_correct_in_top_1:
-            correct_count_top_1 += 1
-            status = "Correct ✅ "
-        else:
-            status = "Incorrect ❌"
-
-        src_tok_str = tokenizer.decode(src_tok)
-        correct_tgt_tok_str = tokenizer.decode(correct_tgt_tok)
-        top_5_tokens = [
-            tokenizer.decode(valid_other_toks[index], skip_special_tokens=True)
-            for index in top_5_indices
-        ]
-        cos_sim_values = [cos_sims[index].item() for index in top_5_indices]
-        top_5_details = "\n".join(
-            f"  {rank}. {token} (Cosine Similarity: {cos_sim:.4f})"
-            for rank, (token, cos_sim) in enumerate(zip(top_5_tokens, cos_sim_values))
-        )
-        detail = (
-            f"{i+1} {status}\n"
-            f"Source Token: '{src_tok_str}'\n"
-            f"Target Token: '{correct_tgt_tok_str}'\n"
-            f"Top 5 tokens with highest cosine similarity:\n"
-            f"{top_5_details}\n\n"
-        )
-        details.append(detail)
-
-    # Calculate the percentage where the hypothesis holds true for top 5 and top 1
-    percentage_correct_top_1 = (correct_count_top_1 / total_count) * 100
-    percentage_correct_top_5 = (correct_count_top_5 / total_count) * 100
+    # shape [2 * n_pairs]
+    all_embeds = embed_module(all_toks.unsqueeze(-1)).squeeze(1)
+    all_embeds = nn.functional.normalize(all_embeds, dim=-1, eps=1e-8)
+    # shape [2 * n_pairs, d_model], the first n_pairs rows are the source embeddings
+    n_pairs = src_toks.shape[0]
+    chunk_size = max(1, max_chunk_elements // all_toks.shape[0])
+
+    top_cos_sims, top_toks = [], []
+    for start in range(0, n_pairs, chunk_size):
+        end = min(start + chunk_size, n_pairs)
+        chunk_toks = src_toks[start:end]
+        cos_sims = all_embeds[start:end] @ all_embeds.T
+        # shape [chunk, 2 * n_pairs]
+        # exclude the source token itself from the candidates to avoid self-matching
+        cos_sims.masked_fill_(chunk_toks.unsqueeze(-1) == all_toks, -float("inf"))
+        chunk_top = t.topk(cos_sims, top_k, dim=-1)
+        top_cos_sims.append(chunk_top.values)
+        top_toks.append(all_toks[chunk_top.indices])
+
+    top_cos_sims = t.cat(top_cos_sims)
+    top_toks = t.cat(top_toks)
+    # both shape [n_pairs, top_k]
+
+    is_tgt = top_toks == tgt_toks.unsqueeze(-1)
+    percentage_correct_top_1 = is_tgt[:, 0].float().mean().item() * 100
+    percentage_correct_top_k = is_tgt.any(dim=-1).float().mean().item() * 100
     summary = (
         f"Percentage where the hypothesis is true (correct translation is top 1): "
         f"{percentage_correct_top_1:.2f}%\n"
-        f"Percentage where the hypothesis is true (correct translation in top 5): "
-        f"{percentage_correct_top_5:.2f}%"
+        f"Percentage where the hypothesis is true (correct translation in top "
+        f"{top_k}): {percentage_correct_top_k:.2f}%"
     )
+    details = ClosestEmbedDetails(tokenizer, src_toks, tgt_toks, top_toks, top_cos_sims)
 
     return {"summary": summary, "details": details}
 
@@ -564,6 +784,7 @@ def test_cos_sim_difference(
 
 
 @t.no_grad()
+@instrumented()
 def prepare_verify_analysis(
     tokenizer: PreTrainedTokenizerBase,
     embed_module: nn.Module,
@@ -688,7 +909,7 @@ def prepare_verify_datasets(
         "src_and_src", "tgt_and_tgt", "top_src", "top_tgt"
     ] = "src_and_src",
     return_type: Literal["dataloader"] = "dataloader",
-) -> Tuple[DataLoader, DataLoader]: ...
+) -> Tuple[FastTensorLoader, FastTensorLoader]: ...
 
 
 @overload
@@ -704,6 +925,7 @@ def prepare_verify_datasets(
 ) -> Tuple[TensorDataset, TensorDataset]: ...
 
 
+@instrumented()
 @t.no_grad()
 def prepare_verify_datasets(
     verify_learning,
@@ -715,7 +937,9 @@ def prepare_verify_datasets(
     ] = "src_and_src",
     return_type: Literal["dataloader", "dataset"] = "dataloader",
     device: Union[str, t.device] = default_device,
-) -> Union[Tuple[DataLoader, DataLoader], Tuple[TensorDataset, TensorDataset]]:
+) -> Union[
+    Tuple[FastTensorLoader, FastTensorLoader], Tuple[TensorDataset, TensorDataset]
+]:
     """Prepares training and testing datasets.
 
     Prepares training and testing datasets from embeddings, selecting top-k
@@ -736,8 +960,9 @@ def prepare_verify_datasets(
             embeddings, tgt_and_tgt for target embeddings, top_src and top_tgt for
             selecting the entire word pair based on top cosine similarity from a
             randomly chosen source or target embedding, respectively.
-        return_type: Specifies whether to return DataLoader or TensorDataset objects.
-            Accepted values are 'loader' for DataLoader 'dataset' for TensorDataset.
+        return_type: Specifies whether to return FastTensorLoader or TensorDataset
+            objects. Accepted values are 'dataloader' for FastTensorLoader and
+            'dataset' for TensorDataset.
         device: The device on which to allocate tensors. If None, defaults to
             default_device. This parameter only controls the device of the returned
             tensors, the device of the tensors in the verify_learning object is
@@ -746,17 +971,6 @@ def prepare_verify_datasets(
     Returns:
         A tuple with either DataLoader objects or TensorDataset objects.
     """
-    # Create a generator for deterministic shuffling if seed is provided
-    generator = t.Generator()
-    if seed is not None:
-        generator.manual_seed(seed)
-
-    # This function initializes the random seeds for worker processes in DataLoader
-    def seed_worker(worker_seed: int):
-        worker_seed = t.initial_seed() % 2**32
-        np.random.seed(worker_seed)
-        random.seed(worker_seed)
-
     # Create test_embeds tensor from top 200 indices
     # other_embeds is of shape [batch, d_model] at this point
     # and src_top_200_cos_sim_indices is of shape [batch] and we want to select all the
@@ -874,25 +1088,21 @@ def prepare_verify_datasets(
     logger.debug(f"target train embeds shape: {tgt_train_embeds.shape}")
 
     # Prepare DataLoader objects for training and testing datasets
-    train_dataset = TensorDataset(src_train_embeds, tgt_train_embeds)
-    test_dataset = TensorDataset(src_test_embeds, tgt_test_embeds)
+    train_dataset = VerifyDataset(src_train_embeds, tgt_train_embeds)
+    test_dataset = VerifyDataset(src_test_embeds, tgt_test_embeds)
 
     if return_type == "dataset":
         return train_dataset, test_dataset
     elif return_type == "dataloader":
-        train_loader = DataLoader(
-            train_dataset,
-            batch_size=batch_sizes[0],
-            shuffle=True,
-            worker_init_fn=seed_worker,
-            generator=generator,
-        )
-        test_loader = DataLoader(
-            test_dataset,
-            batch_size=batch_sizes[1],
-            worker_init_fn=seed_worker,
-            generator=generator,
+        # the shuffling permutations are drawn on the device the embeddings are on, with
+        # a generator seeded for deterministic shuffling if a seed is provided
+        generator = t.Generator(device=src_train_embeds.device)
+        if seed is not None:
+            generator.manual_seed(seed)
+        train_loader = FastTensorLoader(
+            train_dataset, batch_size=batch_sizes[0], shuffle=True, generator=generator
         )
+        test_loader = FastTensorLoader(test_dataset, batch_size=batch_sizes[1])
         return train_loader, test_loader
     else:
         raise ValueError(
@@ -901,25 +1111,46 @@ def prepare_verify_datasets(
 
 
 @t.no_grad()
-def get_closest_embeds(word, embed_module, unembed_module, tokenizer, top_k):
-    d_vocab = embed_module.W_E.shape[0]
+def get_closest_embeds(
+    word: str,
+    embed_module: nn.Module,
+    unembed_module: nn.Module,
+    tokenizer: PreTrainedTokenizerBase,
+    top_k: int,
+    vocab_index: Optional[VocabIndex] = None,
+) -> Table:
+    """Returns a rich table of the tokens whose embeddings are closest to a word.
+
+    Args:
+        word: The word to find the closest embeddings to. Must be a single token.
+        embed_module: The module used for embedding.
+        unembed_module: The module used for unembedding. Not used.
+        tokenizer: A PreTrainedTokenizerBase instance used for tokenizing texts.
+        top_k: The number of closest tokens to show.
+        vocab_index: Optional; a cosine similarity VocabIndex built from embed_module.
+            If not given, one is fetched with get_vocab_index so that the vocabulary
+            is only embedded once per embed_module.
+
+    Returns:
+        A rich Table of the top_k closest tokens and their cosine similarities.
+    """
     word_token = tokenizer.encode(word, return_tensors="pt").squeeze()
     if word_token.numel() != 1:
         raise ValueError(
             f"{word} tokenizes to more than 1 token! ({word_token.numel()})"
         )
-    vocab_tensor = t.arange(0, d_vocab).squeeze()
-    vocab_tensor = vocab_tensor[vocab_tensor != word_token]
-    assert len(vocab_tensor) == d_vocab - 1
-    vocab_embeds = embed_module(vocab_tensor)  # [d_vocab, d_model]
+    if vocab_index is None:
+        vocab_index = get_vocab_index(embed_module, metric="cos_sim")
 
     # Calculate cosine similarities between the word embedding and all other embeddings
-    # TODO: test
-    word_embed = embed_module(word_token.unsqueeze(0))
-    cos_sims = t.nn.functional.cosine_similarity(word_embed, vocab_embeds)
+    word_token = word_token.to(embed_module.W_E.device)
+    word_embed = embed_module(word_token.reshape(1, 1)).squeeze(1)
+    top_k_values, top_k_indices, _ = vocab_index.topk(
+        word_embed, top_k, exclude=word_token.reshape(1)
+    )
+    top_k_values, top_k_indices = top_k_values[0].tolist(), top_k_indices[0].tolist()
+    top_k_strs = tokenizer.batch_decode([[token_id] for token_id in top_k_indices])
 
-    # Get the top_k indices and values
-    top_k_values, top_k_indices = t.topk(cos_sims, top_k, largest=True)
     word_styled = f"[plum3 on grey30]{word}[/plum3 on grey30]"
     word_token_id = word_token.item()
     word_token_id_styled = f"[turquoise2]{word_token_id}[/turquoise2]"
@@ -932,20 +1163,18 @@ def get_closest_embeds(word, embed_module, unembed_module, tokenizer, top_k):
     )
     table.add_column("Rank", style="dim")
     table.add_column("Token", style="bold cyan", width=20)
+    table.add_column("Token ID")
     table.add_column("Cosine Similarity")
 
     # Fetch the tokens and their cosine similarity values
-    for idx, (token_idx, cos_sim) in enumerate(
-        zip(top_k_indices, top_k_values), start=1
+    cos_sim_min, cos_sim_max = min(top_k_values), max(top_k_values)
+    for idx, (token_id, token_str, cos_sim) in enumerate(
+        zip(top_k_indices, top_k_strs, top_k_values), start=1
     ):
-        token_str = tokenizer.decode(token_idx.item())
         token_str_styled = f"[plum3 on grey30]{token_str}[/plum3 on grey30]"
-        token_id = token_idx.item()
         token_id_styled = f"[turquoise2]{token_id}[/turquoise2]"
-        cos_sim_color = calc_gradient_color(
-            cos_sim.item(), top_k_values.min().item(), top_k_values.max().item()
-        )
-        cos_sim_styled = f"[{cos_sim_color}]{cos_sim.item():.4f}[/{cos_sim_color}]"
+        cos_sim_color = calc_gradient_color(cos_sim, cos_sim_min, cos_sim_max)
+        cos_sim_styled = f"[{cos_sim_color}]{cos_sim:.4f}[/{cos_sim_color}]"
         table.add_row(
             str(idx),
             token_str_styled,
@@ -0,0 +1,366 @@
+import hashlib
+import json
+from pathlib import Path
+from typing import Any, Dict, Literal, NamedTuple, Optional, Tuple, Union
+from weakref import WeakKeyDictionary
+
+import numpy as np
+import torch as t
+import torch.nn as nn
+from jaxtyping import Float, Int
+from torch import Tensor
+
+from auto_embeds.utils.cache import cachedir
+from auto_embeds.utils.logging import logger
+from auto_embeds.utils.misc import atomic_directory, default_device
+
+
+class ChunkedTopK(NamedTuple):
+    """The result of chunked_topk.
+
+    Attributes:
+        values: The top-k scores of shape [n_queries, k].
+        indices: The vocabulary ids of the top-k scores of shape [n_queries, k].
+        logsumexp: The log-sum-exp of all scores of shape [n_queries] if requested,
+            otherwise None.
+    """
+
+    values: Tensor
+    indices: Tensor
+    logsumexp: Optional[Tensor]
+
+
+@t.no_grad()
+def chunked_topk(
+    queries: Float[Tensor, "n_queries d_model"],
+    vectors: Float[Tensor, "d_vocab d_model"],
+    k: int,
+    bias: Optional[Float[Tensor, "d_vocab"]] = None,
+    chunk_size: int = 16384,
+    exclude: Optional[Int[Tensor, "n_queries"]] = None,
+    return_logsumexp: bool = False,
+) -> ChunkedTopK:
+    """Finds the top-k scores of queries against vectors without a full score matrix.
+
+    The scores are queries @ vectors.T + bias. They are computed for chunk_size rows of
+    vectors at a time and merged into a running top-k (and optionally a running
+    log-sum-exp), so peak memory is O(n_queries * chunk_size) rather than
+    O(n_queries * d_vocab).
+
+    Args:
+        queries: The query vectors.
+        vectors: The vectors to score the queries against, one row per vocab entry.
+        k: The number of top scores to return per query.
+        bias: Optional; a bias added to the scores of each vocab entry.
+        chunk_size: The number of vocab entries scored at a time.
+        exclude: Optional; a vocab id per query whose score is excluded.
+        return_logsumexp: If True, also returns the log-sum-exp over all (non
+            excluded) scores, which turns the top-k scores into exact log probs.
+
+    Returns:
+        A ChunkedTopK with the top-k values, indices and optionally the logsumexp.
+    """
+    n_queries, d_vocab = queries.shape[0], vectors.shape[0]
+    device = queries.device
+    k = min(k, d_vocab)
+    top_values = t.full((n_queries, 0), -float("inf"), device=device)
+    top_indices = t.zeros((n_queries, 0), dtype=t.long, device=device)
+    logsumexp = (
+        t.full((n_queries,), -float("inf"), device=device) if return_logsumexp else None
+    )
+    for start in range(0, d_vocab, chunk_size):
+        chunk = vectors[start : start + chunk_size].to(
+            device=device, dtype=queries.dtype
+        )
+        scores = queries @ chunk.T
+        # shape [n_queries, chunk]
+        if bias is not None:
+            scores += bias[start : start + chunk_size].to(device=device)
+        chunk_ids = t.arange(start, start + chunk.shape[0], device=device)
+        if exclude is not None:
+            scores.masked_fill_(exclude.unsqueeze(-1) == chunk_ids, -float("inf"))
+        if logsumexp is not None:
+            logsumexp = t.logaddexp(logsumexp, scores.logsumexp(dim=-1))
+        chunk_top = scores.topk(min(k, scores.shape[-1]), dim=-1)
+        top_values = t.cat([top_values, chunk_top.values], dim=-1)
+        top_indices = t.cat([top_indices, chunk_ids[chunk_top.indices]], dim=-1)
+        if top_values.shape[-1] > k:
+            merged = top_values.topk(k, dim=-1)
+            top_values = merged.values
+            top_indices = top_indices.gather(-1, merged.indices)
+    return ChunkedTopK(top_values, top_indices, logsumexp)
+
+
+class VocabIndex:
+    """A reusable nearest-neighbour index over a model's embedding or unembedding.
+
+    The index keeps one row per vocabulary entry and answers batched top-k queries in
+    fixed size chunks via chunked_topk. With metric "cos_sim" the rows are the
+    pre-normalised embeddings of every token (so W_E only has to be embedded once) and
+    queries are compared by cosine similarity. With metric "logit" the rows are the
+    (contiguous) columns of W_U and queries are scored as logits, with the final layer
+    norm applied to the queries first if given.
+
+    Indexes can be saved to a directory of .npy files and loaded back memory-mapped, so
+    repeated sessions do not have to rebuild them. Use get_vocab_index to build or load
+    an index once per (model, processing, ln-config) and reuse it within a process.
+
+    Args:
+        vectors: One row per vocabulary entry, of shape [d_vocab, d_model].
+        metric: Either "cos_sim" or "logit".
+        bias: Optional; the unembedding bias for the "logit" metric.
+        query_ln: Optional; the layer norm applied to queries for the "logit" metric.
+        chunk_size: The number of vocab entries scored at a time.
+    """
+
+    def __init__(
+        self,
+        vectors: Float[Tensor, "d_vocab d_model"],
+        metric: Literal["cos_sim", "logit"] = "cos_sim",
+        bias: Optional[Float[Tensor, "d_vocab"]] = None,
+        query_ln: Optional[nn.Module] = None,
+        chunk_size: int = 16384,
+    ):
+        if metric not in ("cos_sim", "logit"):
+            raise ValueError(f"Unsupported metric: {metric}")
+        self.vectors = vectors
+        self.metric = metric
+        self.bias = bias
+        self.query_ln = query_ln
+        self.chunk_size = chunk_size
+
+    @property
+    def d_vocab(self) -> int:
+        return self.vectors.shape[0]
+
+    @classmethod
+    @t.no_grad()
+    def from_embed(
+        cls,
+        embed_module: nn.Module,
+        chunk_size: int = 16384,
+    ) -> "VocabIndex":
+        """Builds a cosine similarity index from the embeddings of every token.
+
+        Args:
+            embed_module: The module used for embedding, e.g. an Embed instance.
+            chunk_size: The number of tokens embedded (and later scored) at a time.
+
+        Returns:
+            A VocabIndex with the normalised embedding of every token.
+        """
+        d_vocab, d_model = embed_module.W_E.shape
+        device = embed_module.W_E.device
+        vectors = t.empty((d_vocab, d_model), device=device)
+        for start in range(0, d_vocab, chunk_size):
+            toks = t.arange(start, min(start + chunk_size, d_vocab), device=device)
+            embeds = embed_module(toks.unsqueeze(-1)).squeeze(1)
+            vectors[start : start + chunk_size] = nn.functional.normalize(
+                embeds, dim=-1, eps=1e-8
+            )
+        return cls(vectors, metric="cos_sim", chunk_size=chunk_size)
+
+    @classmethod
+    @t.no_grad()
+    def from_unembed(
+        cls,
+        unembed_module: nn.Module,
+        chunk_size: int = 16384,
+    ) -> "VocabIndex":
+        """Builds a logit index from an unembedding module.
+
+        Args:
+            unembed_module: The module used for unembedding, e.g. an Unembed instance.
+            chunk_size: The number of vocab entries scored at a time.
+
+        Returns:
+            A VocabIndex holding W_U transposed to [d_vocab, d_model], b_U and the
+            final layer norm of the unembedding module.
+        """
+        return cls(
+            unembed_module.W_U.detach().T.contiguous(),
+            metric="logit",
+            bias=unembed_module.b_U.detach(),
+            query_ln=getattr(unembed_module, "ln_final", None),
+            chunk_size=chunk_size,
+        )
+
+    @t.no_grad()
+    def topk(
+        self,
+        queries: Float[Tensor, "... d_model"],
+        k: int,
+        exclude: Optional[Int[Tensor, "..."]] = None,
+        return_logsumexp: bool = False,
+    ) -> ChunkedTopK:
+        """Finds the k closest vocab entries to each query.
+
+        Args:
+            queries: The query vectors, with any number of leading dimensions.
+            k: The number of closest entries to return per query.
+            exclude: Optional; a vocab id per query to leave out of the results, with
+                the same leading dimensions as queries.
+            return_logsumexp: If True, also returns the log-sum-exp over all scores,
+                which for the "logit" metric turns the top-k logits into exact log
+                probs.
+
+        Returns:
+            A ChunkedTopK with values, indices (and logsumexp) shaped like queries
+            with the last dimension replaced by k (or removed for the logsumexp).
+        """
+        batch_shape = queries.shape[:-1]
+        queries = queries.reshape(-1, queries.shape[-1])
+        if self.metric == "cos_sim":
+            queries = nn.functional.normalize(queries, dim=-1, eps=1e-8)
+        elif self.query_ln is not None:
+            queries = self.query_ln(queries)
+        if exclude is not None:
+            exclude = exclude.reshape(-1).to(queries.device)
+        values, indices, logsumexp = chunked_topk(
+            queries,
+            self.vectors,
+            k,
+            bias=self.bias,
+            chunk_size=self.chunk_size,
+            exclude=exclude,
+            return_logsumexp=return_logsumexp,
+        )
+        return ChunkedTopK(
+            values.reshape(*batch_shape, -1),
+            indices.reshape(*batch_shape, -1),
+            logsumexp.reshape(batch_shape) if logsumexp is not None else None,
+        )
+
+    def save(self, directory: Union[str, Path]) -> None:
+        """Saves the index as .npy files so it can be memory-mapped by load.
+
+        The query layer norm is not saved, pass it to load again if needed.
+
+        The directory is written atomically with atomic_directory, so if it already
+        exists (e.g. saved by another process) it is kept as is.
+
+        Args:
+            directory: The directory to save the index to.
+        """
+        with atomic_directory(directory) as tmp_dir:
+            np.save(tmp_dir / "vectors.npy", self.vectors.float().cpu().numpy())
+            if self.bias is not None:
+                np.save(tmp_dir / "bias.npy", self.bias.float().cpu().numpy())
+            meta = {"metric": self.metric, "has_bias": self.bias is not None}
+            with open(tmp_dir / "meta.json", "w") as file:
+                json.dump(meta, file)
+
+    @classmethod
+    def load(
+        cls,
+        directory: Union[str, Path],
+        query_ln: Optional[nn.Module] = None,
+        chunk_size: int = 16384,
+        device: Union[str, t.device] = default_device,
+    ) -> "VocabIndex":
+        """Loads an index saved with save.
+
+        The arrays are opened memory-mapped (copy-on-write), so on the CPU only the
+        pages that are actually scored are read and they are shared between processes
+        loading the same index.
+
+        Args:
+            directory: The directory the index was saved to.
+            query_ln: Optional; the layer norm applied to queries for the "logit"
+                metric.
+            chunk_size: The number of vocab entries scored at a time.
+            device: The device to load the index to.
+
+        Returns:
+            The loaded VocabIndex.
+        """
+        directory = Path(directory)
+        with open(directory / "meta.json", "r") as file:
+            meta = json.load(file)
+        vectors = t.from_numpy(np.load(directory / "vectors.npy", mmap_mode="c"))
+        bias = None
+        if meta["has_bias"]:
+            bias = t.from_numpy(np.load(directory / "bias.npy", mmap_mode="c"))
+        if t.device(device).type != "cpu":
+            vectors = vectors.to(device)
+            bias = bias.to(device) if bias is not None else None
+        return cls(
+            vectors,
+            metric=meta["metric"],
+            bias=bias,
+            query_ln=query_ln,
+            chunk_size=chunk_size,
+        )
+
+
+# maps (metric, cache_key) to the indexes memoized under a cache key
+_vocab_indexes: Dict[Any, VocabIndex] = {}
+# maps modules to the indexes memoized without a cache key, by metric, so that the
+# indexes are freed together with their modules
+_module_vocab_indexes: "WeakKeyDictionary[nn.Module, Dict[str, VocabIndex]]" = (
+    WeakKeyDictionary()
+)
+
+
+def get_vocab_index(
+    module: nn.Module,
+    metric: Literal["cos_sim", "logit"] = "cos_sim",
+    cache_key: Optional[Tuple[Any, ...]] = None,
+    persist: bool = False,
+    chunk_size: int = 16384,
+) -> VocabIndex:
+    """Returns a VocabIndex for a module, building it at most once per cache key.
+
+    Indexes are memoized in-process under cache_key, which should identify everything
+    the index depends on, e.g. (model_name, processing, embed_ln_weights). Without a
+    cache_key the index is memoized on the module object, weakly, so it is freed
+    together with the module. Either way the index is a snapshot of the weights, so
+    it goes stale if they are modified in place afterwards. If persist is True (and a
+    cache_key is given) the index is also saved under AUTOEMBEDS_CACHE_DIR and
+    memory-mapped from there by later sessions.
+
+    Args:
+        module: An Embed module for the "cos_sim" metric or an Unembed module for the
+            "logit" metric.
+        metric: Either "cos_sim" or "logit".
+        cache_key: Optional; a hashable key identifying the index.
+        persist: If True, stores the index on disk under the cache key.
+        chunk_size: The number of vocab entries scored at a time.
+
+    Returns:
+        The VocabIndex for the module.
+    """
+    if cache_key is None:
+        module_indexes = _module_vocab_indexes.setdefault(module, {})
+        if metric not in module_indexes:
+            module_indexes[metric] = build_vocab_index(module, metric, chunk_size)
+        return module_indexes[metric]
+    key = (metric, cache_key)
+    if key in _vocab_indexes:
+        return _vocab_indexes[key]
+
+    query_ln = getattr(module, "ln_final", None) if metric == "logit" else None
+    store_dir = None
+    if persist:
+        key_hash = hashlib.sha1(repr(key).encode()).hexdigest()
+        store_dir = Path(cachedir) / "vocab_index" / key_hash
+
+    if store_dir is not None and (store_dir / "meta.json").exists():
+        logger.debug(f"loading vocab index from {store_dir}")
+        device = next(module.parameters()).device
+        index = VocabIndex.load(store_dir, query_ln, chunk_size, device)
+    else:
+        index = build_vocab_index(module, metric, chunk_size)
+    if store_dir is not None and not (store_dir / "meta.json").exists():
+        index.save(store_dir)
+
+    _vocab_indexes[key] = index
+    return index
+
+
+def build_vocab_index(
+    module: nn.Module, metric: Literal["cos_sim", "logit"], chunk_size: int
+) -> VocabIndex:
+    if metric == "cos_sim":
+        return VocabIndex.from_embed(module, chunk_size)
+    return VocabIndex.from_unembed(module, chunk_size)
@@ -0,0 +1,267 @@
+import json
+import re
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Union
+
+import numpy as np
+import torch as t
+from torch import Tensor
+
+from auto_embeds.utils.logging import logger
+from auto_embeds.utils.misc import atomic_directory, default_device
+
+WEIGHT_NAMES = [
+    "W_E",
+    "embed.ln.w",
+    "embed.ln.b",
+    "ln_final.w",
+    "ln_final.b",
+    "W_U",
+    "b_U",
+]
+
+# the checkpoint keys of each weight, in TransformerLens' layout (W_U is transposed and
+# b_U is zeros as both models tie their unembedding to their embedding)
+CHECKPOINT_KEYS = {
+    "bloom": {
+        "W_E": "word_embeddings.weight",
+        "embed.ln.w": "word_embeddings_layernorm.weight",
+        "embed.ln.b": "word_embeddings_layernorm.bias",
+        "ln_final.w": "ln_f.weight",
+        "ln_final.b": "ln_f.bias",
+    },
+    "gpt": {
+        "W_E": "wte.weight",
+        "ln_final.w": "ln_f.weight",
+        "ln_final.b": "ln_f.bias",
+    },
+}
+
+
+# the names of the models whose checkpoints read_checkpoint_weights reads, all of which
+# tie their unembedding to their embedding. other models with "gpt" or "bloom" in their
+# name may not (e.g. EleutherAI/gpt-j-6b has a separate lm_head with a bias), so they
+# are loaded with TransformerLens instead
+CHECKPOINT_MODEL_NAMES = {
+    "bloom": re.compile(r"(bigscience/)?bloomz?(-\d+[mb]\d*)?"),
+    "gpt": re.compile(r"(openai-community/)?(distil)?gpt2(-medium|-large|-xl)?"),
+}
+
+
+def checkpoint_architecture(model_name: str) -> Optional[str]:
+    """Returns the key of CHECKPOINT_KEYS for a model whose checkpoint can be read
+    directly, or None if it has to be loaded with TransformerLens."""
+    for architecture, pattern in CHECKPOINT_MODEL_NAMES.items():
+        if pattern.fullmatch(model_name):
+            return architecture
+    return None
+
+
+class WeightStore(Mapping):
+    """A lazy, memory-mapped mapping from weight names to tensors.
+
+    Every weight is stored as its own .npy file and only opened when it is first
+    accessed. On the cpu the arrays are memory-mapped copy-on-write, so processes
+    (e.g. spawn workers) loading the same weights share the pages of the file and only
+    the rows that are actually read are paged in. On other devices each accessed weight
+    is copied to the device once. Weights that do not exist for a model (e.g.
+    embed.ln.w for gpt2) map to None.
+
+    Args:
+        directory: The directory the weights were saved to with save.
+        device: The device to load the weights to.
+    """
+
+    def __init__(
+        self,
+        directory: Union[str, Path],
+        device: Union[str, t.device] = default_device,
+    ):
+        self.directory = Path(directory)
+        self.device = t.device(device)
+        with open(self.directory / "meta.json", "r") as file:
+            self.names: List[str] = json.load(file)["names"]
+        self._loaded: Dict[str, Optional[Tensor]] = {}
+
+    @staticmethod
+    def exists(directory: Union[str, Path]) -> bool:
+        return (Path(directory) / "meta.json").exists()
+
+    @staticmethod
+    def save(directory: Union[str, Path], weights: Dict[str, Optional[Tensor]]) -> None:
+        """Saves weights as one .npy file each, next to a meta.json listing them.
+
+        The directory is written atomically with atomic_directory, so concurrent
+        processes that both missed the store can both save it: the first one to
+        finish wins and the files the other may already have memory-mapped are left
+        untouched.
+
+        Args:
+            directory: The directory to save the weights to.
+            weights: Maps weight names to tensors or None.
+        """
+        with atomic_directory(directory) as tmp_dir:
+            for name, weight in weights.items():
+                if weight is not None:
+                    array = weight.detach().to("cpu", t.float32).numpy()
+                    np.save(tmp_dir / f"{name}.npy", array)
+            with open(tmp_dir / "meta.json", "w") as file:
+                json.dump({"names": list(weights)}, file)
+
+    def __getitem__(self, name: str) -> Optional[Tensor]:
+        if name not in self.names:
+            raise KeyError(name)
+        if name not in self._loaded:
+            path = self.directory / f"{name}.npy"
+            if not path.exists():
+                self._loaded[name] = None
+            else:
+                weight = t.from_numpy(np.load(path, mmap_mode="c"))
+                if self.device.type != "cpu":
+                    weight = weight.to(self.device)
+                self._loaded[name] = weight
+        return self._loaded[name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __repr__(self) -> str:
+        return f"WeightStore({str(self.directory)!r}, loaded={list(self._loaded)})"
+
+
+def read_checkpoint_weights(
+    model_name: str, checkpoint_paths: List[Union[str, Path]]
+) -> Dict[str, Optional[Tensor]]:
+    """Reads the embedding related weights directly from safetensors checkpoint files.
+
+    Only the needed tensors are read from the files and they are converted to the
+    layout of TransformerLens' from_pretrained_no_processing, so no model has to be
+    instantiated.
+
+    Args:
+        model_name: The name of the model, used to pick the checkpoint keys.
+        checkpoint_paths: The safetensors files of the checkpoint.
+
+    Returns:
+        A dictionary with the same weights as get_cached_weights.
+
+    Raises:
+        ValueError: If the model is not in CHECKPOINT_MODEL_NAMES or a key is missing.
+    """
+    from safetensors import safe_open
+
+    architecture = checkpoint_architecture(model_name)
+    if architecture is None:
+        raise ValueError(f"Unsupported model: {model_name}")
+    keys = CHECKPOINT_KEYS[architecture]
+
+    weights: Dict[str, Optional[Tensor]] = {name: None for name in WEIGHT_NAMES}
+    for path in checkpoint_paths:
+        with safe_open(str(path), framework="pt") as file:
+            file_keys = set(file.keys())
+            for name, key in keys.items():
+                # keys are prefixed with "transformer." in some checkpoints
+                for prefixed_key in [key, f"transformer.{key}"]:
+                    if prefixed_key in file_keys:
+                        weights[name] = file.get_tensor(prefixed_key).to(t.float32)
+    missing = [name for name in keys if weights[name] is None]
+    if missing:
+        raise ValueError(f"Weights {missing} not found in checkpoint of {model_name}")
+    weights["W_U"] = weights["W_E"].T.contiguous()
+    weights["b_U"] = t.zeros(weights["W_E"].shape[0])
+    return weights
+
+
+def download_checkpoint_weights(model_name: str) -> Dict[str, Optional[Tensor]]:
+    """Downloads just the safetensors shards holding the embedding related weights.
+
+    Args:
+        model_name: The name of the model on the Hugging Face hub.
+
+    Returns:
+        A dictionary with the same weights as get_cached_weights.
+    """
+    from huggingface_hub import hf_hub_download
+    from huggingface_hub.utils import EntryNotFoundError
+
+    try:
+        index_path = hf_hub_download(model_name, "model.safetensors.index.json")
+    except EntryNotFoundError:
+        checkpoint_files = ["model.safetensors"]
+    else:
+        with open(index_path, "r") as file:
+            weight_map = json.load(file)["weight_map"]
+        needed_keys = {
+            prefix + key
+            for keys in CHECKPOINT_KEYS.values()
+            for key in keys.values()
+            for prefix in ["", "transformer."]
+        }
+        checkpoint_files = sorted(
+            {file for key, file in weight_map.items() if key in needed_keys}
+        )
+    checkpoint_paths = [hf_hub_download(model_name, file) for file in checkpoint_files]
+    return read_checkpoint_weights(model_name, checkpoint_paths)
+
+
+def extract_weights(model_name: str, processing: bool) -> Dict[str, Optional[Tensor]]:
+    """Extracts the embedding related weights of a model.
+
+    Without processing the weights of the models in CHECKPOINT_MODEL_NAMES are read
+    straight from their safetensors checkpoint where possible, falling back to loading
+    the model with TransformerLens, which is also used for every other model.
+
+    Args:
+        model_name: The name of the transformer model to load.
+        processing: Whether to load the model with processing.
+
+    Returns:
+        A dictionary with the same weights as get_cached_weights.
+
+    Raises:
+        ValueError: If the model name is not supported.
+    """
+    if not any(architecture in model_name for architecture in CHECKPOINT_KEYS):
+        raise ValueError(f"Unsupported model: {model_name}")
+    if not processing and checkpoint_architecture(model_name) is not None:
+        try:
+            return download_checkpoint_weights(model_name)
+        except Exception as e:
+            logger.info(
+                f"could not read {model_name} weights from its checkpoint ({e}), "
+                "loading the model with TransformerLens instead"
+            )
+    import transformer_lens as tl
+
+    if processing:
+        model = tl.HookedTransformer.from_pretrained(model_name)
+    else:
+        model = tl.HookedTransformer.from_pretrained_no_processing(model_name)
+    if "bloom" in model_name:
+        model_weights = {
+            "W_E": model.W_E.detach().clone(),
+            "embed.ln.w": (model.embed.ln.w.detach().clone()),
+            "embed.ln.b": (model.embed.ln.b.detach().clone()),
+            "ln_final.w": model.ln_final.w.detach().clone(),
+            "ln_final.b": model.ln_final.b.detach().clone(),
+            "W_U": model.W_U.detach().clone(),
+            "b_U": model.b_U.detach().clone(),
+        }
+    elif "gpt" in model_name:
+        model_weights = {
+            "W_E": model.W_E.detach().clone(),
+            "embed.ln.w": None,
+            "embed.ln.b": None,
+            "ln_final.w": model.ln_final.w.detach().clone(),
+            "ln_final.b": model.ln_final.b.detach().clone(),
+            "W_U": model.W_U.detach().clone(),
+            "b_U": model.b_U.detach().clone(),
+        }
+    else:
+        raise ValueError(f"Unsupported model: {model_name}")
+    del model
+    return model_weights
@@ -0,0 +1,128 @@
+import random
+import string
+
+import pytest
+import torch as t
+
+from auto_embeds.data import filter_word_pairs
+from auto_embeds.modules import Embed, Unembed
+from auto_embeds.verify import prepare_verify_analysis, prepare_verify_datasets
+
+# (d_model, d_vocab) of the models the experiments run on
+MODEL_SHAPES = {
+    "gpt2": (768, 50257),
+    "bloom-560m": (1024, 250880),
+    "bloom-3b": (2560, 250880),
+}
+
+# about the number of en-fr pairs left in wikdict after filtering
+N_WORD_PAIRS = 5000
+
+
+def random_word(rng: random.Random) -> str:
+    return "".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 10)))
+
+
+def make_word_pairs(n_pairs: int, seed: int = 0):
+    """Makes en-fr word pairs where the fr word is a perturbed copy of the en word."""
+    rng = random.Random(seed)
+    word_pairs = []
+    for _ in range(n_pairs):
+        en_word = random_word(rng)
+        fr_word = list(en_word)
+        for _ in range(rng.randint(1, 3)):
+            fr_word[rng.randrange(len(fr_word))] = rng.choice(string.ascii_lowercase)
+        word_pairs.append([en_word, "".join(fr_word) + rng.choice(["", "e", "er"])])
+    return word_pairs
+
+
+@pytest.fixture(
+    scope="session",
+    params=["gpt2", "bloom-560m", pytest.param("bloom-3b", marks=pytest.mark.slow)],
+)
+def model_name(request):
+    return request.param
+
+
+@pytest.fixture(scope="session")
+def word_pairs():
+    return make_word_pairs(N_WORD_PAIRS)
+
+
+@pytest.fixture(scope="session")
+def tokenizer(model_name, word_pairs):
+    """An offline tokenizer with the model's vocab size holding every word pair.
+
+    Every word is a single token with and without a leading space and capitalisation,
+    the rest of the vocab is filled with tokens that never occur in the word pairs.
+    """
+    from tokenizers import Tokenizer
+    from tokenizers.models import WordLevel
+    from transformers import PreTrainedTokenizerFast
+
+    _, d_vocab = MODEL_SHAPES[model_name]
+    vocab = {"<unk>": 0}
+    for pair in word_pairs:
+        for word in pair:
+            for variant in [
+                word,
+                " " + word,
+                word.capitalize(),
+                " " + word.capitalize(),
+            ]:
+                vocab.setdefault(variant, len(vocab))
+    for i in range(d_vocab - len(vocab)):
+        vocab[f"<filler_{i}>"] = len(vocab)
+    tokenizer = Tokenizer(WordLevel(vocab, "<unk>"))
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, unk_token="<unk>", pad_token="<unk>"
+    )
+
+
+@pytest.fixture(scope="session")
+def embed_and_unembed(model_name):
+    """Synthetic embed and unembed modules, tied like the models' so W_E is shared."""
+    d_model, d_vocab = MODEL_SHAPES[model_name]
+    generator = t.Generator().manual_seed(0)
+    W_E = t.randn(d_vocab, d_model, generator=generator) / d_model**0.5
+    embed_module = Embed(d_model, d_vocab, W_E, device="cpu")
+    # W_E.T is the transposed layout of a contiguous W_U_T, so no copy is made
+    unembed_module = Unembed(
+        d_model, d_vocab, W_E.T, t.zeros(d_vocab), device="cpu", transpose_weight=True
+    )
+    return embed_module, unembed_module
+
+
+@pytest.fixture(scope="session")
+def embed_module(embed_and_unembed):
+    return embed_and_unembed[0]
+
+
+@pytest.fixture(scope="session")
+def unembed_module(embed_and_unembed):
+    return embed_and_unembed[1]
+
+
+@pytest.fixture(scope="session")
+def all_word_pairs(tokenizer, word_pairs):
+    return filter_word_pairs.__wrapped__(
+        tokenizer, word_pairs, discard_if_same=True, min_length=3
+    )
+
+
+@pytest.fixture(scope="session")
+def verify_analysis(tokenizer, embed_module, all_word_pairs):
+    return prepare_verify_analysis(
+        tokenizer, embed_module, all_word_pairs, seed=1, device="cpu"
+    )
+
+
+@pytest.fixture(scope="session")
+def loaders(verify_analysis):
+    return prepare_verify_datasets(
+        verify_analysis,
+        batch_sizes=(128, 256),
+        top_k=200,
+        top_k_selection_method="top_src",
+        device="cpu",
+    )
@@ -0,0 +1,46 @@
+import pytest
+import torch as t
+
+from auto_embeds.analytical import (
+    EmbeddingStatistics,
+    solve_linear_map_batched,
+    solve_orthogonal_procrustes_batched,
+)
+
+N_PROBLEMS = 16
+
+
+@pytest.fixture(params=[64, 768], ids=lambda d_model: f"d_model={d_model}")
+def stats(request):
+    t.manual_seed(0)
+    d_model = request.param
+    stats = []
+    for _ in range(N_PROBLEMS):
+        src_embeds = t.randn(2 * d_model, d_model)
+        tgt_embeds = src_embeds @ t.randn(d_model, d_model)
+        problem_stats = EmbeddingStatistics(d_model, gram=True, device="cpu")
+        problem_stats.update(src_embeds, tgt_embeds)
+        stats.append(problem_stats)
+    return stats
+
+
+@pytest.mark.benchmark(group="orthogonal_procrustes")
+def test_orthogonal_procrustes_loop(benchmark, stats):
+    benchmark(
+        lambda: [problem_stats.orthogonal_procrustes(True) for problem_stats in stats]
+    )
+
+
+@pytest.mark.benchmark(group="orthogonal_procrustes")
+def test_orthogonal_procrustes_batched(benchmark, stats):
+    benchmark(solve_orthogonal_procrustes_batched, stats, True)
+
+
+@pytest.mark.benchmark(group="linear_map")
+def test_linear_map_loop(benchmark, stats):
+    benchmark(lambda: [problem_stats.linear_map() for problem_stats in stats])
+
+
+@pytest.mark.benchmark(group="linear_map")
+def test_linear_map_batched(benchmark, stats):
+    benchmark(solve_linear_map_batched, stats)
@@ -0,0 +1,91 @@
+import pytest
+import torch as t
+from torch.utils.data import TensorDataset
+
+from auto_embeds.data import FastTensorLoader
+from auto_embeds.embed_utils import (
+    initialize_transform_and_optim,
+    initialize_transform_ensemble,
+    train_transform,
+    train_transform_ensemble,
+)
+from auto_embeds.metrics import initialize_loss
+from auto_embeds.modules import Unembed
+
+# an epoch of a sweep over the seeds of bloom-560m sized transforms, trained one
+# after the other with train_transform or all at once with train_transform_ensemble
+D_MODEL, N_MEMBERS = 1024, 8
+N_TRAIN, N_TEST, BATCH_SIZE = 2048, 256, 128
+
+
+@pytest.fixture(scope="module")
+def loaders():
+    t.manual_seed(0)
+    src_embeds = t.randn(N_TRAIN + N_TEST, 1, D_MODEL)
+    tgt_embeds = t.randn(N_TRAIN + N_TEST, 1, D_MODEL)
+    train_loader = FastTensorLoader(
+        TensorDataset(src_embeds[:N_TRAIN], tgt_embeds[:N_TRAIN]),
+        batch_size=BATCH_SIZE,
+        shuffle=True,
+    )
+    test_loader = FastTensorLoader(
+        TensorDataset(src_embeds[N_TRAIN:], tgt_embeds[N_TRAIN:]),
+        batch_size=2 * BATCH_SIZE,
+    )
+    return train_loader, test_loader
+
+
+@pytest.mark.benchmark(group="train_ensemble_epoch")
+@pytest.mark.parametrize("transformation", ["linear_map", "translation"])
+def test_train_ensemble_epoch_sequential(
+    benchmark, word_level_tokenizer, loaders, transformation
+):
+    train_loader, test_loader = loaders
+    # the tokenizer and unembed are only used by mark_translation, which is not run
+    d_vocab = len(word_level_tokenizer)
+    unembed_module = Unembed(
+        D_MODEL, d_vocab, t.randn(D_MODEL, d_vocab), t.zeros(d_vocab), device="cpu"
+    )
+
+    def train_members():
+        for seed in range(N_MEMBERS):
+            t.manual_seed(seed)
+            transform, optim = initialize_transform_and_optim(
+                D_MODEL, transformation, optim_kwargs={"lr": 1e-3}, device="cpu"
+            )
+            train_transform(
+                tokenizer=word_level_tokenizer,
+                train_loader=train_loader,
+                test_loader=test_loader,
+                transform=transform,
+                optim=optim,
+                loss_module=initialize_loss("cos_sim"),
+                unembed_module=unembed_module,
+                n_epochs=0,
+                plot_fig=False,
+                device="cpu",
+            )
+
+    benchmark.pedantic(train_members, rounds=3)
+
+
+@pytest.mark.benchmark(group="train_ensemble_epoch")
+@pytest.mark.parametrize("transformation", ["linear_map", "translation"])
+def test_train_ensemble_epoch(benchmark, loaders, transformation):
+    train_loader, test_loader = loaders
+
+    def train_members():
+        ensemble = initialize_transform_ensemble(
+            D_MODEL, transformation, list(range(N_MEMBERS)), device="cpu"
+        )
+        train_transform_ensemble(
+            train_loader,
+            test_loader,
+            ensemble,
+            initialize_loss("cos_sim"),
+            n_epochs=0,
+            lrs=[1e-3] * N_MEMBERS,
+            device="cpu",
+        )
+
+    benchmark.pedantic(train_members, rounds=3)
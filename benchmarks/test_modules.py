@@ -0,0 +1,162 @@
+import pytest
+import torch as t
+from fancy_einsum import einsum
+
+from auto_embeds.modules import ManualTransformModule, OrthogonalLinear, Unembed
+
+# bloom-560m sized residual stream activations of a 100 token prompt
+BATCH, POS, D_MODEL = 1, 100, 1024
+
+
+def steering_hook(input, transformation):
+    # the computation of auto_embeds.steer.steering_hook with positions_to_steer="all",
+    # which is not imported as steer needs transformer_lens' HookedTransformer
+    return transformation(input[0])
+
+
+@pytest.fixture(scope="module")
+def transform():
+    t.manual_seed(0)
+    return ManualTransformModule(
+        [
+            ("add", t.randn(D_MODEL)),
+            ("multiply", t.linalg.qr(t.randn(D_MODEL, D_MODEL)).Q),
+            ("scale", t.tensor(1.2)),
+        ]
+    )
+
+
+@pytest.fixture(scope="module")
+def resid():
+    return t.randn(BATCH, POS, D_MODEL)
+
+
+@pytest.mark.benchmark(group="steering_hook")
+@t.inference_mode()
+def test_steering_hook_op_chain(benchmark, transform, resid):
+    benchmark(steering_hook, (resid,), transform)
+
+
+@pytest.mark.benchmark(group="steering_hook")
+@t.inference_mode()
+def test_steering_hook_fused(benchmark, transform, resid):
+    benchmark(steering_hook, (resid,), transform.fuse())
+
+
+@pytest.mark.benchmark(group="steering_hook_final")
+@t.inference_mode()
+def test_steering_hook_final_op_chain(benchmark, transform, resid):
+    benchmark(steering_hook, (resid[:, -1:],), transform)
+
+
+@pytest.mark.benchmark(group="steering_hook_final")
+@t.inference_mode()
+def test_steering_hook_final_fused(benchmark, transform, resid):
+    benchmark(steering_hook, (resid[:, -1:],), transform.fuse())
+
+
+# a batch of bloom-560m sized embeddings unembedded over its full vocabulary
+UNEMBED_BATCH, D_VOCAB = 256, 250880
+
+
+@pytest.fixture(scope="module")
+def unembed_weights():
+    t.manual_seed(0)
+    return t.randn(D_MODEL, D_VOCAB) / D_MODEL**0.5, t.zeros(D_VOCAB)
+
+
+@pytest.fixture(scope="module")
+def embeds():
+    return t.randn(UNEMBED_BATCH, 1, D_MODEL)
+
+
+@pytest.mark.benchmark(group="unembed")
+@t.inference_mode()
+def test_unembed_einsum(benchmark, unembed_weights, embeds):
+    # the fancy_einsum path Unembed.forward used to take
+    W_U, b_U = unembed_weights
+    benchmark(
+        lambda: (
+            einsum("batch pos d_model, d_model vocab -> batch pos vocab", embeds, W_U)
+            + b_U
+        )
+    )
+
+
+@pytest.mark.benchmark(group="unembed")
+@pytest.mark.parametrize("transpose_weight", [False, True])
+@t.inference_mode()
+def test_unembed_forward(benchmark, unembed_weights, embeds, transpose_weight):
+    W_U, b_U = unembed_weights
+    unembed_module = Unembed(
+        D_MODEL, D_VOCAB, W_U, b_U, device="cpu", transpose_weight=transpose_weight
+    )
+    benchmark(unembed_module, embeds)
+
+
+@pytest.mark.benchmark(group="unembed_argmax")
+@t.inference_mode()
+def test_unembed_full_argmax(benchmark, unembed_weights, embeds):
+    unembed_module = Unembed(D_MODEL, D_VOCAB, *unembed_weights, device="cpu")
+    benchmark(lambda: unembed_module(embeds).argmax(dim=-1))
+
+
+@pytest.mark.benchmark(group="unembed_argmax")
+@t.inference_mode()
+def test_unembed_topk(benchmark, unembed_weights, embeds):
+    unembed_module = Unembed(D_MODEL, D_VOCAB, *unembed_weights, device="cpu")
+    benchmark(unembed_module.topk, embeds, 1)
+
+
+# rotations of bloom-3b sized embeddings
+ROTATION_BATCH, ROTATION_D_MODEL = 256, 2560
+
+
+@pytest.fixture(scope="module")
+def rotation_embeds():
+    t.manual_seed(0)
+    return t.randn(ROTATION_BATCH, 1, ROTATION_D_MODEL)
+
+
+def parametrized_rotation(d_model):
+    # the t.nn.utils.parametrizations.orthogonal rotation the transforms used to use
+    return t.nn.utils.parametrizations.orthogonal(
+        t.nn.Linear(d_model, d_model, bias=False), orthogonal_map="cayley"
+    )
+
+
+@pytest.mark.benchmark(group="rotation_eval")
+@t.no_grad()
+def test_rotation_eval_parametrized(benchmark, rotation_embeds):
+    rotation = parametrized_rotation(ROTATION_D_MODEL)
+    benchmark(rotation, rotation_embeds)
+
+
+@pytest.mark.benchmark(group="rotation_eval")
+@t.no_grad()
+def test_rotation_eval_cached(benchmark, rotation_embeds):
+    rotation = OrthogonalLinear(ROTATION_D_MODEL, device="cpu")
+    benchmark(rotation, rotation_embeds)
+
+
+def rotation_train_step(rotation, optim, embeds):
+    optim.zero_grad()
+    rotation(embeds).pow(2).mean().backward()
+    optim.step()
+
+
+@pytest.mark.benchmark(group="rotation_train_step")
+def test_rotation_train_step_parametrized(benchmark, rotation_embeds):
+    rotation = parametrized_rotation(ROTATION_D_MODEL)
+    optim = t.optim.Adam(rotation.parameters())
+    benchmark(rotation_train_step, rotation, optim, rotation_embeds)
+
+
+@pytest.mark.benchmark(group="rotation_train_step")
+@pytest.mark.parametrize(
+    "parametrization", ["cayley", "matrix_exp", "householder", "retraction"]
+)
+def test_rotation_train_step(benchmark, rotation_embeds, parametrization):
+    rotation = OrthogonalLinear(ROTATION_D_MODEL, parametrization, device="cpu")
+    optim = t.optim.Adam(rotation.parameters())
+    benchmark(rotation_train_step, rotation, optim, rotation_embeds)
@@ -0,0 +1,229 @@
+import pytest
+import torch as t
+
+from auto_embeds.analytical import initialize_manual_transform
+from auto_embeds.data import filter_word_pairs
+from auto_embeds.embed_utils import initialize_transform_and_optim, train_transform
+from auto_embeds.metrics import (
+    calc_acc_detailed,
+    calc_acc_fast,
+    calc_canonical_angles,
+    calc_cos_sim_acc,
+    calc_loss,
+    calc_metrics,
+    calc_pred_same_as_input,
+    initialize_loss,
+    mark_translation,
+)
+from auto_embeds.verify import (
+    calc_tgt_is_closest_embed,
+    prepare_verify_analysis,
+    prepare_verify_datasets,
+)
+
+# the benchmarks of the stages of run_experiment on synthetic weights of each model's
+# shape, see benchmarks/conftest.py. filter_word_pairs is called through __wrapped__
+# so that the disk cache of auto_embeds_cache is bypassed.
+
+
+@pytest.fixture(scope="session")
+def transform(model_name, loaders):
+    train_loader, _ = loaders
+    return initialize_manual_transform("analytical_rotation", train_loader, "cpu")
+
+
+@pytest.fixture(scope="session")
+def translations_dict(all_word_pairs):
+    translations_dict = {}
+    for en_word, fr_word in all_word_pairs:
+        translations_dict.setdefault(en_word.strip().lower(), []).append(fr_word)
+    return translations_dict
+
+
+@pytest.mark.benchmark(group="filter_word_pairs")
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {},
+        {"capture_diff_case": True},
+        {"acceptable_english_overlap": 0.8, "acceptable_french_overlap": 0.8},
+    ],
+    ids=["default", "capture_diff_case", "overlap"],
+)
+def test_filter_word_pairs(benchmark, tokenizer, word_pairs, kwargs):
+    benchmark(
+        filter_word_pairs.__wrapped__,
+        tokenizer,
+        word_pairs,
+        discard_if_same=True,
+        min_length=3,
+        **kwargs,
+    )
+
+
+@pytest.mark.benchmark(group="prepare_verify")
+def test_prepare_verify_analysis(benchmark, tokenizer, embed_module, all_word_pairs):
+    benchmark(
+        prepare_verify_analysis,
+        tokenizer,
+        embed_module,
+        all_word_pairs,
+        seed=1,
+        device="cpu",
+    )
+
+
+@pytest.mark.benchmark(group="prepare_verify")
+def test_prepare_verify_datasets(benchmark, verify_analysis):
+    benchmark(
+        prepare_verify_datasets,
+        verify_analysis,
+        batch_sizes=(128, 256),
+        top_k=200,
+        top_k_selection_method="top_src",
+        device="cpu",
+    )
+
+
+@pytest.mark.benchmark(group="metrics")
+@t.no_grad()
+def test_calc_cos_sim_acc(benchmark, loaders, transform):
+    benchmark(calc_cos_sim_acc, loaders[1], transform, device="cpu")
+
+
+@pytest.mark.benchmark(group="metrics")
+@pytest.mark.parametrize("calc_acc", [calc_acc_detailed, calc_acc_fast])
+@t.no_grad()
+def test_calc_acc(benchmark, tokenizer, loaders, transform, unembed_module, calc_acc):
+    benchmark(
+        calc_acc,
+        tokenizer,
+        loaders[1],
+        transform,
+        unembed_module,
+        exact_match=False,
+        device="cpu",
+        print_acc=False,
+    )
+
+
+@pytest.mark.benchmark(group="metrics")
+@t.no_grad()
+def test_mark_translation(
+    benchmark, tokenizer, loaders, transform, unembed_module, translations_dict
+):
+    benchmark(
+        mark_translation,
+        tokenizer,
+        transform,
+        unembed_module,
+        loaders[1],
+        translations_dict=translations_dict,
+        device="cpu",
+    )
+
+
+@pytest.mark.benchmark(group="metrics")
+@t.no_grad()
+def test_calc_pred_same_as_input(
+    benchmark, tokenizer, loaders, transform, unembed_module
+):
+    benchmark(
+        calc_pred_same_as_input,
+        tokenizer,
+        loaders[1],
+        transform,
+        unembed_module,
+        device="cpu",
+    )
+
+
+@pytest.mark.benchmark(group="metrics")
+@t.no_grad()
+def test_calc_loss(benchmark, loaders, transform):
+    benchmark(calc_loss, loaders[1], transform, initialize_loss("cos_sim"))
+
+
+@pytest.mark.benchmark(group="metrics")
+@t.no_grad()
+def test_calc_canonical_angles(benchmark, loaders, transform):
+    src_embeds, tgt_embeds = loaders[1].dataset.tensors[:2]
+    benchmark(calc_canonical_angles, transform(src_embeds), tgt_embeds)
+
+
+@pytest.mark.benchmark(group="metrics")
+@t.no_grad()
+def test_calc_metrics(
+    benchmark, tokenizer, loaders, transform, unembed_module, translations_dict
+):
+    benchmark(
+        calc_metrics,
+        loaders[1],
+        transform,
+        tokenizer,
+        unembed_module,
+        None,
+        translations_dict=translations_dict,
+        device="cpu",
+    )
+
+
+@pytest.mark.benchmark(group="train_transform_epoch")
+@pytest.mark.parametrize("transformation", ["linear_map", "rotation"])
+def test_train_transform_epoch(
+    benchmark, tokenizer, loaders, unembed_module, transformation
+):
+    train_loader, test_loader = loaders
+    d_model = train_loader.dataset.tensors[0].shape[-1]
+
+    def setup():
+        t.manual_seed(0)
+        transform, optim = initialize_transform_and_optim(
+            d_model, transformation, optim_kwargs={"lr": 1e-3}, device="cpu"
+        )
+        return (), {"transform": transform, "optim": optim}
+
+    def train_epoch(transform, optim):
+        # n_epochs=0 trains for a single epoch
+        train_transform(
+            tokenizer=tokenizer,
+            train_loader=train_loader,
+            test_loader=test_loader,
+            transform=transform,
+            optim=optim,
+            loss_module=initialize_loss("cos_sim"),
+            unembed_module=unembed_module,
+            n_epochs=0,
+            plot_fig=False,
+            device="cpu",
+        )
+
+    benchmark.pedantic(train_epoch, setup=setup, rounds=3)
+
+
+@pytest.mark.benchmark(group="initialize_manual_transform")
+@pytest.mark.parametrize(
+    "transform_name",
+    [
+        "analytical_translation",
+        "roma_analytical",
+        "roma_scale_analytical",
+        "analytical_rotation",
+        "analytical_rotation_and_reflection",
+        "analytical_linear_map",
+    ],
+)
+def test_initialize_manual_transform(benchmark, loaders, transform_name):
+    benchmark(initialize_manual_transform, transform_name, loaders[0], "cpu")
+
+
+@pytest.mark.benchmark(group="unembed_forward")
+@t.inference_mode()
+def test_unembed_forward(benchmark, loaders, unembed_module):
+    benchmark(unembed_module, loaders[1].dataset.tensors[0])
+
+
+@pytest.mark.benchmark(group="calc_tgt_is_closest_embed")
+@t.no_grad()
+def test_calc_tgt_is_closest_embed(benchmark, tokenizer, all_word_pairs, embed_module):
+    benchmark(calc_tgt_is_closest_embed, tokenizer, all_word_pairs, embed_module, "cpu")
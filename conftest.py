@@ -19,3 +19,33 @@ def pytest_collection_modifyitems(config, items):
     for item in items:
         if "slow" in item.keywords:
             item.add_marker(skip_slow)
+
+
+@pytest.fixture
+def word_level_tokenizer():
+    """A small offline tokenizer where every word in the vocab is a single token."""
+    from tokenizers import Tokenizer
+    from tokenizers.models import WordLevel
+    from transformers import PreTrainedTokenizerFast
+
+    words = ["<unk>"]
+    for en_word, fr_word in [
+        ("hospital", "hôpital"),
+        ("electronic", "électronique"),
+        ("trajectory", "trajectoire"),
+        ("commissioner", "commissaire"),
+        ("house", "maison"),
+        ("cat", "chat"),
+        ("dog", "chien"),
+        ("water", "eau"),
+        ("book", "livre"),
+        ("tree", "arbre"),
+        ("bread", "pain"),
+        ("apple", "pomme"),
+    ]:
+        for word in [en_word, fr_word]:
+            words.extend([word, " " + word, word.capitalize(), " " + word.capitalize()])
+    tokenizer = Tokenizer(WordLevel({w: i for i, w in enumerate(words)}, "<unk>"))
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, unk_token="<unk>", pad_token="<unk>"
+    )
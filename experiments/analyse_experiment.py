@@ -5,6 +5,8 @@ import shap
 from IPython.core.getipython import get_ipython
 from sklearn.ensemble import RandomForestRegressor
 
+from auto_embeds.results_store import ResultsStore
+from auto_embeds.utils.logging import logger
 from auto_embeds.utils.neptune import (
     fetch_neptune_runs_df,
     process_neptune_runs_df,
@@ -28,12 +30,20 @@ tags = experiment_config["neptune"]["tags"]
 if visualise_all_run_groups:
     tags = [tag for tag in tags if "run group" not in tag]
 
-# fetch_neptune_runs_df.clear_cache()
-original_df = fetch_neptune_runs_df(
-    project_name=project_name,
-    tags=tags,
-    get_artifacts=True,
-)
+# load the runs from the local results store written by run_experiment rather than
+# fetching them (and their artifacts) from neptune, falling back to neptune for runs
+# that were never written to the store (e.g. those from before it existed)
+results_store_config = experiment_config.get("results_store") or {}
+original_df = ResultsStore(results_store_config.get("directory")).load_runs_df(
+    tags=tags
+)
+if len(original_df) == 0:
+    logger.warning(f"no runs tagged {tags} in the results store, fetching from neptune")
+    original_df = fetch_neptune_runs_df(
+        project_name=project_name,
+        tags=tags,
+        get_artifacts=True,
+    )
 
 # %%
 (
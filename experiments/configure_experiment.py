@@ -7,6 +7,9 @@ from auto_embeds.utils.logging import logger
 
 num_workers = 2
 
+# the keys of experiment_config that configure the experiment rather than being swept
+NON_RUN_CONFIG_KEYS = {"neptune", "instrumentation", "results_store"}
+
 # configuration for overall experiments
 experiment_config = {
     "neptune": {
@@ -20,6 +23,15 @@ experiment_config = {
         # "mode": "debug",
         "mode": "async",
     },
+    # stage-level timing and memory spans, see auto_embeds.utils.instrument
+    "instrumentation": {
+        "trace_path": "instrumentation/trace.jsonl",
+        # "trace_format": "chrome",
+        "log_to_neptune": True,
+    },
+    # a local copy of every run, see auto_embeds.results_store. the directory defaults
+    # to AUTOEMBEDS_RESULTS_DIR or results/ in the repo
+    "results_store": {"directory": None},
     "description": ["none"],
     "models": [
         "bigscience/bloom-560m",
@@ -142,7 +154,9 @@ def get_config_list(config_dict: Dict[str, List]) -> List[tuple]:
 
 
 def get_total_runs(experiment_config: Dict[str, List]) -> int:
-    experiment_config = {k: v for k, v in experiment_config.items() if k != "neptune"}
+    experiment_config = {
+        k: v for k, v in experiment_config.items() if k not in NON_RUN_CONFIG_KEYS
+    }
     config_list = get_config_list(experiment_config)
     return len(config_list)
 
@@ -6,7 +6,10 @@ import plotly.graph_objects as go
 import plotly.io as pio
 from plotly.subplots import make_subplots
 
+from auto_embeds.results_store import ResultsStore
+from auto_embeds.utils.logging import logger
 from auto_embeds.utils.neptune import fetch_neptune_runs_df, process_neptune_runs_df
+from experiments.configure_experiment import experiment_config
 
 
 def generate_train_loss_figure(color_var, df, highlighted_name=None):
@@ -244,11 +247,20 @@ def generate_parallel_categories_plot(
     return fig
 
 
-original_df = fetch_neptune_runs_df(
-    project_name="mars/language-transformations",
-    tags=["actual", "2024-04-29 analytical and ln", "experiment 3"],
-    get_artifacts=True,
+tags = ["actual", "2024-04-29 analytical and ln", "experiment 3"]
+# loading the runs from the local results store as in analyse_experiment, falling
+# back to neptune for runs that were never written to the store
+results_store_config = experiment_config.get("results_store") or {}
+original_df = ResultsStore(results_store_config.get("directory")).load_runs_df(
+    tags=tags
 )
+if len(original_df) == 0:
+    logger.warning(f"no runs tagged {tags} in the results store, fetching from neptune")
+    original_df = fetch_neptune_runs_df(
+        project_name="mars/language-transformations",
+        tags=tags,
+        get_artifacts=True,
+    )
 
 runs_df = process_neptune_runs_df(
     original_df,
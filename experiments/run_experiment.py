@@ -1,7 +1,7 @@
 # %%
 import json
-import multiprocessing as mp
 import os
+from functools import partial
 
 os.environ["TOKENIZERS_PARALLELISM"] = "FALSE"
 os.environ["AUTOEMBEDS_CACHING"] = "TRUE"
@@ -16,7 +16,12 @@ from torch.utils.data import DataLoader, SubsetRandomSampler
 from transformers import AutoTokenizer
 
 from auto_embeds.analytical import initialize_manual_transform
-from auto_embeds.data import filter_word_pairs, get_cached_weights, get_dataset_path
+from auto_embeds.data import (
+    filter_word_pairs,
+    get_cached_weights,
+    get_dataset_path,
+    load_word_pairs,
+)
 from auto_embeds.embed_utils import (
     initialize_embed_and_unembed,
     initialize_transform_and_optim,
@@ -26,9 +31,16 @@ from auto_embeds.metrics import (
     calc_metrics,
     initialize_loss,
 )
+from auto_embeds.results_store import ResultsStore
 from auto_embeds.utils.custom_tqdm import tqdm
+from auto_embeds.utils.instrument import (
+    Instrumentation,
+    get_instrumentation,
+    instrument,
+    span,
+)
 from auto_embeds.utils.logging import logger
-from auto_embeds.utils.misc import get_experiment_worker_config
+from auto_embeds.utils.neptune import fetch_neptune_id
 from auto_embeds.verify import (
     plot_cos_sim_trend,
     prepare_verify_analysis,
@@ -37,95 +49,160 @@ from auto_embeds.verify import (
     verify_transform,
 )
 from experiments.configure_experiment import (
+    NON_RUN_CONFIG_KEYS,
     experiment_config,
     get_config_list,
-    total_runs,
 )
+from experiments.sweep import StageCache, plan_runs, run_sweep
+
 
+def run_experiment_parallel(config_dict, num_workers, max_chunk_size=None):
+    """Runs every config of an experiment on a pool of num_workers processes.
 
-def run_experiment_parallel(config, num_workers):
-    logger.info(f"total runs: {total_runs}")
-    logger.info(f"running experiment with config: {config}")
+    Returns:
+        A SweepResult (the run config, its results, duration and worker) per run, in
+        the order of get_config_list.
+    """
+    neptune_config = config_dict.get("neptune", {})
+    instrumentation_config = config_dict.get("instrumentation", {})
+    results_store_config = config_dict.get("results_store")
+    run_configs = get_run_configs(config_dict)
+    logger.info(f"total runs: {len(run_configs)}")
+    logger.info(f"running experiment with config: {config_dict}")
     logger.info(f"using {num_workers} workers")
-    mp.set_start_method("spawn", force=True)
-    tasks = [(i, config, "datasets", num_workers) for i in range(1, num_workers + 1)]
-    with mp.Pool(num_workers) as pool:
-        results = pool.starmap(run_worker, tasks)
-    return [item for sublist in results for item in sublist]
-
-
-def run_worker(worker_id, experiment_config, split_parameter="datasets", n_splits=2):
-    config_to_use = get_experiment_worker_config(
-        experiment_config=experiment_config,
-        split_parameter=split_parameter,
-        n_splits=n_splits,
-        worker_id=worker_id,
+    return run_sweep(
+        run_configs,
+        partial(
+            run_single_experiment,
+            neptune_config=neptune_config,
+            instrumentation_config=instrumentation_config,
+            results_store_config=results_store_config,
+        ),
+        num_workers=num_workers,
+        max_chunk_size=max_chunk_size,
     )
-    print(f"Running experiment for worker ID = {worker_id}")
-    return run_experiment(config_to_use)
+
+
+RUN_CONFIG_KEYS = [
+    "description",
+    "model_name",
+    "processing",
+    "dataset",
+    "transformation",
+    "train_batch_size",
+    "test_batch_size",
+    "top_k",
+    "top_k_selection_method",
+    "seed",
+    "loss_function",
+    "embed_weight",
+    "embed_ln_weights",
+    "unembed_weight",
+    "unembed_ln_weights",
+    "n_epoch",
+    "weight_decay",
+    "lr",
+]
+
+
+def get_run_configs(config_dict):
+    config_dict = {k: v for k, v in config_dict.items() if k not in NON_RUN_CONFIG_KEYS}
+    return [
+        dict(zip(RUN_CONFIG_KEYS, config)) for config in get_config_list(config_dict)
+    ]
 
 
 def run_experiment(config_dict, return_local_results=False):
     local_results = []
     # extracting 'neptune' configuration and generating all combinations of configs
-    # as a list of lists
-    run = None
+    # as a list of run configs, ordered so that runs sharing upstream stages are
+    # consecutive
     neptune_config = config_dict.get("neptune", {})
-    config_dict = {k: v for k, v in config_dict.items() if k != "neptune"}
-    config_list = get_config_list(config_dict)
-    last_model_config = None
-    model_weights = None
-
-    for (
-        description,
-        model_name,
-        processing,
-        dataset_config,
-        transformation,
-        train_batch_size,
-        test_batch_size,
-        top_k,
-        top_k_selection_method,
-        seed,
-        loss_function,
-        embed_weight,
-        embed_ln_weights,
-        unembed_weight,
-        unembed_ln_weights,
-        n_epoch,
-        weight_decay,
-        lr,
-    ) in tqdm(config_list, total=len(config_list)):
-
-        embed_ln = True if embed_ln_weights != "no_ln" else False
-        unembed_ln = True if unembed_ln_weights != "no_ln" else False
-
-        run_config = {
-            "description": description,
-            "model_name": model_name,
-            "processing": processing,
-            "dataset": dataset_config,
-            "transformation": transformation,
-            "train_batch_size": train_batch_size,
-            "test_batch_size": test_batch_size,
-            "top_k": top_k,
-            "top_k_selection_method": top_k_selection_method,
-            "seed": seed,
-            "loss_function": loss_function,
-            "embed_weight": embed_weight,
-            "embed_ln": embed_ln,
-            "embed_ln_weights": embed_ln_weights,
-            "unembed_weight": unembed_weight,
-            "unembed_ln": unembed_ln,
-            "unembed_ln_weights": unembed_ln_weights,
-            "n_epoch": n_epoch,
-            "weight_decay": weight_decay,
-            "lr": lr,
-        }
+    instrumentation_config = config_dict.get("instrumentation", {})
+    results_store_config = config_dict.get("results_store")
+    run_configs = plan_runs(get_run_configs(config_dict))
+    stage_cache = StageCache()
+
+    for run_config in tqdm(run_configs, total=len(run_configs)):
+        results = run_single_experiment(
+            run_config,
+            stage_cache,
+            neptune_config,
+            instrumentation_config,
+            results_store_config,
+        )
+        if return_local_results:
+            local_results.append(results)
+
+    logger.info(f"stage cache hits: {stage_cache.hits}, misses: {stage_cache.misses}")
+    return local_results
 
-        logger.info(f"Running experiment with config: {run_config}")
 
-        # neptune run init
+def run_single_experiment(
+    run_config,
+    stage_cache,
+    neptune_config,
+    instrumentation_config=None,
+    results_store_config=None,
+):
+    """Runs a single config, recording its stages as spans of an Instrumentation.
+
+    Args:
+        run_config: The config of the run.
+        stage_cache: The StageCache holding the results of the stages of earlier runs.
+        neptune_config: The tags and mode of the Neptune run.
+        instrumentation_config: Optional; the trace_path and trace_format of the
+            Instrumentation (see auto_embeds.utils.instrument) and whether to
+            log_to_neptune its spans (defaults to True).
+        results_store_config: Optional; if given, the run is also written to the
+            ResultsStore in its directory (see auto_embeds.results_store).
+
+    Returns:
+        The train and test metrics of the run.
+    """
+    instrumentation_config = instrumentation_config or {}
+    instrumentation = Instrumentation(
+        trace_path=instrumentation_config.get("trace_path"),
+        trace_format=instrumentation_config.get("trace_format", "jsonl"),
+    )
+    with instrument(instrumentation):
+        with span("run", model_name=run_config["model_name"]):
+            results = _run_single_experiment(
+                run_config,
+                stage_cache,
+                neptune_config,
+                log_instrumentation=instrumentation_config.get("log_to_neptune", True),
+                results_store_config=results_store_config,
+            )
+    instrumentation.log_summary()
+    return results
+
+
+def _run_single_experiment(
+    run_config,
+    stage_cache,
+    neptune_config,
+    log_instrumentation=True,
+    results_store_config=None,
+):
+    model_name = run_config["model_name"]
+    processing = run_config["processing"]
+    dataset_config = run_config["dataset"]
+    transformation = run_config["transformation"]
+    embed_ln_weights = run_config["embed_ln_weights"]
+    unembed_ln_weights = run_config["unembed_ln_weights"]
+    embed_ln = True if embed_ln_weights != "no_ln" else False
+    unembed_ln = True if unembed_ln_weights != "no_ln" else False
+    run_config = {
+        **run_config,
+        "embed_ln": embed_ln,
+        "unembed_ln": unembed_ln,
+    }
+
+    logger.info(f"Running experiment with config: {run_config}")
+
+    # neptune run init
+    with span("neptune_init"):
         run = neptune.init_run(
             project="mars/language-transformations",
             tags=neptune_config.get("tags", []),
@@ -133,104 +210,126 @@ def run_experiment(config_dict, return_local_results=False):
         )
         run["config"] = stringify_unsupported(run_config)
 
-        # tokenizer setup
-        tokenizer = AutoTokenizer.from_pretrained(model_name)
+    # tokenizer setup
+    tokenizer = stage_cache.get(
+        "tokenizer", run_config, lambda: AutoTokenizer.from_pretrained(model_name)
+    )
 
-        # model weights setup
-        current_model_config = (model_name, processing)
-        if model_weights is None or current_model_config != last_model_config:
-            model_weights = get_cached_weights(model_name, processing)
-            last_model_config = current_model_config
-        d_model = model_weights["W_E"].shape[1]
+    # model weights setup
+    model_weights = stage_cache.get(
+        "model_weights",
+        run_config,
+        lambda: get_cached_weights(model_name, processing),
+    )
+    d_model = model_weights["W_E"].shape[1]
 
-        embed_module, unembed_module = initialize_embed_and_unembed(
+    embed_module, unembed_module = stage_cache.get(
+        "embed_and_unembed",
+        run_config,
+        lambda: initialize_embed_and_unembed(
             tokenizer=tokenizer,
             model_weights=model_weights,
-            embed_weight=embed_weight,
+            embed_weight=run_config["embed_weight"],
             embed_ln=embed_ln,
             embed_ln_weights=embed_ln_weights,
-            unembed_weight=unembed_weight,
+            unembed_weight=run_config["unembed_weight"],
             unembed_ln=unembed_ln,
             unembed_ln_weights=unembed_ln_weights,
-        )
-
-        # dataset filtering
-        dataset_name = dataset_config["name"]
-        file_path = get_dataset_path(dataset_name)
-        with open(file_path, "r", encoding="utf-8") as file:
-            word_pairs = json.load(file)
+        ),
+    )
 
-        all_word_pairs = filter_word_pairs(
+    # dataset filtering
+    all_word_pairs = stage_cache.get(
+        "word_pairs",
+        run_config,
+        lambda: filter_word_pairs(
             tokenizer=tokenizer,
-            word_pairs=word_pairs,
+            word_pairs=load_word_pairs(get_dataset_path(dataset_config["name"])),
             discard_if_same=True,
             min_length=dataset_config["min_length"],
             space_configurations=dataset_config["space_configurations"],
             print_number=True,
             verbose_count=True,
-        )
+        ),
+    )
 
-        # prepare datasets
-        verify_learning = prepare_verify_analysis(
+    # prepare datasets
+    verify_learning = stage_cache.get(
+        "verify_analysis",
+        run_config,
+        lambda: prepare_verify_analysis(
             tokenizer=tokenizer,
             embed_module=embed_module,
             all_word_pairs=all_word_pairs,
-            seed=seed,
-        )
+            seed=run_config["seed"],
+        ),
+    )
 
-        train_loader, test_loader = prepare_verify_datasets(
+    train_loader, test_loader = stage_cache.get(
+        "loaders",
+        run_config,
+        lambda: prepare_verify_datasets(
             verify_learning=verify_learning,
-            batch_sizes=(train_batch_size, test_batch_size),
-            top_k=top_k,
-            top_k_selection_method=top_k_selection_method,
+            batch_sizes=(run_config["train_batch_size"], run_config["test_batch_size"]),
+            top_k=run_config["top_k"],
+            top_k_selection_method=run_config["top_k_selection_method"],
             return_type="dataloader",
+        ),
+    )
+    # the shuffle generator of a memoized train loader carries on from the state the
+    # previous run left it in, so it is reset to the state of a freshly built loader
+    # to keep each run's batch order independent of the runs before it
+    train_loader.generator.manual_seed(train_loader.generator.initial_seed())
+
+    if "mark_accuracy_path" in dataset_config:
+        azure_translations_path = get_dataset_path(dataset_config["mark_accuracy_path"])
+    else:
+        azure_translations_path = None
+
+    # initialize transformation and optimizer
+    if "analytical" in transformation:
+        transform = initialize_manual_transform(
+            transform_name=transformation,
+            train_loader=train_loader,
         )
-
-        if "mark_accuracy_path" in dataset_config:
-            azure_translations_path = get_dataset_path(
-                dataset_config["mark_accuracy_path"]
-            )
-        else:
-            azure_translations_path = None
-
-        # initialize transformation and optimizer
-        if "analytical" in transformation:
-            transform = initialize_manual_transform(
-                transform_name=transformation,
-                train_loader=train_loader,
-            )
-            optim = None
-        else:
+        optim = None
+    else:
+        with span("initialize_transform_and_optim"):
             transform, optim = initialize_transform_and_optim(
                 d_model,
                 transformation=transformation,
-                optim_kwargs={"lr": lr, "weight_decay": weight_decay},
+                optim_kwargs={
+                    "lr": run_config["lr"],
+                    "weight_decay": run_config["weight_decay"],
+                },
             )
 
-        loss_module = initialize_loss(loss_function)
-
-        if optim is not None:
-            transform, loss_history = train_transform(
-                tokenizer=tokenizer,
-                train_loader=train_loader,
-                test_loader=test_loader,
-                transform=transform,
-                optim=optim,
-                unembed_module=unembed_module,
-                loss_module=loss_module,
-                n_epochs=n_epoch,
-                plot_fig=False,
-                neptune_run=run,
-                azure_translations_path=azure_translations_path,
-            )
+    loss_module = initialize_loss(run_config["loss_function"])
 
-        subset_indices = t.randint(len(train_loader.dataset), (512,))  # type: ignore
-        train_loader_sample = DataLoader(
-            train_loader.dataset,
-            batch_size=512,
-            sampler=SubsetRandomSampler(subset_indices),
+    loss_history = None
+    if optim is not None:
+        transform, loss_history = train_transform(
+            tokenizer=tokenizer,
+            train_loader=train_loader,
+            test_loader=test_loader,
+            transform=transform,
+            optim=optim,
+            unembed_module=unembed_module,
+            loss_module=loss_module,
+            n_epochs=run_config["n_epoch"],
+            plot_fig=False,
+            neptune_run=run,
+            azure_translations_path=azure_translations_path,
         )
 
+    subset_indices = t.randint(len(train_loader.dataset), (512,))  # type: ignore
+    train_loader_sample = DataLoader(
+        train_loader.dataset,
+        batch_size=512,
+        sampler=SubsetRandomSampler(subset_indices),
+    )
+
+    with span("train_metrics"):
         train_metrics = calc_metrics(
             train_loader_sample,
             transform,
@@ -238,17 +337,19 @@ def run_experiment(config_dict, return_local_results=False):
             unembed_module,
             azure_translations_path,
         )
+    with span("test_metrics"):
         test_metrics = calc_metrics(
             test_loader, transform, tokenizer, unembed_module, azure_translations_path
         )
 
-        verify_results_dict = verify_transform(
-            tokenizer=tokenizer,
-            transformation=transform,
-            test_loader=test_loader,
-            unembed_module=unembed_module,
-        )
+    verify_results_dict = verify_transform(
+        tokenizer=tokenizer,
+        transformation=transform,
+        test_loader=test_loader,
+        unembed_module=unembed_module,
+    )
 
+    with span("verify_results_artifacts"):
         cos_sims_trend_plot = plot_cos_sim_trend(verify_results_dict)
         verify_results_json = json.dumps(
             {
@@ -263,35 +364,53 @@ def run_experiment(config_dict, return_local_results=False):
             }
         )
 
-        # logging results
-
+    # logging results
+    with span("neptune_upload"):
         run["results"] = {
             "train": train_metrics,
             "test": test_metrics,
         }
 
+        cos_sims_trend_plot_json = str(pio.to_json(cos_sims_trend_plot))
         run["results/test/cos_sims_trend_plot"].upload(cos_sims_trend_plot)
         run["results/test/json/verify_results"].upload(
             File.from_content(verify_results_json)
         )
         run["results/test/json/cos_sims_trend_plot"].upload(
-            File.from_content(str(pio.to_json(cos_sims_trend_plot)))
+            File.from_content(cos_sims_trend_plot_json)
         )
         run["results/test/json/test_cos_sim_diff"].upload(
             File.from_content(test_cos_sim_diff)
         )
 
-        if return_local_results:
-            local_results = {
-                "train": train_metrics,
-                "test": test_metrics,
-            }
-
-        # returning results that we are not uploading for local analysis
-        # transform_weights = transform.state_dict()
-        # results["transform_weights"] = transform_weights
+    # a local copy of the run for offline analysis with ResultsStore.load_runs_df
+    if results_store_config is not None:
+        with span("results_store_write"):
+            ResultsStore(results_store_config.get("directory")).write_run(
+                neptune_id=fetch_neptune_id(run, neptune_config.get("mode", "async")),
+                tags=neptune_config.get("tags", []),
+                config=run_config,
+                results={"train": train_metrics, "test": test_metrics},
+                histories=loss_history,
+                artifacts={
+                    "cos_sims_trend_plot": cos_sims_trend_plot_json,
+                    "test_cos_sim_diff": test_cos_sim_diff,
+                    "verify_results": verify_results_json,
+                },
+            )
 
-    return local_results
+    # the spans of the run so far, i.e. all but the enclosing run span
+    instrumentation = get_instrumentation()
+    if log_instrumentation and instrumentation is not None:
+        instrumentation.log_to_neptune(run)
+
+    # returning results that we are not uploading for local analysis
+    # transform_weights = transform.state_dict()
+    # results["transform_weights"] = transform_weights
+    return {
+        "train": train_metrics,
+        "test": test_metrics,
+    }
 
 
 if __name__ == "__main__":
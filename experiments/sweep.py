@@ -0,0 +1,269 @@
+import itertools
+import json
+import math
+import multiprocessing as mp
+import os
+import time
+from typing import Any, Callable, Dict, Hashable, List, NamedTuple, Optional, Tuple
+
+from auto_embeds.utils.instrument import span
+from auto_embeds.utils.logging import logger
+
+# the stages of a run, each with the run config fields its result depends on in
+# addition to the fields of the stages before it. the dependency DAG is linearised into
+# this chain with the most expensive stages (model weights and their embed/unembed
+# copies) first, which only leaves cheap or disk-cached stages (the tokenizer and
+# filter_word_pairs) recomputed more often than strictly needed.
+STAGES: List[Tuple[str, List[str]]] = [
+    ("tokenizer", ["model_name"]),
+    ("model_weights", ["processing"]),
+    (
+        "embed_and_unembed",
+        [
+            "embed_weight",
+            "embed_ln_weights",
+            "unembed_weight",
+            "unembed_ln_weights",
+        ],
+    ),
+    ("word_pairs", ["dataset"]),
+    ("verify_analysis", ["seed"]),
+    (
+        "loaders",
+        ["train_batch_size", "test_batch_size", "top_k", "top_k_selection_method"],
+    ),
+]
+
+# maps each stage to all the fields it depends on, including those of earlier stages
+STAGE_FIELDS: Dict[str, List[str]] = {
+    stage: [field for _, fields in STAGES[: i + 1] for field in fields]
+    for i, (stage, _) in enumerate(STAGES)
+}
+
+
+def _field_key(value: Any) -> str:
+    # dataset configs are dicts, so values are compared by their json
+    return json.dumps(value, sort_keys=True, default=str)
+
+
+def stage_key(stage: str, run_config: Dict[str, Any]) -> Tuple[str, ...]:
+    """Returns the key identifying the result of a stage for a run config.
+
+    Args:
+        stage: The name of the stage, one of the names in STAGES.
+        run_config: The config of the run.
+
+    Returns:
+        A tuple of the (json encoded) values of every field the stage depends on.
+    """
+    return tuple(_field_key(run_config[field]) for field in STAGE_FIELDS[stage])
+
+
+def plan_runs(run_configs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Orders runs so that runs sharing expensive upstream stages run consecutively.
+
+    The stages form a chain (tokenizer -> model weights -> embed/unembed -> filtered
+    word pairs -> verify analysis -> loaders -> transform -> metrics), so sorting the
+    runs by the fields of the stages in that order groups every shared prefix of the
+    chain together. With a StageCache holding the last result of each stage, each
+    distinct stage key is then computed exactly once. The sort is stable, so runs that
+    only differ in per-run fields (e.g. transformation or lr) keep their order.
+
+    Args:
+        run_configs: The configs of the runs.
+
+    Returns:
+        The run configs in execution order.
+    """
+    all_fields = STAGE_FIELDS[STAGES[-1][0]]
+    return sorted(
+        run_configs,
+        key=lambda run_config: [_field_key(run_config[f]) for f in all_fields],
+    )
+
+
+class StageCache:
+    """Memoizes the result of each stage of a sweep in-process.
+
+    Only the most recent result of each stage is kept. As plan_runs orders the runs so
+    that a stage key never comes back once it has changed, this gives the same reuse
+    as keeping every result while holding at most one result (e.g. one set of model
+    weights) per stage in memory.
+    """
+
+    def __init__(self):
+        self._results: Dict[str, Tuple[Hashable, Any]] = {}
+        self.hits: Dict[str, int] = {stage: 0 for stage, _ in STAGES}
+        self.misses: Dict[str, int] = {stage: 0 for stage, _ in STAGES}
+
+    def get(
+        self, stage: str, run_config: Dict[str, Any], compute: Callable[[], Any]
+    ) -> Any:
+        """Returns the result of a stage for a run, computing it if it changed.
+
+        Computing a stage is recorded as a stage/<stage> span of the current
+        instrumentation, see auto_embeds.utils.instrument.
+
+        Args:
+            stage: The name of the stage, one of the names in STAGES.
+            run_config: The config of the run.
+            compute: Computes the result of the stage.
+
+        Returns:
+            The result of the stage.
+        """
+        key = stage_key(stage, run_config)
+        if stage in self._results and self._results[stage][0] == key:
+            self.hits[stage] += 1
+            return self._results[stage][1]
+        self.misses[stage] += 1
+        # drop the stale result first so that it can be freed while computing
+        self._results.pop(stage, None)
+        with span(f"stage/{stage}"):
+            result = compute()
+        self._results[stage] = (key, result)
+        logger.debug(f"computed stage {stage} for {key}")
+        return result
+
+
+class SweepResult(NamedTuple):
+    """The outcome of one run of a sweep.
+
+    Attributes:
+        run_config: The config of the run.
+        result: What the run function returned.
+        duration: The wall time of the run in seconds.
+        worker: The pid of the process that executed the run.
+    """
+
+    run_config: Dict[str, Any]
+    result: Any
+    duration: float
+    worker: int
+
+
+def chunk_runs(
+    run_configs: List[Dict[str, Any]], max_chunk_size: int
+) -> List[List[Tuple[int, Dict[str, Any]]]]:
+    """Splits runs into chunks of runs sharing model weights.
+
+    The runs are ordered with plan_runs and grouped by their model_weights stage key,
+    then each group is split into chunks of at most max_chunk_size runs, so a worker
+    executing a chunk loads the model once while large groups are still spread over
+    several workers.
+
+    Args:
+        run_configs: The configs of the runs.
+        max_chunk_size: The maximum number of runs in a chunk.
+
+    Returns:
+        The chunks, each a list of (index of the run in run_configs, run config).
+    """
+    indexed = {id(run_config): i for i, run_config in enumerate(run_configs)}
+    chunks = []
+    for _, group in itertools.groupby(
+        plan_runs(run_configs),
+        key=lambda run_config: stage_key("model_weights", run_config),
+    ):
+        group = [(indexed[id(run_config)], run_config) for run_config in group]
+        for start in range(0, len(group), max_chunk_size):
+            chunks.append(group[start : start + max_chunk_size])
+    return chunks
+
+
+# the stage cache of a worker process, kept across the chunks it executes
+_worker_stage_cache: Optional[StageCache] = None
+
+
+def _init_worker() -> None:
+    global _worker_stage_cache
+    _worker_stage_cache = StageCache()
+
+
+def _run_chunk(
+    run_fn: Callable[[Dict[str, Any], StageCache], Any],
+    chunk: List[Tuple[int, Dict[str, Any]]],
+    stage_cache: StageCache,
+) -> List[Tuple[int, SweepResult]]:
+    results = []
+    for index, run_config in chunk:
+        start = time.perf_counter()
+        result = run_fn(run_config, stage_cache)
+        duration = time.perf_counter() - start
+        results.append((index, SweepResult(run_config, result, duration, os.getpid())))
+    return results
+
+
+def _run_chunk_in_worker(
+    task: Tuple[Callable[[Dict[str, Any], StageCache], Any], List],
+) -> List[Tuple[int, SweepResult]]:
+    assert _worker_stage_cache is not None
+    run_fn, chunk = task
+    return _run_chunk(run_fn, chunk, _worker_stage_cache)
+
+
+def run_sweep(
+    run_configs: List[Dict[str, Any]],
+    run_fn: Callable[[Dict[str, Any], StageCache], Any],
+    num_workers: int,
+    max_chunk_size: Optional[int] = None,
+) -> List[SweepResult]:
+    """Executes the runs of a sweep on a pool of spawned worker processes.
+
+    The runs are split into chunks with chunk_runs and put on the pool's shared task
+    queue, from which idle workers take the next chunk, so the work is balanced however
+    unevenly the runs are distributed over the config. Every worker keeps a StageCache
+    across the chunks it executes. With num_workers <= 1 the runs are executed in this
+    process instead.
+
+    Args:
+        run_configs: The configs of the runs.
+        run_fn: Called as run_fn(run_config, stage_cache) for every run. Must be
+            picklable, i.e. defined at module level (or a functools.partial of such a
+            function), as the workers are spawned.
+        num_workers: The number of worker processes.
+        max_chunk_size: The maximum number of runs in a chunk. Defaults to splitting
+            the runs into about two chunks per worker.
+
+    Returns:
+        A SweepResult for every run, in the order of run_configs regardless of the
+        order the runs finished in.
+    """
+    if max_chunk_size is None:
+        max_chunk_size = max(1, math.ceil(len(run_configs) / (2 * num_workers)))
+    chunks = chunk_runs(run_configs, max_chunk_size)
+    logger.info(
+        f"running {len(run_configs)} runs in {len(chunks)} chunks on "
+        f"{num_workers} workers"
+    )
+
+    results: Dict[int, SweepResult] = {}
+
+    def collect(chunk_results: List[Tuple[int, SweepResult]]) -> None:
+        for index, sweep_result in chunk_results:
+            results[index] = sweep_result
+            logger.info(
+                f"run {len(results)}/{len(run_configs)} finished in "
+                f"{sweep_result.duration:.1f}s on worker {sweep_result.worker}"
+            )
+
+    start = time.perf_counter()
+    if num_workers <= 1:
+        stage_cache = StageCache()
+        for chunk in chunks:
+            collect(_run_chunk(run_fn, chunk, stage_cache))
+    else:
+        # an explicit spawn context leaves the global start method untouched
+        context = mp.get_context("spawn")
+        with context.Pool(num_workers, initializer=_init_worker) as pool:
+            tasks = pool.imap_unordered(
+                _run_chunk_in_worker, [(run_fn, chunk) for chunk in chunks]
+            )
+            for chunk_results in tasks:
+                collect(chunk_results)
+    total_duration = time.perf_counter() - start
+    run_duration = sum(sweep_result.duration for sweep_result in results.values())
+    logger.info(
+        f"sweep finished in {total_duration:.1f}s ({run_duration:.1f}s of runs)"
+    )
+    return [results[index] for index in range(len(run_configs))]
@@ -0,0 +1,193 @@
+import pytest
+import torch as t
+from torch.utils.data import DataLoader, TensorDataset
+
+from auto_embeds.analytical import (
+    EmbeddingStatistics,
+    calc_linear_map,
+    calc_orthogonal_procrustes,
+    calc_procrustes_roma,
+    calc_translation,
+    initialize_manual_transform,
+    initialize_manual_transforms,
+    solve_linear_map_batched,
+    solve_orthogonal_procrustes_batched,
+)
+
+
+@pytest.fixture
+def embeds():
+    t.manual_seed(0)
+    n, d_model = 200, 16
+    src_embeds = t.randn(n, 1, d_model)
+    rotation = t.linalg.qr(t.randn(d_model, d_model)).Q
+    tgt_embeds = src_embeds @ rotation.T + 0.5 + 0.1 * t.randn(n, 1, d_model)
+    return src_embeds, tgt_embeds
+
+
+def test_streaming_statistics_match_in_memory_solvers(embeds):
+    src_embeds, tgt_embeds = embeds
+    loader = DataLoader(TensorDataset(src_embeds, tgt_embeds), batch_size=32)
+    stats = EmbeddingStatistics.from_loader(loader, gram=True, device="cpu")
+
+    assert stats.n == len(src_embeds)
+    t.testing.assert_close(
+        stats.translation(), calc_translation(src_embeds, tgt_embeds)
+    )
+    for ensure_rotation in [False, True]:
+        R, scale = stats.orthogonal_procrustes(ensure_rotation=ensure_rotation)
+        expected_R, expected_scale = calc_orthogonal_procrustes(
+            src_embeds, tgt_embeds, ensure_rotation=ensure_rotation
+        )
+        t.testing.assert_close(R, expected_R, atol=1e-4, rtol=1e-4)
+        t.testing.assert_close(scale, expected_scale)
+    R, scale = stats.procrustes_roma()
+    expected_R, expected_scale = calc_procrustes_roma(src_embeds, tgt_embeds)
+    t.testing.assert_close(R, expected_R, atol=1e-4, rtol=1e-4)
+    t.testing.assert_close(scale, expected_scale)
+    t.testing.assert_close(
+        stats.linear_map(),
+        calc_linear_map(src_embeds, tgt_embeds),
+        atol=1e-4,
+        rtol=1e-4,
+    )
+
+
+def test_orthogonal_procrustes_ensure_rotation_is_optimal_rotation():
+    t.manual_seed(0)
+    d_model = 8
+    src_embeds = t.randn(100, d_model)
+    # a reflection, so the best orthogonal map has determinant -1
+    reflection = t.eye(d_model)
+    reflection[0, 0] = -1.0
+    tgt_embeds = src_embeds @ reflection.T
+    stats = EmbeddingStatistics(d_model, device="cpu")
+    stats.update(src_embeds, tgt_embeds)
+
+    R, _ = stats.orthogonal_procrustes(ensure_rotation=True)
+
+    assert t.det(R) > 0
+    # flipping any other single axis would leave a larger residual
+    residual = (src_embeds @ R.T - tgt_embeds).square().sum()
+    for axis in range(1, d_model):
+        other = t.eye(d_model)
+        other[0, 0], other[axis, axis] = -1.0, -1.0
+        assert residual <= (src_embeds @ other.T - tgt_embeds).square().sum() + 1e-3
+
+
+@pytest.mark.parametrize(
+    "transform_name",
+    [
+        "analytical_translation",
+        "analytical_rotation",
+        "analytical_rotation_and_reflection",
+        "analytical_linear_map",
+        "roma_scale_analytical",
+    ],
+)
+def test_initialize_manual_transform_fits_data(embeds, transform_name):
+    src_embeds, tgt_embeds = embeds
+    # centre the data so that the rotations alone can fit it
+    if transform_name != "analytical_translation":
+        tgt_embeds = tgt_embeds - 0.5
+    loader = DataLoader(TensorDataset(src_embeds, tgt_embeds), batch_size=64)
+
+    transform = initialize_manual_transform(transform_name, loader, device="cpu")
+
+    residual = (transform(src_embeds) - tgt_embeds).square().mean()
+    assert residual < (src_embeds - tgt_embeds).square().mean()
+
+
+def test_initialize_manual_transform_unknown_name(embeds):
+    loader = DataLoader(TensorDataset(*embeds), batch_size=64)
+    with pytest.raises(ValueError):
+        initialize_manual_transform("analytical_nonsense", loader, device="cpu")
+
+
+def make_problems(d_models, n=100):
+    t.manual_seed(0)
+    problems = []
+    for d_model in d_models:
+        src_embeds = t.randn(n, 1, d_model)
+        tgt_embeds = src_embeds @ t.randn(d_model, d_model) + 0.1 * t.randn(
+            n, 1, d_model
+        )
+        problems.append((src_embeds, tgt_embeds))
+    # a reflection, so that ensure_rotation has to flip an axis
+    reflection = t.eye(d_models[0])
+    reflection[0, 0] = -1.0
+    problems.append((problems[0][0], problems[0][0] @ reflection.T))
+    return problems
+
+
+def test_batched_solvers_match_per_problem_solvers():
+    problems = make_problems([8, 12, 5])
+    stats = []
+    for src_embeds, tgt_embeds in problems:
+        problem_stats = EmbeddingStatistics(src_embeds.shape[-1], True, device="cpu")
+        problem_stats.update(src_embeds, tgt_embeds)
+        stats.append(problem_stats)
+
+    for ensure_rotation in [False, True]:
+        solutions = solve_orthogonal_procrustes_batched(stats, ensure_rotation)
+        for problem_stats, (R, scale) in zip(stats, solutions):
+            expected_R, expected_scale = problem_stats.orthogonal_procrustes(
+                ensure_rotation
+            )
+            t.testing.assert_close(R, expected_R, atol=1e-5, rtol=1e-5)
+            t.testing.assert_close(scale, expected_scale, atol=1e-4, rtol=1e-5)
+    for problem_stats, X in zip(stats, solve_linear_map_batched(stats)):
+        t.testing.assert_close(X, problem_stats.linear_map(), atol=1e-4, rtol=1e-4)
+
+
+def test_solve_linear_map_batched_falls_back_for_singular_problems():
+    # fewer samples than dimensions, so the gram matrix is singular
+    problems = make_problems([8, 16], n=10)[:2]
+    stats = []
+    for src_embeds, tgt_embeds in problems:
+        problem_stats = EmbeddingStatistics(src_embeds.shape[-1], True, device="cpu")
+        problem_stats.update(src_embeds, tgt_embeds)
+        stats.append(problem_stats)
+
+    X = solve_linear_map_batched(stats)[1]
+
+    t.testing.assert_close(X, stats[1].linear_map())
+
+
+@pytest.mark.parametrize(
+    "transform_name",
+    ["analytical_rotation", "analytical_linear_map", "analytical_translation"],
+)
+def test_initialize_manual_transforms(transform_name):
+    loaders = [
+        DataLoader(TensorDataset(src_embeds, tgt_embeds), batch_size=32)
+        for src_embeds, tgt_embeds in make_problems([8, 12])
+    ]
+
+    transforms = initialize_manual_transforms(transform_name, loaders, device="cpu")
+
+    for loader, transform in zip(loaders, transforms):
+        src_embeds, tgt_embeds = loader.dataset.tensors  # type: ignore
+        expected = initialize_manual_transform(transform_name, loader, device="cpu")
+        t.testing.assert_close(
+            transform(src_embeds), expected(src_embeds), atol=1e-4, rtol=1e-4
+        )
+
+
+def test_solve_linear_map_batched_falls_back_for_ill_conditioned_problems():
+    src_embeds, tgt_embeds = make_problems([8])[0]
+    # two almost collinear dimensions, for which cholesky succeeds but the normal
+    # equations are badly conditioned
+    src_embeds[..., 1] = src_embeds[..., 0] + 1e-6 * t.randn(src_embeds.shape[:-1])
+    stats = EmbeddingStatistics(8, True, device="cpu")
+    stats.update(src_embeds, tgt_embeds)
+    assert t.linalg.cholesky_ex(stats.src_src).info == 0
+
+    X = solve_linear_map_batched([stats])[0]
+
+    t.testing.assert_close(X, stats.linear_map())
+    # the fit is still as good as that of lstsq in float64
+    lstsq_X = calc_linear_map(src_embeds.double(), tgt_embeds.double()).float()
+    residual = (src_embeds @ X.T - tgt_embeds).norm()
+    lstsq_residual = (src_embeds @ lstsq_X.T - tgt_embeds).norm()
+    assert residual <= 1.001 * lstsq_residual
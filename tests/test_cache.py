@@ -0,0 +1,63 @@
+import importlib
+
+import pytest
+
+import auto_embeds.utils.cache as cache
+from auto_embeds.utils.cache import FingerprintedList
+
+
+@pytest.fixture
+def auto_embeds_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("AUTOEMBEDS_CACHE_DIR", str(tmp_path))
+    monkeypatch.setenv("AUTOEMBEDS_CACHING", "true")
+    return importlib.reload(cache).auto_embeds_cache
+
+
+def test_auto_embeds_cache_normalises_arguments(auto_embeds_cache):
+    calls = []
+
+    @auto_embeds_cache
+    def add(a, b=2, c=3):
+        calls.append((a, b, c))
+        return a + b + c
+
+    assert add(1) == 6
+    assert add(1, 2) == 6
+    assert add(a=1, c=3) == 6
+    assert add(1, c=4) == 7
+    assert calls == [(1, 2, 3), (1, 2, 4)]
+    assert add.cache_info()["hits"] == 2
+    assert add.cache_info()["misses"] == 2
+
+
+def test_auto_embeds_cache_uses_fingerprints(auto_embeds_cache, word_level_tokenizer):
+    calls = []
+
+    @auto_embeds_cache
+    def count_pairs(tokenizer, word_pairs):
+        calls.append(len(word_pairs))
+        return len(word_pairs)
+
+    word_pairs = FingerprintedList([["cat", "chat"]], "file:abc")
+    assert count_pairs(word_level_tokenizer, word_pairs) == 1
+    # the same fingerprint is a cache hit even though the contents differ
+    other_pairs = FingerprintedList([["cat", "chat"], ["dog", "chien"]], "file:abc")
+    assert count_pairs(word_level_tokenizer, other_pairs) == 1
+    assert count_pairs(word_level_tokenizer, [["dog", "chien"]] * 2) == 2
+    assert calls == [1, 2]
+
+
+def test_auto_embeds_cache_custom_key_fn(auto_embeds_cache):
+    calls = []
+
+    @auto_embeds_cache(key_fn=lambda x, verbose=False: x)
+    def square(x, verbose=False):
+        calls.append(x)
+        return x * x
+
+    assert square(3) == 9
+    assert square(3, verbose=True) == 9
+    assert calls == [3]
+    square.clear_cache()
+    assert square(3) == 9
+    assert calls == [3, 3]
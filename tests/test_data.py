@@ -0,0 +1,132 @@
+import json
+import random
+
+import pytest
+import torch as t
+from Levenshtein import distance as levenshtein_distance
+from torch.utils.data import TensorDataset
+
+import auto_embeds.data as data
+from auto_embeds.data import (
+    FastTensorLoader,
+    _deduplicate_similar_words,
+    load_azure_translations,
+)
+
+
+def test_load_azure_translations_is_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(data, "cachedir", str(tmp_path / "cache"))
+    translations_path = tmp_path / "azure_translations.json"
+    azure_translations = [
+        {
+            "normalizedSource": "cat",
+            "translations": [
+                {"normalizedTarget": "chat"},
+                {"normalizedTarget": None},
+                {"normalizedTarget": " Chatte "},
+            ],
+        },
+        {"normalizedSource": " Dog", "translations": [{"normalizedTarget": "chien"}]},
+    ]
+    translations_path.write_text(json.dumps(azure_translations), encoding="utf-8")
+
+    loaded = load_azure_translations(translations_path)
+
+    assert loaded.translations_dict == {"cat": ["chat", " Chatte "], " Dog": ["chien"]}
+    assert load_azure_translations(str(translations_path)) is loaded
+    pickles = list((tmp_path / "cache" / "azure_translations").glob("*.pkl"))
+    assert len(pickles) == 1
+    # a new process only has the pickle, so the file is not parsed again
+    data._azure_translations.clear()
+    monkeypatch.setattr(data.json, "loads", None)
+    assert load_azure_translations(translations_path) == loaded
+
+
+def deduplicate_similar_words_loop(words, id_sums, acceptable_overlap):
+    # the quadratic greedy loop previously used by filter_word_pairs
+    pairs_to_filter = list(zip(id_sums, words, range(len(words))))
+    kept = []
+    while pairs_to_filter:
+        current_id_sum, current_word, current_idx = pairs_to_filter.pop(0)
+        most_similar_idx, most_similar_id_sum = current_idx, current_id_sum
+        for other_pair in pairs_to_filter[:]:
+            other_id_sum, other_word, other_idx = other_pair
+            similarity_ratio = 1 - levenshtein_distance(current_word, other_word) / max(
+                len(current_word), len(other_word)
+            )
+            if (
+                similarity_ratio >= acceptable_overlap
+                and other_id_sum < most_similar_id_sum
+            ):
+                most_similar_idx, most_similar_id_sum = other_idx, other_id_sum
+                pairs_to_filter.remove(other_pair)
+        kept.append(most_similar_idx)
+    return kept
+
+
+@pytest.mark.parametrize("acceptable_overlap", [0.0, 0.3, 0.5, 0.7, 0.8, 0.9, 0.99])
+def test_deduplicate_similar_words_matches_loop(acceptable_overlap):
+    rng = random.Random(0)
+    stems = ["maison", "chat", "chien", "hôpital", "arbre", "eau", "pomme", "livre"]
+    words = []
+    for _ in range(300):
+        word = list(rng.choice(stems))
+        for _ in range(rng.randint(0, 3)):
+            pos = rng.randrange(len(word) + 1)
+            op = rng.choice(["insert", "delete", "replace"])
+            if op == "insert" or len(word) <= 1:
+                word.insert(pos, rng.choice("aeistx"))
+            elif op == "delete":
+                del word[min(pos, len(word) - 1)]
+            else:
+                word[min(pos, len(word) - 1)] = rng.choice("aeistx")
+        words.append(rng.choice(["", " "]) + "".join(word))
+    id_sums = [rng.randint(0, 1000) for _ in words]
+
+    kept = _deduplicate_similar_words(words, id_sums, acceptable_overlap)
+
+    assert kept == deduplicate_similar_words_loop(words, id_sums, acceptable_overlap)
+
+
+@pytest.mark.parametrize("drop_last", [False, True])
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_fast_tensor_loader(shuffle, drop_last):
+    src, tgt = t.arange(10), t.arange(10) * 2
+    loader = FastTensorLoader(
+        TensorDataset(src, tgt),
+        batch_size=4,
+        shuffle=shuffle,
+        generator=t.Generator().manual_seed(0),
+        drop_last=drop_last,
+    )
+
+    batches = list(loader)
+
+    assert len(batches) == len(loader) == (2 if drop_last else 3)
+    assert [len(src_batch) for src_batch, _ in batches] == [4, 4, 2][: len(loader)]
+    for src_batch, tgt_batch in batches:
+        assert t.equal(tgt_batch, src_batch * 2)
+    seen = t.cat([src_batch for src_batch, _ in batches])
+    if not drop_last:
+        assert sorted(seen.tolist()) == list(range(10))
+    if shuffle:
+        # a new permutation every epoch
+        assert not t.equal(seen, t.cat([src_batch for src_batch, _ in loader]))
+    else:
+        assert seen.tolist() == list(range(len(seen)))
+
+
+def test_fast_tensor_loader_seeded_shuffle_is_deterministic():
+    dataset = TensorDataset(t.arange(100))
+
+    def epochs(seed):
+        loader = FastTensorLoader(
+            dataset,
+            batch_size=16,
+            shuffle=True,
+            generator=t.Generator().manual_seed(seed),
+        )
+        return [[batch.tolist() for (batch,) in loader] for _ in range(2)]
+
+    assert epochs(0) == epochs(0)
+    assert epochs(0) != epochs(1)
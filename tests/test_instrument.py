@@ -0,0 +1,147 @@
+import json
+import time
+
+import pytest
+
+from auto_embeds.utils.instrument import (
+    Instrumentation,
+    get_instrumentation,
+    instrument,
+    instrumented,
+    span,
+)
+
+
+def run_nested_spans(instrumentation):
+    with instrumentation.span("outer", run=1):
+        with instrumentation.span("inner") as attributes:
+            time.sleep(0.01)
+            attributes["n_items"] = 3
+        with instrumentation.span("inner"):
+            pass
+
+
+def test_nested_spans_are_recorded_innermost_first():
+    instrumentation = Instrumentation()
+
+    run_nested_spans(instrumentation)
+
+    inner, second_inner, outer = instrumentation.records
+    assert [record.name for record in instrumentation.records] == [
+        "inner",
+        "inner",
+        "outer",
+    ]
+    assert [record.depth for record in instrumentation.records] == [1, 1, 0]
+    assert inner.duration >= 0.01
+    assert outer.duration >= inner.duration + second_inner.duration
+    assert outer.start <= inner.start <= second_inner.start
+    assert inner.attributes == {"n_items": 3}
+    assert outer.attributes == {"run": 1}
+    for record in instrumentation.records:
+        assert record.max_rss is None or record.max_rss > 0
+        assert record.peak_allocated is None
+
+    summary = instrumentation.summary()
+    assert list(summary) == ["inner", "outer"]
+    assert summary["inner"]["count"] == 2
+    assert summary["inner"]["total_duration"] == pytest.approx(
+        inner.duration + second_inner.duration
+    )
+    assert summary["inner"]["max_duration"] == inner.duration
+
+
+def test_span_is_recorded_when_the_code_raises():
+    instrumentation = Instrumentation()
+
+    with pytest.raises(ValueError):
+        with instrumentation.span("failing"):
+            raise ValueError
+
+    assert [record.name for record in instrumentation.records] == ["failing"]
+    assert instrumentation._stack == []
+
+
+@pytest.mark.parametrize("trace_format", ["jsonl", "chrome"])
+def test_spans_are_appended_to_the_trace(tmp_path, trace_format):
+    trace_path = tmp_path / "traces" / f"trace.{trace_format}"
+    # two runs appending to the same file
+    for _ in range(2):
+        run_nested_spans(Instrumentation(trace_path, trace_format))
+
+    text = trace_path.read_text()
+    if trace_format == "jsonl":
+        records = [json.loads(line) for line in text.splitlines()]
+        assert [record["name"] for record in records] == ["inner", "inner", "outer"] * 2
+        assert records[0]["attributes"] == {"n_items": 3}
+    else:
+        # the array is left unterminated so that further spans can be appended
+        events = json.loads(text.rstrip().rstrip(",") + "]")
+        assert [event["name"] for event in events] == ["inner", "inner", "outer"] * 2
+        assert all(event["ph"] == "X" for event in events)
+        assert events[0]["args"]["n_items"] == 3
+        inner, _, outer = events[:3]
+        assert outer["ts"] <= inner["ts"]
+        assert inner["ts"] + inner["dur"] <= outer["ts"] + outer["dur"]
+
+
+@instrumented()
+def add(a, b):
+    """Adds a and b."""
+    with span("add_inner"):
+        return a + b
+
+
+def test_module_level_spans_record_to_the_current_instrumentation():
+    assert get_instrumentation() is None
+    # without a current instrumentation nothing is recorded
+    assert add(1, 2) == 3
+
+    outer, inner = Instrumentation(), Instrumentation()
+    with instrument(outer):
+        assert add(1, 2) == 3
+        with instrument(inner):
+            add(1, 2)
+        assert get_instrumentation() is outer
+    assert get_instrumentation() is None
+
+    assert [record.name for record in outer.records] == ["add_inner", "add"]
+    assert [record.name for record in inner.records] == ["add_inner", "add"]
+    assert add.__name__ == "add"
+    assert add.__doc__ == "Adds a and b."
+
+
+class FakeNeptuneRun:
+    def __init__(self):
+        self.values = {}
+        self.uploads = {}
+
+    def __setitem__(self, name, value):
+        self.values[name] = value
+
+    def __getitem__(self, name):
+        uploads = self.uploads
+
+        class Field:
+            def upload(self, file):
+                uploads[name] = file
+
+        return Field()
+
+
+def test_log_to_neptune():
+    instrumentation = Instrumentation()
+    run_nested_spans(instrumentation)
+    neptune_run = FakeNeptuneRun()
+
+    instrumentation.log_to_neptune(neptune_run)
+
+    summary = neptune_run.values["instrumentation/summary"]
+    assert summary["inner"]["count"] == 2
+    spans = neptune_run.uploads["instrumentation/spans"]
+    assert spans.extension == "jsonl"
+    assert [json.loads(line)["name"] for line in spans.content.splitlines()] == [
+        "inner",
+        "inner",
+        "outer",
+    ]
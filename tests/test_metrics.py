@@ -0,0 +1,79 @@
+import json
+
+import pytest
+import torch as t
+from torch.utils.data import DataLoader, TensorDataset
+
+from auto_embeds.metrics import (
+    calc_acc_fast,
+    calc_loss,
+    calc_metrics,
+    calc_pred_same_as_input,
+    initialize_loss,
+    mark_translation,
+)
+from auto_embeds.modules import Unembed
+from auto_embeds.verify import VerifyDataset
+
+
+@pytest.mark.parametrize("dataset_cls", [TensorDataset, VerifyDataset])
+@t.no_grad()
+def test_calc_metrics_matches_separate_passes(
+    word_level_tokenizer, tmp_path, dataset_cls
+):
+    t.manual_seed(0)
+    device = t.device("cpu")
+    vocab = word_level_tokenizer.get_vocab()
+    d_vocab, d_model = len(word_level_tokenizer), 32
+    W_E = t.randn(d_vocab, d_model)
+    en_words = [" hospital", " house", " cat", " dog", " water", " book", " tree"]
+    fr_words = [" hôpital", " maison", " chat", " chien", " eau", " livre", " arbre"]
+    # pull half of the french embeddings towards their english ones
+    for en_word, fr_word in zip(en_words[::2], fr_words[::2]):
+        W_E[vocab[fr_word]] = W_E[vocab[en_word]] + 0.2 * t.randn(d_model)
+    unembed_module = Unembed(d_model, d_vocab, W_E.T.clone(), t.zeros(d_vocab))
+    en_embeds = W_E[[vocab[word] for word in en_words]].unsqueeze(1)
+    fr_embeds = W_E[[vocab[word] for word in fr_words]].unsqueeze(1)
+    loader = DataLoader(dataset_cls(en_embeds, fr_embeds), batch_size=3)
+    # a noisy transform that gets some, but not all, of the translations right
+    transform = t.nn.Linear(d_model, d_model, bias=False)
+    transform.weight.copy_(t.eye(d_model) + 0.1 * t.randn(d_model, d_model))
+    translations_path = tmp_path / "azure_translations.json"
+    azure_translations = [
+        {
+            "normalizedSource": en_word.strip(),
+            "translations": [
+                {"normalizedTarget": fr_word.strip()},
+                {"normalizedTarget": None},
+            ],
+        }
+        for en_word, fr_word in zip(en_words[:-1], fr_words[:-1])
+    ]
+    translations_path.write_text(json.dumps(azure_translations), encoding="utf-8")
+
+    metrics = calc_metrics(
+        loader,
+        transform,
+        word_level_tokenizer,
+        unembed_module,
+        translations_path,
+        device=device,
+    )
+
+    kwargs = dict(
+        tokenizer=word_level_tokenizer,
+        test_loader=loader,
+        transformation=transform,
+        unembed_module=unembed_module,
+        device=device,
+    )
+    assert metrics["accuracy"] == calc_acc_fast(
+        **kwargs, exact_match=False, print_acc=False
+    )
+    assert metrics["pred_same_as_input"] == calc_pred_same_as_input(**kwargs)
+    assert metrics["mark_translation_acc"] == mark_translation(
+        **kwargs, azure_translations_path=translations_path
+    )
+    for metric, loss in [("cos_sim_loss", "cos_sim"), ("mse_loss", "mse_loss")]:
+        expected = calc_loss(loader, transform, initialize_loss(loss), device=device)
+        assert metrics[metric] == pytest.approx(expected)
@@ -0,0 +1,278 @@
+import pytest
+import torch as t
+
+from auto_embeds.modules import (
+    FusedAffineTransform,
+    LinearTransform,
+    ManualTransformModule,
+    OrthogonalLinear,
+    RotationTransform,
+    TransformEnsemble,
+    TranslationTransform,
+    UncenteredRotationTransform,
+    Unembed,
+    random_rotation,
+    unembed_argmax,
+)
+
+
+def make_transformations(d_model):
+    t.manual_seed(0)
+    rotation = t.linalg.qr(t.randn(d_model, d_model)).Q
+    return [
+        ("add", t.randn(d_model)),
+        ("multiply", rotation),
+        ("scale", t.tensor(1.5)),
+        ("multiply", t.randn(d_model, d_model)),
+        ("scale", t.rand(d_model)),
+        ("add", t.randn(d_model)),
+    ]
+
+
+def test_fuse_matches_op_chain():
+    d_model = 16
+    transform = ManualTransformModule(make_transformations(d_model))
+    x = t.randn(4, 3, d_model)
+
+    fused = transform.fuse()
+
+    assert isinstance(fused, FusedAffineTransform)
+    t.testing.assert_close(fused(x), transform(x), atol=1e-4, rtol=1e-4)
+    # the leading dimensions are flattened and restored
+    t.testing.assert_close(fused(x[:, 0]), fused(x)[:, 0])
+
+
+def test_fuse_needs_d_model_for_scalar_chains():
+    transform = ManualTransformModule([("scale", t.tensor(2.0))])
+    with pytest.raises(ValueError):
+        transform.fuse()
+
+    fused = transform.fuse(d_model=4)
+
+    x = t.randn(2, 1, 4)
+    t.testing.assert_close(fused(x), 2.0 * x)
+
+
+@pytest.mark.parametrize("positions_to_steer", ["all", "final"])
+def test_steering_hook_with_fused_transform(positions_to_steer):
+    # steer imports transformer_lens, whose HookedTransformer is not in every version
+    try:
+        from auto_embeds import steer
+    except ImportError as e:
+        pytest.skip(f"could not import auto_embeds.steer: {e}")
+    d_model = 16
+    transform = ManualTransformModule(make_transformations(d_model))
+    resid = t.randn(2, 5, d_model)
+
+    expected = steer.steering_hook(None, (resid,), resid, transform, positions_to_steer)  # type: ignore
+    steered = steer.steering_hook(
+        None,  # type: ignore
+        (resid,),
+        resid,
+        transform.fuse(),
+        positions_to_steer,
+    )
+
+    t.testing.assert_close(steered, expected, atol=1e-4, rtol=1e-4)
+
+
+@pytest.mark.parametrize("transpose_weight", [False, True])
+@pytest.mark.parametrize("apply_ln", [False, True])
+def test_unembed_matches_reference(transpose_weight, apply_ln):
+    t.manual_seed(0)
+    d_model, d_vocab = 16, 50
+    W_U, b_U = t.randn(d_model, d_vocab), t.randn(d_vocab)
+    ln_weight, ln_bias = t.randn(d_model), t.randn(d_model)
+    unembed_module = Unembed(
+        d_model,
+        d_vocab,
+        W_U,
+        b_U,
+        apply_ln=apply_ln,
+        ln_weight=ln_weight,
+        ln_bias=ln_bias,
+        device="cpu",
+        transpose_weight=transpose_weight,
+    )
+    x = t.randn(4, 3, d_model)
+
+    ln_x = t.nn.functional.layer_norm(x, (d_model,), ln_weight, ln_bias)
+    expected = (ln_x if apply_ln else x) @ W_U + b_U
+    t.testing.assert_close(unembed_module(x), expected, atol=1e-4, rtol=1e-4)
+    t.testing.assert_close(unembed_module(x[:, 0]), unembed_module(x)[:, 0])
+    assert t.equal(unembed_module.W_U, W_U)
+    if transpose_weight:
+        assert unembed_module.W_U_T.is_contiguous()
+
+
+@pytest.mark.parametrize("transpose_weight", [False, True])
+def test_unembed_topk_matches_full_logits(transpose_weight):
+    t.manual_seed(0)
+    d_model, d_vocab = 16, 1000
+    unembed_module = Unembed(
+        d_model,
+        d_vocab,
+        t.randn(d_model, d_vocab),
+        t.randn(d_vocab),
+        apply_ln=True,
+        device="cpu",
+        transpose_weight=transpose_weight,
+    )
+    x = t.randn(4, 3, d_model)
+    logits = unembed_module(x)
+
+    top = unembed_module.topk(x, 5, return_probs=True, chunk_size=128)
+
+    expected = logits.topk(5, dim=-1)
+    assert t.equal(top.ids, expected.indices)
+    t.testing.assert_close(top.logits, expected.values)
+    t.testing.assert_close(top.probs, logits.softmax(dim=-1).gather(-1, top.ids))
+    assert unembed_module.topk(x, 5).probs is None
+
+
+def test_unembed_argmax():
+    t.manual_seed(0)
+    d_model, d_vocab = 16, 100
+    W_U, b_U = t.randn(d_model, d_vocab), t.randn(d_vocab)
+    unembed_module = Unembed(d_model, d_vocab, W_U, b_U, device="cpu")
+    x = t.randn(4, 1, d_model)
+    expected = (x @ W_U + b_U).argmax(dim=-1)
+
+    toks, n_vocab = unembed_argmax(unembed_module, x)
+    assert t.equal(toks, expected) and n_vocab == d_vocab
+    # any other module is unembedded in full
+    linear = t.nn.Linear(d_model, d_vocab)
+    with t.no_grad():
+        linear.weight.copy_(W_U.T)
+        linear.bias.copy_(b_U)
+    toks, n_vocab = unembed_argmax(linear, x)
+    assert t.equal(toks, expected) and n_vocab == d_vocab
+
+
+@pytest.mark.parametrize(
+    "transform_cls, kwargs",
+    [
+        (LinearTransform, {}),
+        (LinearTransform, {"bias": False}),
+        (TranslationTransform, {}),
+        (RotationTransform, {}),
+        (UncenteredRotationTransform, {}),
+    ],
+)
+def test_transform_ensemble_matches_members(transform_cls, kwargs):
+    t.manual_seed(0)
+    transforms = [transform_cls(8, device="cpu", **kwargs) for _ in range(3)]
+    if transform_cls is TranslationTransform:
+        # translations are initialised to zero
+        with t.no_grad():
+            for transform in transforms:
+                transform.translation.normal_()
+    ensemble = TransformEnsemble(transforms)
+    x = t.randn(5, 1, 8)
+
+    out = ensemble(x)
+
+    assert out.shape == (3, 5, 1, 8)
+    for member_out, transform, member in zip(out, transforms, ensemble.unstack()):
+        t.testing.assert_close(member_out, transform(x))
+        t.testing.assert_close(member(x), transform(x))
+    # the members are copies, independent of the ensemble
+    with t.no_grad():
+        ensemble.stacked_params[0].zero_()
+    t.testing.assert_close(member(x), transforms[-1](x))
+
+
+PARAMETRIZATIONS = ["cayley", "matrix_exp", "householder", "retraction"]
+
+
+def assert_rotation(matrix):
+    eye = t.eye(matrix.shape[0])
+    t.testing.assert_close(matrix @ matrix.T, eye, atol=1e-5, rtol=0)
+    assert t.linalg.det(matrix) > 0
+
+
+@pytest.mark.parametrize("parametrization", PARAMETRIZATIONS)
+def test_orthogonal_linear_init(parametrization):
+    t.manual_seed(0)
+    rotation = OrthogonalLinear(16, parametrization, device="cpu")
+    t.manual_seed(0)
+    same_rotation = OrthogonalLinear(16, parametrization, device="cpu")
+    identity = OrthogonalLinear(16, parametrization, init="identity", device="cpu")
+
+    assert_rotation(rotation.weight.detach())
+    t.testing.assert_close(rotation.weight, same_rotation.weight)
+    t.testing.assert_close(identity.weight, t.eye(16), atol=1e-5, rtol=0)
+
+
+@pytest.mark.parametrize("parametrization", PARAMETRIZATIONS)
+def test_orthogonal_linear_set_weight(parametrization):
+    t.manual_seed(0)
+    rotation = OrthogonalLinear(16, parametrization, device="cpu")
+    matrix = random_rotation(16, device="cpu")
+    x = t.randn(4, 1, 16)
+
+    rotation.weight = matrix
+
+    t.testing.assert_close(rotation(x), x @ matrix.T, atol=1e-5, rtol=1e-5)
+
+
+@pytest.mark.parametrize("parametrization", PARAMETRIZATIONS)
+def test_orthogonal_linear_stays_a_rotation_while_training(parametrization):
+    t.manual_seed(0)
+    rotation = OrthogonalLinear(16, parametrization, retract_every=3, device="cpu")
+    target = random_rotation(16, device="cpu")
+    optim = t.optim.Adam(rotation.parameters(), lr=1e-2)
+    x = t.randn(64, 16)
+    losses = []
+    for _ in range(10):
+        optim.zero_grad()
+        loss = (rotation(x) - x @ target.T).pow(2).mean()
+        loss.backward()
+        optim.step()
+        losses.append(loss.item())
+        with t.no_grad():
+            assert_rotation(rotation.weight)
+
+    assert losses[-1] < losses[0]
+
+
+@pytest.mark.parametrize("parametrization", PARAMETRIZATIONS)
+def test_transform_ensemble_of_rotations(parametrization):
+    t.manual_seed(0)
+    transforms = [RotationTransform(8, parametrization, device="cpu") for _ in range(3)]
+    ensemble = TransformEnsemble(transforms)
+    # perturb the free matrices so that the first training forward retracts them
+    if parametrization == "retraction":
+        with t.no_grad():
+            ensemble.stacked_params[0].add_(0.1 * t.randn(3, 8, 8))
+    optim = t.optim.Adam(ensemble.parameters(), lr=1e-2)
+    x = t.randn(5, 1, 8)
+
+    for _ in range(3):
+        optim.zero_grad()
+        ensemble(x).pow(2).mean().backward()
+        optim.step()
+    ensemble.eval()
+    with t.no_grad():
+        out = ensemble(x)
+
+    members = ensemble.unstack()
+    for member_out, member in zip(out, members):
+        with t.no_grad():
+            assert_rotation(member.rotation.weight)
+            t.testing.assert_close(member_out, member(x), atol=1e-5, rtol=1e-5)
+
+
+def test_orthogonal_linear_caches_weight_without_grad():
+    rotation = OrthogonalLinear(16, device="cpu")
+    optim = t.optim.SGD(rotation.parameters(), lr=1e-2)
+
+    with t.no_grad():
+        weight = rotation.weight
+        assert rotation.weight is weight
+    # recomputed with gradients, for the backward pass
+    assert rotation.weight is not weight and rotation.weight.requires_grad
+    rotation(t.randn(4, 16)).sum().backward()
+    optim.step()
+    with t.no_grad():
+        assert not t.equal(rotation.weight, weight)
@@ -0,0 +1,177 @@
+import json
+import threading
+import time
+
+import pytest
+
+from auto_embeds.utils.neptune import ARTIFACT_TYPES, download_artifacts
+
+
+class FakeNeptune:
+    """A local stand-in for neptune.init_run serving the artifacts of fake runs.
+
+    Args:
+        n_failures: The number of times each download fails before succeeding.
+        missing: (run_id, artifact_name) pairs whose download always fails.
+        missing_error: Optional; the error the downloads of missing artifacts fail
+            with, instead of a ConnectionError after a partial download.
+        delay: The time each download takes in seconds.
+    """
+
+    def __init__(self, n_failures=0, missing=(), missing_error=None, delay=0.0):
+        self.n_failures = n_failures
+        self.missing = set(missing)
+        self.missing_error = missing_error
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.init_runs = []
+        self.downloads = []
+        self.attempts = {}
+        self.active = 0
+        self.max_active = 0
+        self.stopped = 0
+
+    @staticmethod
+    def content(run_id, artifact_name):
+        return json.dumps({"run_id": run_id, "artifact": artifact_name})
+
+    def init_run(self, project, with_id, mode):
+        assert mode == "read-only"
+        with self.lock:
+            self.init_runs.append(with_id)
+        return FakeRun(self, with_id)
+
+
+class FakeRun:
+    def __init__(self, neptune, run_id):
+        self.neptune = neptune
+        self.run_id = run_id
+
+    def __getitem__(self, field):
+        neptune, run_id = self.neptune, self.run_id
+        artifact_name = field.removeprefix("results/test/json/")
+
+        class FileField:
+            def download(self, destination, progress_bar):
+                key = (run_id, artifact_name)
+                with neptune.lock:
+                    neptune.attempts[key] = neptune.attempts.get(key, 0) + 1
+                    attempt = neptune.attempts[key]
+                    neptune.active += 1
+                    neptune.max_active = max(neptune.max_active, neptune.active)
+                try:
+                    time.sleep(neptune.delay)
+                    if key in neptune.missing and neptune.missing_error is not None:
+                        raise neptune.missing_error(f"{key} does not exist")
+                    if key in neptune.missing or attempt <= neptune.n_failures:
+                        # a partial download, as left by a dropped connection
+                        with open(destination, "w") as file:
+                            file.write("{")
+                        raise ConnectionError(f"failed to download {key}")
+                    with open(destination, "w") as file:
+                        file.write(FakeNeptune.content(run_id, artifact_name))
+                    with neptune.lock:
+                        neptune.downloads.append(key)
+                finally:
+                    with neptune.lock:
+                        neptune.active -= 1
+
+        return FileField()
+
+    def stop(self):
+        with self.neptune.lock:
+            self.neptune.stopped += 1
+
+
+RUN_IDS = [f"LAN-{i}" for i in range(12)]
+
+
+def download(fake_neptune, directory, **kwargs):
+    return download_artifacts(
+        "project",
+        RUN_IDS,
+        directory=directory,
+        init_run=fake_neptune.init_run,
+        retry_delay=0.0,
+        **kwargs,
+    )
+
+
+def test_artifacts_are_downloaded_concurrently_in_run_order(tmp_path):
+    fake_neptune = FakeNeptune(delay=0.01)
+
+    artifacts = download(fake_neptune, tmp_path, max_workers=4)
+
+    assert artifacts == {
+        name: [FakeNeptune.content(run_id, name) for run_id in RUN_IDS]
+        for name in ARTIFACT_TYPES
+    }
+    # every run is opened once for all of its artifacts, and closed again
+    assert sorted(fake_neptune.init_runs) == sorted(RUN_IDS)
+    assert fake_neptune.stopped == len(RUN_IDS)
+    assert 1 < fake_neptune.max_active <= 4
+    assert len(fake_neptune.downloads) == len(RUN_IDS) * len(ARTIFACT_TYPES)
+
+
+def test_failed_downloads_are_retried(tmp_path):
+    fake_neptune = FakeNeptune(n_failures=2)
+
+    artifacts = download(fake_neptune, tmp_path, max_retries=2)
+
+    assert artifacts["verify_results"][0] == FakeNeptune.content(
+        "LAN-0", "verify_results"
+    )
+    assert set(fake_neptune.attempts.values()) == {3}
+
+
+def test_missing_artifacts_are_none_and_resumed_later(tmp_path):
+    missing = {("LAN-3", "verify_results"), ("LAN-5", "test_cos_sim_diff")}
+    fake_neptune = FakeNeptune(missing=missing)
+
+    artifacts = download(fake_neptune, tmp_path, max_retries=1)
+
+    assert artifacts["verify_results"][3] is None
+    assert artifacts["test_cos_sim_diff"][5] is None
+    assert artifacts["cos_sims_trend_plot"][3] is not None
+    assert fake_neptune.attempts[("LAN-3", "verify_results")] == 2
+
+    # a second call only downloads the artifacts that are still missing
+    resumed_neptune = FakeNeptune()
+    artifacts = download(resumed_neptune, tmp_path)
+
+    assert sorted(resumed_neptune.downloads) == sorted(missing)
+    assert sorted(resumed_neptune.init_runs) == ["LAN-3", "LAN-5"]
+    assert artifacts["verify_results"][3] == FakeNeptune.content(
+        "LAN-3", "verify_results"
+    )
+
+
+@pytest.mark.parametrize("corruption", ["truncated", "modified", "no_checksum"])
+def test_corrupted_downloads_are_downloaded_again(tmp_path, corruption):
+    download(FakeNeptune(), tmp_path)
+    path = tmp_path / "LAN-7-verify_results"
+    if corruption == "truncated":
+        path.write_text(path.read_text()[:-1])
+    elif corruption == "modified":
+        path.write_text(path.read_text().replace("LAN-7", "LAN-8"))
+    else:
+        path.with_name(path.name + ".sha1").unlink()
+
+    fake_neptune = FakeNeptune()
+    artifacts = download(fake_neptune, tmp_path)
+
+    assert fake_neptune.downloads == [("LAN-7", "verify_results")]
+    assert artifacts["verify_results"][7] == FakeNeptune.content(
+        "LAN-7", "verify_results"
+    )
+
+
+def test_artifacts_that_do_not_exist_are_not_retried(tmp_path):
+    missing = {("LAN-3", "verify_results")}
+    fake_neptune = FakeNeptune(missing=missing, missing_error=KeyError)
+
+    artifacts = download(fake_neptune, tmp_path, max_retries=3)
+
+    assert artifacts["verify_results"][3] is None
+    assert fake_neptune.attempts[("LAN-3", "verify_results")] == 1
+    assert artifacts["verify_results"][4] is not None
@@ -0,0 +1,143 @@
+import json
+from datetime import datetime, timezone
+
+import pandas as pd
+import pytest
+
+from auto_embeds.results_store import ResultsStore
+from auto_embeds.utils.neptune import process_neptune_runs_df
+
+
+def write_runs(store):
+    for i, (tags, weight_decay, day) in enumerate(
+        [
+            (["sweep", "run group 1"], 0, 1),
+            (["sweep", "run group 2"], 2e-5, 1),
+            (["other"], 0, 2),
+            ([], 0, 2),
+        ]
+    ):
+        store.write_run(
+            neptune_id=f"LAN-{i}",
+            tags=tags,
+            config={
+                "model_name": "gpt2",
+                "dataset": {
+                    "name": "wikdict_en_fr_extracted",
+                    "space_configurations": [{"en": "space", "fr": "space"}],
+                },
+                "transformation": "rotation",
+                "seed": i,
+                "weight_decay": weight_decay,
+                "mark_accuracy_path": None,
+            },
+            results={
+                "train": {"accuracy": 0.5, "mark_translation_acc": None},
+                "test": {"accuracy": i / 10},
+            },
+            histories={"train_loss": [{"train_loss": 1.0, "epoch": 0}]},
+            artifacts={
+                "cos_sims_trend_plot": json.dumps({"data": []}),
+                "test_cos_sim_diff": json.dumps({"correct": True}),
+                "verify_results": json.dumps({"cos_sims": [0.1 * i]}),
+            },
+            creation_time=datetime(2024, 6, day, i, tzinfo=timezone.utc),
+        )
+
+
+def test_load_runs_df_filters_by_tags_and_dates(tmp_path):
+    store = ResultsStore(tmp_path)
+    write_runs(store)
+
+    assert [path.name for path in store.partitions()] == [
+        "date=2024-06-01",
+        "date=2024-06-02",
+    ]
+    df = store.load_runs_df()
+    assert df["sys/id"].tolist() == ["LAN-0", "LAN-1", "LAN-2", "LAN-3"]
+    assert df["config/dataset/name"].tolist() == ["wikdict_en_fr_extracted"] * 4
+    assert df["config/dataset/space_configurations"][0] == str(
+        [{"en": "space", "fr": "space"}]
+    )
+    assert df["config/mark_accuracy_path"][0] == "None"
+    # the int and float weight decays are promoted to a common type
+    assert df["config/weight_decay"].tolist() == [0, 2e-5, 0, 0]
+    assert df["results/test/accuracy"].tolist() == pytest.approx([0, 0.1, 0.2, 0.3])
+    assert json.loads(df["history/train_loss"][0]) == [{"train_loss": 1.0, "epoch": 0}]
+
+    assert store.load_runs_df(tags=["sweep"])["sys/id"].tolist() == ["LAN-0", "LAN-1"]
+    assert store.load_runs_df(tags=["sweep", "run group 2"])["sys/id"].tolist() == [
+        "LAN-1"
+    ]
+    assert store.load_runs_df(dates=["2024-06-02"])["sys/id"].tolist() == [
+        "LAN-2",
+        "LAN-3",
+    ]
+
+    without_artifacts = store.load_runs_df(get_artifacts=False)
+    assert without_artifacts["results/test/json/verify_results"].isnull().all()
+
+
+def test_load_runs_df_is_unchanged_by_compaction(tmp_path):
+    store = ResultsStore(tmp_path)
+    write_runs(store)
+    expected_df = store.load_runs_df()
+
+    store.compact()
+
+    for partition in store.partitions():
+        assert len(list(partition.glob("*.parquet"))) == 1
+    pd.testing.assert_frame_equal(store.load_runs_df(), expected_df)
+
+
+def test_rewritten_run_keeps_its_latest_row(tmp_path):
+    store = ResultsStore(tmp_path)
+    write_runs(store)
+    store_id = store.load_runs_df()["sys/store_id"][1]
+    store.compact()
+
+    store.write_run(
+        ["sweep"],
+        {"seed": 1},
+        {"test": {"accuracy": 1.0}},
+        neptune_id="LAN-1",
+        store_id=store_id,
+    )
+
+    df = store.load_runs_df()
+    assert df["sys/id"].tolist() == ["LAN-0", "LAN-2", "LAN-3", "LAN-1"]
+    assert df["results/test/accuracy"].iloc[-1] == 1.0
+
+
+def test_runs_without_neptune_ids_are_kept_apart(tmp_path):
+    store = ResultsStore(tmp_path)
+
+    # e.g. offline runs of parallel sweep workers, which share no neptune id
+    paths = [
+        store.write_run(
+            ["sweep"],
+            {"seed": seed},
+            {"test": {"accuracy": 0.5}},
+            creation_time=datetime(2024, 6, 1, seed, tzinfo=timezone.utc),
+        )
+        for seed in range(2)
+    ]
+
+    assert paths[0] != paths[1]
+    df = store.load_runs_df()
+    assert df["sys/id"].isnull().all()
+    assert df["config/seed"].tolist() == [0, 1]
+    runs_df, *_ = process_neptune_runs_df(df)
+    assert runs_df["run_id"].tolist() == [path.stem for path in paths]
+
+
+def test_empty_store_loads_an_empty_df(tmp_path):
+    df = ResultsStore(tmp_path / "missing").load_runs_df()
+
+    assert len(df) == 0
+    assert "sys/id" in df.columns and "sys/store_id" in df.columns
+
+
+def test_unknown_artifact_raises(tmp_path):
+    with pytest.raises(ValueError):
+        ResultsStore(tmp_path).write_run([], {}, {}, artifacts={"plot": ""})
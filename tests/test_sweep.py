@@ -0,0 +1,136 @@
+import itertools
+import os
+import random
+import time
+
+import pytest
+
+from auto_embeds.utils.instrument import Instrumentation, instrument
+from experiments.sweep import (
+    STAGES,
+    StageCache,
+    chunk_runs,
+    plan_runs,
+    run_sweep,
+    stage_key,
+)
+
+
+def make_run_configs():
+    datasets = [
+        {"name": "wikdict_en_fr_extracted", "min_length": 5},
+        {"name": "cc_cedict_zh_en_extracted", "min_length": 2},
+    ]
+    run_configs = []
+    for model_name, processing, dataset, seed, lr in itertools.product(
+        ["bigscience/bloom-560m", "gpt2"], [False, True], datasets, [1, 2], [1e-3, 1e-4]
+    ):
+        run_configs.append(
+            {
+                "model_name": model_name,
+                "processing": processing,
+                "dataset": dataset,
+                "transformation": "rotation",
+                "train_batch_size": 128,
+                "test_batch_size": 256,
+                "top_k": 200,
+                "top_k_selection_method": "top_src",
+                "seed": seed,
+                "embed_weight": "model_weights",
+                "embed_ln_weights": "default_weights",
+                "unembed_weight": "model_weights",
+                "unembed_ln_weights": "default_weights",
+                "lr": lr,
+            }
+        )
+    random.Random(0).shuffle(run_configs)
+    return run_configs
+
+
+def test_plan_runs_groups_shared_stages():
+    run_configs = make_run_configs()
+    planned = plan_runs(run_configs)
+
+    assert sorted(map(id, planned)) == sorted(map(id, run_configs))
+    # every stage key forms one contiguous block in the planned order
+    for stage, _ in STAGES:
+        keys = [stage_key(stage, run_config) for run_config in planned]
+        blocks = [key for key, _ in itertools.groupby(keys)]
+        assert len(blocks) == len(set(keys))
+    # runs only differing in per-run fields keep their relative order
+    position = {id(run_config): i for i, run_config in enumerate(run_configs)}
+    for _, group in itertools.groupby(
+        planned, key=lambda run_config: stage_key("loaders", run_config)
+    ):
+        positions = [position[id(run_config)] for run_config in group]
+        assert positions == sorted(positions)
+
+
+def test_stage_cache_computes_each_stage_key_once():
+    stage_cache = StageCache()
+    calls = {stage: [] for stage, _ in STAGES}
+
+    for run_config in plan_runs(make_run_configs()):
+        for stage, _ in STAGES:
+            key = stage_key(stage, run_config)
+            result = stage_cache.get(
+                stage, run_config, lambda: calls[stage].append(key) or key
+            )
+            assert result == key
+
+    for stage, _ in STAGES:
+        assert len(calls[stage]) == len(set(calls[stage]))
+        assert stage_cache.misses[stage] == len(calls[stage])
+    assert stage_cache.misses["model_weights"] == 4
+    assert stage_cache.hits["model_weights"] == 32 - 4
+
+
+def test_stage_cache_records_a_span_per_computed_stage():
+    stage_cache = StageCache()
+    instrumentation = Instrumentation()
+    run_configs = plan_runs(make_run_configs())
+
+    with instrument(instrumentation):
+        for run_config in run_configs:
+            stage_cache.get("model_weights", run_config, lambda: None)
+
+    names = [record.name for record in instrumentation.records]
+    assert names == ["stage/model_weights"] * stage_cache.misses["model_weights"]
+
+
+def test_chunk_runs_splits_by_model_weights():
+    run_configs = make_run_configs()
+    chunks = chunk_runs(run_configs, max_chunk_size=3)
+
+    indices = [index for chunk in chunks for index, _ in chunk]
+    assert sorted(indices) == list(range(len(run_configs)))
+    for chunk in chunks:
+        assert len(chunk) <= 3
+        assert len({stage_key("model_weights", config) for _, config in chunk}) == 1
+        assert all(run_configs[index] is config for index, config in chunk)
+
+
+def slow_run(run_config, stage_cache):
+    # sleeps longer for earlier runs so that runs finish out of order
+    weights = stage_cache.get(
+        "model_weights", run_config, lambda: (run_config["model_name"], os.getpid())
+    )
+    time.sleep(0.05 if run_config["seed"] == 1 else 0.0)
+    return run_config["lr"], weights
+
+
+@pytest.mark.parametrize("num_workers", [1, 3])
+def test_run_sweep_returns_results_in_config_order(num_workers):
+    run_configs = make_run_configs()
+
+    results = run_sweep(run_configs, slow_run, num_workers=num_workers)
+
+    assert [result.run_config for result in results] == run_configs
+    for run_config, result in zip(run_configs, results):
+        assert result.result[0] == run_config["lr"]
+        assert result.result[1][0] == run_config["model_name"]
+        assert result.duration >= 0
+    # the model weights are loaded by the worker that ran the run
+    assert all(result.result[1][1] == result.worker for result in results)
+    if num_workers > 1:
+        assert len({result.worker for result in results}) > 1
@@ -0,0 +1,47 @@
+import torch as t
+
+from auto_embeds.token_classes import get_token_classes
+
+
+def mark_with_strings(en_str, pred_str, translations_dict):
+    # the string comparisons previously done in mark_translation
+    if en_str.strip().lower() not in translations_dict:
+        return None
+    all_allowed_translations = translations_dict[en_str.strip().lower()]
+    return (
+        pred_str.strip() in all_allowed_translations
+        or pred_str.strip() + "s" in all_allowed_translations
+        or pred_str.strip()[:-1] in all_allowed_translations
+    )
+
+
+def test_token_classes_match_string_comparisons(word_level_tokenizer):
+    d_vocab = len(word_level_tokenizer) + 3
+    token_classes = get_token_classes(word_level_tokenizer, d_vocab)
+    assert get_token_classes(word_level_tokenizer, d_vocab) is token_classes
+    translations_dict = {
+        "hospital": ["hôpital", "Hôpital"],
+        "house": ["maisons"],
+        "cat": ["cha"],
+        "dog": ["Chien", "chiens"],
+        "water": [],
+        "unknown": ["eau"],
+    }
+    allowed = token_classes.allowed_translations(translations_dict)
+    toks = t.arange(d_vocab)
+    src_toks, pred_toks = t.cartesian_prod(toks, toks).unbind(-1)
+    strs = word_level_tokenizer.batch_decode(toks[: len(word_level_tokenizer), None])
+    strs += [""] * 3
+
+    words_found, marks = token_classes.mark(src_toks, pred_toks, allowed)
+    same = token_classes.same(src_toks, pred_toks)
+    exact_same = token_classes.same(src_toks, pred_toks, exact_match=True)
+
+    for i, (src_tok, pred_tok) in enumerate(zip(src_toks, pred_toks)):
+        src_str, pred_str = strs[src_tok], strs[pred_tok]
+        expected_mark = mark_with_strings(src_str, pred_str, translations_dict)
+        assert words_found[i] == (expected_mark is not None)
+        assert marks[i] == bool(expected_mark)
+        assert same[i] == (src_str.strip().lower() == pred_str.strip().lower())
+        assert exact_same[i] == (src_str == pred_str)
+    assert marks.any()
@@ -0,0 +1,192 @@
+import pytest
+import torch as t
+import torch.nn as nn
+from torch.utils.data import TensorDataset
+
+from auto_embeds.data import FastTensorLoader
+from auto_embeds.embed_utils import (
+    initialize_transform_and_optim,
+    initialize_transform_ensemble,
+    train_transform,
+    train_transform_ensemble,
+)
+from auto_embeds.modules import Unembed
+
+
+def make_loaders(d_model=8, n_train=512, n_test=64, batch_size=64, shuffle=True):
+    t.manual_seed(0)
+    linear_map = t.randn(d_model, d_model)
+    src_embeds = t.randn(n_train + n_test, 1, d_model)
+    tgt_embeds = src_embeds @ linear_map.T
+    train_loader = FastTensorLoader(
+        TensorDataset(src_embeds[:n_train], tgt_embeds[:n_train]),
+        batch_size=batch_size,
+        shuffle=shuffle,
+    )
+    test_loader = FastTensorLoader(
+        TensorDataset(src_embeds[n_train:], tgt_embeds[n_train:]),
+        batch_size=batch_size,
+    )
+    return train_loader, test_loader
+
+
+def train(word_level_tokenizer, optim_name, n_epochs=50, **kwargs):
+    d_model = 8
+    train_loader, test_loader = make_loaders(d_model)
+    transform, optim = initialize_transform_and_optim(
+        d_model,
+        "linear_map",
+        optim_kwargs={"lr": 1e-2} if optim_name == "adam" else {},
+        device="cpu",
+        optim_name=optim_name,
+    )
+    d_vocab = len(word_level_tokenizer)
+    unembed_module = Unembed(
+        d_model, d_vocab, t.randn(d_model, d_vocab), t.zeros(d_vocab), device="cpu"
+    )
+    return train_transform(
+        tokenizer=word_level_tokenizer,
+        train_loader=train_loader,
+        test_loader=test_loader,
+        transform=transform,
+        optim=optim,
+        loss_module=nn.MSELoss(),
+        unembed_module=unembed_module,
+        n_epochs=n_epochs,
+        plot_fig=False,
+        device="cpu",
+        **kwargs,
+    )
+
+
+def test_full_batch_lbfgs_converges_and_stops_early(word_level_tokenizer):
+    _, history = train(
+        word_level_tokenizer, "lbfgs", full_batch=True, tol=1e-3, patience=2
+    )
+
+    # one step per epoch, stopping well before n_epochs
+    epochs = [info["epoch"] for info in history["train_loss"]]
+    assert epochs == list(range(len(epochs)))
+    assert len(epochs) < 20
+    assert history["train_loss"][-1]["train_loss"] < 1e-6
+    # the test loss is logged at the epoch training stopped at
+    assert history["test_loss"][-1]["epoch"] == epochs[-1]
+    assert history["test_loss"][-1]["test_loss"] < 1e-6
+
+
+@pytest.mark.parametrize("full_batch", [False, True])
+def test_adam_trains_for_all_epochs_without_tol(word_level_tokenizer, full_batch):
+    _, history = train(word_level_tokenizer, "adam", n_epochs=5, full_batch=full_batch)
+
+    n_steps_per_epoch = 1 if full_batch else 512 // 64
+    assert len(history["train_loss"]) == 6 * n_steps_per_epoch
+    assert (
+        history["train_loss"][-1]["train_loss"] < history["train_loss"][0]["train_loss"]
+    )
+
+
+class FakeNeptuneRun:
+    def __init__(self):
+        self.series = {}
+        self.n_calls = 0
+
+    def __getitem__(self, name):
+        run = self
+        appended = self.series.setdefault(name, [])
+
+        class Series:
+            def append(self, value, step):
+                run.n_calls += 1
+                appended.append((step, value))
+
+            def extend(self, values, steps):
+                run.n_calls += 1
+                for i, step in enumerate(steps):
+                    appended.append(
+                        (step, {key: vals[i] for key, vals in values.items()})
+                    )
+
+        return Series()
+
+
+@pytest.mark.parametrize("log_every", [None, 3, 100])
+def test_train_losses_are_logged_every_step(word_level_tokenizer, log_every):
+    neptune_run = FakeNeptuneRun()
+
+    _, history = train(
+        word_level_tokenizer,
+        "adam",
+        n_epochs=2,
+        neptune_run=neptune_run,
+        log_every=log_every,
+    )
+
+    n_steps = 3 * 512 // 64
+    assert [info["epoch"] for info in history["train_loss"]] == [
+        step // (512 // 64) for step in range(n_steps)
+    ]
+    assert neptune_run.series["train"] == [
+        (step, info) for step, info in enumerate(history["train_loss"], start=1)
+    ]
+    # one call per flush of the buffer, which is flushed when full and every epoch
+    steps_per_epoch = 512 // 64
+    flushes_per_epoch = -(-steps_per_epoch // (log_every or steps_per_epoch))
+    n_test_calls = 1
+    assert neptune_run.n_calls == 3 * flushes_per_epoch + n_test_calls
+    assert all(isinstance(info["train_loss"], float) for info in history["train_loss"])
+
+
+@pytest.mark.parametrize("transformation", ["biased_linear_map", "rotation"])
+def test_ensemble_matches_independent_training(word_level_tokenizer, transformation):
+    d_model, seeds = 8, [1, 2, 3]
+    lrs, weight_decays = [1e-2, 1e-3, 3e-3], [0.0, 1e-2, 0.0]
+    train_loader, test_loader = make_loaders(d_model, shuffle=False)
+    ensemble = initialize_transform_ensemble(
+        d_model, transformation, seeds, device="cpu"
+    )
+
+    members, histories = train_transform_ensemble(
+        train_loader,
+        test_loader,
+        ensemble,
+        nn.MSELoss(),
+        n_epochs=3,
+        lrs=lrs,
+        weight_decays=weight_decays,
+        device="cpu",
+    )
+
+    d_vocab = len(word_level_tokenizer)
+    unembed_module = Unembed(
+        d_model, d_vocab, t.randn(d_model, d_vocab), t.zeros(d_vocab), device="cpu"
+    )
+    x = t.randn(16, 1, d_model)
+    for seed, lr, weight_decay, member, history in zip(
+        seeds, lrs, weight_decays, members, histories
+    ):
+        t.manual_seed(seed)
+        transform, optim = initialize_transform_and_optim(
+            d_model,
+            transformation,
+            optim_kwargs={"lr": lr, "weight_decay": weight_decay},
+            device="cpu",
+        )
+        transform, expected_history = train_transform(
+            tokenizer=word_level_tokenizer,
+            train_loader=train_loader,
+            test_loader=test_loader,
+            transform=transform,
+            optim=optim,
+            loss_module=nn.MSELoss(),
+            unembed_module=unembed_module,
+            n_epochs=3,
+            plot_fig=False,
+            device="cpu",
+        )
+        assert type(member) is type(transform)
+        t.testing.assert_close(member(x), transform(x), atol=1e-5, rtol=1e-4)
+        for key in ["train_loss", "test_loss"]:
+            assert len(history[key]) == len(expected_history[key])
+            for info, expected_info in zip(history[key], expected_history[key]):
+                assert info["epoch"] == expected_info["epoch"]
+                assert info[key] == pytest.approx(expected_info[key], rel=1e-4)
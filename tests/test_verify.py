@@ -0,0 +1,115 @@
+import pytest
+import torch as t
+from torch.utils.data import DataLoader, TensorDataset
+
+from auto_embeds.data import FastTensorLoader, tokenize_word_pairs
+from auto_embeds.modules import Embed, Unembed
+from auto_embeds.verify import (
+    VerifyDataset,
+    calc_tgt_is_closest_embed,
+    iter_verify_batches,
+)
+
+
+def calc_tgt_is_closest_embed_loop(tokenizer, all_word_pairs, embed_module, device):
+    # reference implementation that checks each source token one at a time
+    src_toks, tgt_toks, _, _ = tokenize_word_pairs(tokenizer, all_word_pairs, device)
+    all_toks = t.cat([src_toks, tgt_toks], dim=0)
+    all_embeds = embed_module(all_toks)
+    top_1, top_5 = [], []
+    for src_tok, correct_tgt_tok in zip(src_toks, tgt_toks):
+        src_embed = embed_module(src_tok.unsqueeze(0)).squeeze(0)
+        valid_indices = (all_toks != src_tok).squeeze(-1)
+        valid_other_toks = all_toks[valid_indices]
+        valid_other_embeds = all_embeds[valid_indices].squeeze(1)
+        cos_sims = t.cosine_similarity(src_embed, valid_other_embeds, dim=-1)
+        top_5_indices = t.topk(cos_sims, 5).indices
+        top_5.append(correct_tgt_tok in valid_other_toks[top_5_indices])
+        top_1.append(bool(correct_tgt_tok == valid_other_toks[top_5_indices[0]]))
+    return top_1, top_5
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5])
+@t.no_grad()
+def test_calc_tgt_is_closest_embed_matches_loop(word_level_tokenizer, chunk_size):
+    t.manual_seed(1)
+    device = t.device("cpu")
+    d_vocab, d_model = len(word_level_tokenizer), 16
+    W_E = t.randn(d_vocab, d_model)
+    embed_module = Embed(d_model, d_vocab, W_E, device=device)
+    vocab = word_level_tokenizer.get_vocab()
+    en_words = [w for w in vocab if w.startswith(" ")][::2]
+    word_pairs = [[en, fr] for en, fr in zip(en_words[::2], en_words[1::2])]
+    # nudge half of the targets towards their sources so both outcomes are exercised
+    for en_word, fr_word in word_pairs[::2]:
+        W_E[vocab[fr_word]] = W_E[vocab[en_word]] + 0.1 * t.randn(d_model)
+
+    expected_top_1, expected_top_5 = calc_tgt_is_closest_embed_loop(
+        word_level_tokenizer, word_pairs, embed_module, device
+    )
+    # a tiny chunk size forces several similarity blocks, the last one partial
+    assert len(word_pairs) % 5 != 0
+    results = calc_tgt_is_closest_embed(
+        word_level_tokenizer,
+        word_pairs,
+        embed_module,
+        device=device,
+        max_chunk_elements=chunk_size * 2 * len(word_pairs),
+    )
+
+    top_1 = sum(expected_top_1) / len(word_pairs) * 100
+    top_5 = sum(expected_top_5) / len(word_pairs) * 100
+    assert f"top 1): {top_1:.2f}%" in results["summary"]
+    assert f"top 5): {top_5:.2f}%" in results["summary"]
+    details = results["details"]
+    assert len(details) == len(word_pairs)
+    for detail, correct in zip(details, expected_top_1):
+        assert ("Correct ✅" in detail) == correct
+    assert f"Source Token: '{word_pairs[0][0]}'" in details[0]
+
+
+def test_verify_dataset_caches_argmax_tokens(word_level_tokenizer):
+    t.manual_seed(0)
+    d_model, d_vocab = 8, len(word_level_tokenizer)
+    unembed_module = Unembed(
+        d_model, d_vocab, t.randn(d_model, d_vocab), t.zeros(d_vocab), device="cpu"
+    )
+    src_embeds, tgt_embeds = t.randn(10, 1, d_model), t.randn(10, 1, d_model)
+    dataset = VerifyDataset(src_embeds, tgt_embeds)
+
+    src_toks, tgt_toks = dataset.argmax_toks(unembed_module)
+
+    assert t.equal(src_toks, unembed_module(src_embeds).argmax(dim=-1))
+    assert t.equal(tgt_toks, unembed_module(tgt_embeds).argmax(dim=-1))
+    src_strs, tgt_strs = dataset.argmax_strs(word_level_tokenizer, unembed_module)
+    assert src_strs == word_level_tokenizer.batch_decode(src_toks)
+    assert tgt_strs == word_level_tokenizer.batch_decode(tgt_toks)
+    assert dataset.argmax_toks(unembed_module)[0] is src_toks
+
+
+@pytest.mark.parametrize("loader_cls", [DataLoader, FastTensorLoader])
+@pytest.mark.parametrize("dataset_cls", [VerifyDataset, TensorDataset])
+def test_iter_verify_batches(dataset_cls, loader_cls):
+    t.manual_seed(0)
+    d_model, d_vocab = 8, 30
+    unembed_module = Unembed(
+        d_model, d_vocab, t.randn(d_model, d_vocab), t.zeros(d_vocab), device="cpu"
+    )
+    src_embeds, tgt_embeds = t.randn(10, 1, d_model), t.randn(10, 1, d_model)
+    loader = loader_cls(
+        dataset_cls(src_embeds, tgt_embeds),
+        batch_size=4,
+        shuffle=True,
+        generator=t.Generator().manual_seed(0),
+    )
+
+    batches = list(iter_verify_batches(loader, unembed_module, device="cpu"))
+
+    assert sum(len(batch.src_embeds) for batch in batches) == 10
+    for batch in batches:
+        assert t.equal(batch.src_toks, unembed_module(batch.src_embeds).argmax(dim=-1))
+        assert t.equal(batch.tgt_toks, unembed_module(batch.tgt_embeds).argmax(dim=-1))
+        if dataset_cls is VerifyDataset:
+            assert t.equal(batch.src_embeds, src_embeds[batch.indices])
+        else:
+            assert batch.indices is None
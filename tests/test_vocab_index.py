@@ -0,0 +1,76 @@
+import gc
+import weakref
+
+import torch as t
+
+from auto_embeds.modules import Embed, Unembed
+from auto_embeds.vocab_index import VocabIndex, chunked_topk, get_vocab_index
+
+
+def test_chunked_topk_matches_full_topk():
+    t.manual_seed(0)
+    queries, vectors, bias = t.randn(7, 16), t.randn(1000, 16), t.randn(1000)
+    exclude = t.randint(0, 1000, (7,))
+    scores = queries @ vectors.T + bias
+    scores[t.arange(7), exclude] = -float("inf")
+    expected = scores.topk(10, dim=-1)
+
+    result = chunked_topk(
+        queries,
+        vectors,
+        10,
+        bias=bias,
+        chunk_size=64,
+        exclude=exclude,
+        return_logsumexp=True,
+    )
+
+    assert t.equal(result.indices, expected.indices)
+    assert t.allclose(result.values, expected.values, atol=1e-5)
+    assert t.allclose(result.logsumexp, scores.logsumexp(dim=-1), atol=1e-5)
+
+
+def test_vocab_index_cos_sim_returns_vocab_ids(tmp_path):
+    t.manual_seed(0)
+    device = t.device("cpu")
+    W_E = t.randn(300, 8)
+    embed_module = Embed(8, 300, W_E, device=device)
+    index = VocabIndex.from_embed(embed_module, chunk_size=32)
+    word_token = t.tensor([42])
+
+    values, indices, _ = index.topk(W_E[42:43], 5, exclude=word_token)
+    cos_sims = t.cosine_similarity(W_E[42:43], W_E, dim=-1)
+    cos_sims[42] = -float("inf")
+
+    assert t.equal(indices, cos_sims.topk(5).indices.unsqueeze(0))
+    assert t.allclose(values, cos_sims.topk(5).values.unsqueeze(0), atol=1e-5)
+
+    index.save(tmp_path)
+    loaded = VocabIndex.load(tmp_path, chunk_size=32, device=device)
+    assert t.equal(loaded.topk(W_E[42:43], 5, exclude=word_token).indices, indices)
+
+
+def test_vocab_index_logit_matches_unembed():
+    t.manual_seed(0)
+    device = t.device("cpu")
+    W_U, b_U = t.randn(8, 300), t.randn(300)
+    unembed_module = Unembed(8, 300, W_U, b_U, device=device)
+    index = VocabIndex.from_unembed(unembed_module, chunk_size=32)
+    queries = t.randn(4, 8)
+
+    result = index.topk(queries, 3)
+
+    expected = unembed_module(queries.unsqueeze(1)).squeeze(1).topk(3, dim=-1)
+    assert t.equal(result.indices, expected.indices)
+
+
+def test_get_vocab_index_is_freed_with_its_module():
+    embed_module = Embed(8, 300, t.randn(300, 8), device=t.device("cpu"))
+
+    index = get_vocab_index(embed_module)
+    assert get_vocab_index(embed_module) is index
+    index_ref = weakref.ref(index)
+    del embed_module, index
+    gc.collect()
+
+    assert index_ref() is None
@@ -0,0 +1,91 @@
+import pytest
+import torch as t
+from safetensors.torch import save_file
+
+import auto_embeds.data as data
+from auto_embeds.data import get_cached_weights
+from auto_embeds.weight_store import (
+    WeightStore,
+    checkpoint_architecture,
+    read_checkpoint_weights,
+)
+
+
+def test_read_checkpoint_weights_gpt2_layout(tmp_path):
+    wte, ln_f_w, ln_f_b = t.randn(50, 8), t.randn(8), t.randn(8)
+    save_file(
+        {
+            "transformer.wte.weight": wte,
+            "transformer.h.0.attn.c_attn.weight": t.randn(8, 24),
+        },
+        tmp_path / "model-00001.safetensors",
+    )
+    save_file(
+        {"transformer.ln_f.weight": ln_f_w, "transformer.ln_f.bias": ln_f_b},
+        tmp_path / "model-00002.safetensors",
+    )
+
+    weights = read_checkpoint_weights(
+        "gpt2",
+        [tmp_path / "model-00001.safetensors", tmp_path / "model-00002.safetensors"],
+    )
+
+    assert t.equal(weights["W_E"], wte)
+    assert t.equal(weights["W_U"], wte.T)
+    assert t.equal(weights["b_U"], t.zeros(50))
+    assert t.equal(weights["ln_final.w"], ln_f_w)
+    assert t.equal(weights["ln_final.b"], ln_f_b)
+    assert weights["embed.ln.w"] is None and weights["embed.ln.b"] is None
+
+
+def test_get_cached_weights_uses_lazy_store(tmp_path, monkeypatch):
+    weights = {"W_E": t.randn(50, 8), "embed.ln.w": None, "b_U": t.zeros(50)}
+    extractions = []
+
+    def extract_weights(model_name, processing):
+        extractions.append((model_name, processing))
+        return weights
+
+    monkeypatch.setattr(data, "cachedir", str(tmp_path))
+    monkeypatch.setattr(data, "extract_weights", extract_weights)
+
+    first = get_cached_weights("bigscience/bloom-560m", False, device="cpu")
+    second = get_cached_weights("bigscience/bloom-560m", False, device="cpu")
+
+    assert extractions == [("bigscience/bloom-560m", False)]
+    assert isinstance(second, WeightStore)
+    assert list(second) == ["W_E", "embed.ln.w", "b_U"]
+    assert t.equal(second["W_E"], weights["W_E"])
+    assert second["embed.ln.w"] is None
+    # only the accessed weights are opened
+    assert list(second._loaded) == ["W_E", "embed.ln.w"]
+    assert first["b_U"].shape == (50,)
+
+
+def test_saving_an_existing_store_keeps_it(tmp_path):
+    store_dir = tmp_path / "weights"
+    first_weights = {"W_E": t.randn(50, 8), "b_U": None}
+    WeightStore.save(store_dir, first_weights)
+    store = WeightStore(store_dir, device="cpu")
+    W_E = store["W_E"]
+
+    # e.g. a second process that also missed the store and saved it after the first
+    WeightStore.save(store_dir, {"W_E": t.randn(50, 8), "b_U": t.zeros(50)})
+
+    assert t.equal(W_E, first_weights["W_E"])
+    assert list(WeightStore(store_dir, device="cpu")) == ["W_E", "b_U"]
+    assert WeightStore(store_dir, device="cpu")["b_U"] is None
+    # the temporary directories are cleaned up
+    assert [path.name for path in tmp_path.iterdir()] == ["weights"]
+
+
+def test_checkpoint_architecture_only_matches_tied_families():
+    assert checkpoint_architecture("gpt2") == "gpt"
+    assert checkpoint_architecture("gpt2-xl") == "gpt"
+    assert checkpoint_architecture("bigscience/bloom-560m") == "bloom"
+    assert checkpoint_architecture("bigscience/bloom-7b1") == "bloom"
+    # untied unembeddings, which are loaded with TransformerLens
+    assert checkpoint_architecture("EleutherAI/gpt-j-6b") is None
+    assert checkpoint_architecture("EleutherAI/gpt-neo-125M") is None
+    with pytest.raises(ValueError):
+        read_checkpoint_weights("EleutherAI/gpt-j-6b", [])